@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Time `handle_comments` on a synthetic document containing many spans.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_dispatch.py [--spans 50000] [--baseline REV]
+
+With `--baseline`, the version of `pandocCommentFilter.py` at git revision REV
+is timed as well, so the two can be compared.
+"""
+
+import argparse
+import functools
+import subprocess
+import sys
+import time
+import types
+from os import path
+
+from pandocfilters import walk
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+CLASSES = ['comment', 'margin', 'fixme', 'highlight', 'smcaps', 'l', 'r',
+           'rp', 'i', 'other']
+
+
+def make_document(spans):
+    # A document with `spans` spans, ten to a paragraph, some of them nested.
+    blocks = []
+    inlines = []
+    for n in range(spans):
+        cls = CLASSES[n % len(CLASSES)]
+        content = [{'t': 'Str', 'c': 'word{}'.format(n)}]
+        if n % 7 == 0:
+            content.append({'t': 'Span', 'c': [['', ['highlight'], []],
+                                               [{'t': 'Str', 'c': 'nested'}]]})
+        inlines += [{'t': 'Span', 'c': [['', [cls], []], content]},
+                    {'t': 'Space'}]
+        if len(inlines) == 20:
+            blocks.append({'t': 'Para', 'c': inlines})
+            inlines = []
+    if inlines:
+        blocks.append({'t': 'Para', 'c': inlines})
+    return {'pandoc-api-version': [1, 22], 'meta': {}, 'blocks': blocks}
+
+
+def load_filter(revision=None):
+    # Import the filter, either from the working tree or from a git revision.
+    filename = path.join(ROOT, 'pandocCommentFilter.py')
+    if revision is None:
+        with open(filename) as f:
+            source = f.read()
+    else:
+        source = subprocess.check_output(
+            ['git', 'show', revision + ':pandocCommentFilter.py'],
+            cwd=ROOT).decode('utf-8')
+    module = types.ModuleType('pandocCommentFilter')
+    module.__file__ = filename
+    exec(compile(source, filename, 'exec'), module.__dict__)
+    return module
+
+
+def make_action(module, draft):
+    # The filter's action for `walk`, with the given draft status. (Older
+    # versions of the filter keep their state in globals.)
+    if hasattr(module, 'FilterState'):
+        state = module.FilterState({'draft': {'t': 'MetaBool', 'c': draft}})
+        return functools.partial(module.handle_comments, state)
+    module.DRAFT = draft
+    return module.handle_comments
+
+
+def time_filter(module, document, docFormat, draft, repeat):
+    # Best CPU times (in seconds) of `repeat` runs of the filter: walking the
+    # whole document, and calling `handle_comments` directly on each inline of
+    # each paragraph (which leaves out most of the cost of the walk).
+    meta = document['meta']
+    inlines = [inline for block in document['blocks'] for inline in block['c']]
+    bestWalk = bestCalls = None
+    for _ in range(repeat):
+        start = time.process_time()
+        walk(document, make_action(module, draft), docFormat, meta)
+        elapsed = time.process_time() - start
+        bestWalk = elapsed if bestWalk is None else min(bestWalk, elapsed)
+
+        handle_comments = make_action(module, draft)
+        start = time.process_time()
+        for inline in inlines:
+            handle_comments(inline['t'], inline.get('c'), docFormat, meta)
+        elapsed = time.process_time() - start
+        bestCalls = elapsed if bestCalls is None else min(bestCalls, elapsed)
+    return bestWalk, bestCalls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--spans', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', metavar='REV')
+    args = parser.parse_args()
+
+    document = make_document(args.spans)
+    filters = [('current', load_filter())]
+    if args.baseline:
+        filters.append((args.baseline, load_filter(args.baseline)))
+    for docFormat in ['latex', 'html5', 'revealjs']:
+        for draft in [True, False]:
+            times = [(name, time_filter(module, document, docFormat, draft,
+                                        args.repeat))
+                     for name, module in filters]
+            for n, kind in enumerate(['walk', 'handler']):
+                line = '{:8} draft={:5} {:7}'.format(docFormat, str(draft),
+                                                      kind)
+                for name, seconds in times:
+                    line += '  {}: {:.3f}s'.format(name, seconds[n])
+                if len(times) == 2:
+                    line += '  speedup: {:.2f}x'.format(times[1][1][n] /
+                                                        times[0][1][n])
+                print(line)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Compare `walk_inplace` with `pandocfilters.walk` on a synthetic document.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_walk.py [--paragraphs 5000] [--span-every 1]
+        [--repeat 5]
+
+For each output format and draft status this prints the best wall time of
+walking the document with `handle_comments`, and the memory allocated while
+doing so (the peak reported by `tracemalloc`, measured in a separate run).
+`walk_inplace` skips paragraphs and markup with nothing but text in them (see
+`inert`), so with `--span-every` above 1, when only every Nth paragraph has a
+span, it gains more.
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+from pandocfilters import walk
+
+from bench_dispatch import load_filter, make_action
+
+
+def make_document(paragraphs, spanEvery=1):
+    # A document that is mostly ordinary text: each paragraph has forty
+    # words and some emphasis, and every `spanEvery`th has one span (every
+    # fifth paragraph has a nested span); every tenth block is a bullet
+    # list.
+    blocks = []
+    classes = ['comment', 'highlight', 'fixme', 'smcaps', 'r']
+    for n in range(paragraphs):
+        inlines = []
+        for word in range(40):
+            inlines += [{'t': 'Str', 'c': 'word{}'.format(word)},
+                        {'t': 'Space'}]
+        inlines[10] = {'t': 'Emph', 'c': [{'t': 'Str', 'c': 'emphasis'}]}
+        content = [{'t': 'Str', 'c': 'spanned'}]
+        if n % 5 == 0:
+            content.append({'t': 'Span', 'c': [['', ['highlight'], []],
+                                               [{'t': 'Str', 'c': 'nested'}]]})
+        if n % spanEvery == 0:
+            inlines[20] = {'t': 'Span', 'c': [
+                ['', [classes[n % len(classes)]], []], content]}
+        if n % 10 == 9:
+            blocks.append({'t': 'BulletList',
+                           'c': [[{'t': 'Plain', 'c': inlines[:10]}],
+                                 [{'t': 'Plain', 'c': inlines[10:20]}]]})
+        blocks.append({'t': 'Para', 'c': inlines})
+    return {'pandoc-api-version': [1, 22], 'meta': {}, 'blocks': blocks}
+
+
+def inplace(module):
+    # `walk_inplace`, skipping what the action's FilterState lets it skip.
+    def walker(x, action, docFormat, meta):
+        return module.walk_inplace(x, action, docFormat, meta,
+                                   action.args[0].skip)
+    return walker
+
+
+def measure(walker, module, document, docFormat, draft, repeat):
+    # Best wall time (in seconds) and peak allocation (in bytes) of walking a
+    # fresh copy of `document` with `walker`.
+    meta = document['meta']
+    best = None
+    for _ in range(repeat):
+        copy = deepcopy(document)
+        action = make_action(module, draft)
+        start = time.perf_counter()
+        walker(copy, action, docFormat, meta)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    copy = deepcopy(document)
+    action = make_action(module, draft)
+    tracemalloc.start()
+    walker(copy, action, docFormat, meta)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--paragraphs', type=int, default=5000)
+    parser.add_argument('--span-every', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    module = load_filter()
+    document = make_document(args.paragraphs, args.span_every)
+    for docFormat in ['latex', 'html5', 'revealjs']:
+        for draft in [True, False]:
+            walkTime, walkPeak = measure(walk, module, document, docFormat,
+                                         draft, args.repeat)
+            inplaceTime, inplacePeak = measure(inplace(module), module,
+                                               document, docFormat, draft,
+                                               args.repeat)
+            print('{:8} draft={:5}  walk: {:.3f}s {:6.1f}MB  '
+                  'walk_inplace: {:.3f}s {:6.1f}MB  speedup: {:.2f}x'.format(
+                      docFormat, str(draft), walkTime, walkPeak / 1e6,
+                      inplaceTime, inplacePeak / 1e6, walkTime / inplaceTime))
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Generate a synthetic document (as pandoc's JSON AST) for benchmarking.
+
+    python benchmarks/corpus.py [--paragraphs 1000] [--density 0.1]
+        [--tikz 0] [--transclusions 0] [--seed 1] OUTDIR
+
+This writes OUTDIR/corpus.json, and the files it transcludes (if any). The
+document has the markup of both filters: spans, nested spans and tag-style
+(raw HTML) inlines; `<!comment>` blocks and `::: comment` divs; `< `
+paragraphs; labels and references; TikZ figures; and `@[...](file)`
+transclusions. `--density` is the chance that a word starts some inline
+markup; block-level markup is a fifth as frequent.
+"""
+
+import argparse
+import json
+import random
+from os import makedirs, path
+
+API_VERSION = [1, 22]
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+INLINE_CLASSES = ['comment', 'highlight', 'fixme', 'margin', 'smcaps']
+REFERENCE_CLASSES = ['l', 'r', 'rp', 'i']
+BLOCK_TAGS = ['<!comment>', '<!box>', '<center>', '<!speaker>']
+DIV_CLASSES = ['comment', 'box', 'center', 'speaker']
+TIKZ = ('\\begin{{tikzpicture}}\n'
+        '\\draw (0,0) circle ({}pt);\n'
+        '\\end{{tikzpicture}}')
+
+
+def Str(text):
+    return {'t': 'Str', 'c': text}
+
+
+def Space():
+    return {'t': 'Space'}
+
+
+def Span(cls, inlines):
+    return {'t': 'Span', 'c': [['', [cls], []], inlines]}
+
+
+def RawInline(text):
+    return {'t': 'RawInline', 'c': ['html', text]}
+
+
+def RawBlock(text):
+    return {'t': 'RawBlock', 'c': ['html', text]}
+
+
+def Para(inlines):
+    return {'t': 'Para', 'c': inlines}
+
+
+def words(rng, count):
+    # `count` random words, separated by spaces.
+    inlines = []
+    for n in range(count):
+        if n:
+            inlines.append(Space())
+        inlines.append(Str(rng.choice(WORDS)))
+    return inlines
+
+
+def markup(rng):
+    # A random piece of inline markup.
+    kind = rng.random()
+    cls = rng.choice(INLINE_CLASSES)
+    if kind < 0.35:
+        return [Span(cls, words(rng, rng.randint(1, 6)))]
+    elif kind < 0.5:  # Nested spans
+        inner = Span(rng.choice(INLINE_CLASSES), words(rng, 2))
+        return [Span(cls, words(rng, 2) + [Space(), inner])]
+    elif kind < 0.85:  # Tag-style
+        return ([RawInline('<{}>'.format(cls))] + words(rng, rng.randint(1, 6))
+                + [RawInline('</{}>'.format(cls))])
+    else:
+        label = 'label-{}'.format(rng.randint(1, 100))
+        return [Span(rng.choice(REFERENCE_CLASSES), [Str(label)])]
+
+
+def paragraph(rng, length, density):
+    # A paragraph of about `length` words, with inline markup.
+    inlines = []
+    for n in range(length):
+        if inlines:
+            inlines.append(Space())
+        if rng.random() < density:
+            inlines += markup(rng)
+        else:
+            inlines.append(Str(rng.choice(WORDS)))
+    return Para(inlines)
+
+
+def make_document(paragraphs=1000, density=0.1, tikz=0, transclusions=0,
+                  length=60, seed=1):
+    # The document, and a dictionary of files it transcludes (name: text).
+    rng = random.Random(seed)
+    blocks = []
+    files = {}
+    blockDensity = density / 5
+    for n in range(paragraphs):
+        kind = rng.random()
+        if kind < blockDensity:  # Python filter's block tags
+            tag = rng.choice(BLOCK_TAGS)
+            blocks += [RawBlock(tag), paragraph(rng, length, density),
+                       RawBlock(tag[:1] + '/' + tag[1:])]
+        elif kind < 2 * blockDensity:  # Lua filter's divs
+            blocks.append({'t': 'Div', 'c': [['', [rng.choice(DIV_CLASSES)],
+                                              []],
+                                             [paragraph(rng, length,
+                                                        density)]]})
+        elif kind < 3 * blockDensity:  # Non-indented paragraph
+            para = paragraph(rng, length, density)
+            para['c'][:0] = [Str('<'), Space()]
+            blocks.append(para)
+        else:
+            blocks.append(paragraph(rng, length, density))
+    for n in range(tikz):
+        caption = 'Figure {} with *emphasis*.'.format(n)
+        blocks.insert(rng.randint(0, len(blocks)), {
+            't': 'CodeBlock',
+            'c': [['fig{}'.format(n), ['tikz'], [['caption', caption]]],
+                  TIKZ.format(n + 1)]})
+    for n in range(transclusions):
+        name = 'transcluded-{}.md'.format(n)
+        files[name] = '\n\n'.join(
+            ' '.join(rng.choice(WORDS) for _ in range(length))
+            for _ in range(5)) + '\n'
+        blocks.insert(rng.randint(0, len(blocks)), Para([
+            Str('@'), {'t': 'Link', 'c': [['', [], []], [Str(name)],
+                                          [name, '']]}]))
+    document = {'pandoc-api-version': API_VERSION, 'meta': {},
+                'blocks': blocks}
+    return document, files
+
+
+def count_nodes(x):
+    # Number of pandoc elements in x.
+    if isinstance(x, list):
+        return sum(count_nodes(item) for item in x)
+    elif isinstance(x, dict):
+        return ('t' in x) + sum(count_nodes(value) for value in x.values())
+    return 0
+
+
+def write_corpus(outdir, **options):
+    # Write corpus.json (and transcluded files) to `outdir`, returning the
+    # path of corpus.json.
+    document, files = make_document(**options)
+    try:
+        makedirs(outdir)
+    except OSError:
+        pass
+    for name, text in files.items():
+        with open(path.join(outdir, name), 'w') as f:
+            f.write(text)
+    filename = path.join(outdir, 'corpus.json')
+    with open(filename, 'w') as f:
+        json.dump(document, f)
+    return filename
+
+
+def add_options(parser):
+    # Command-line options for `make_document`.
+    parser.add_argument('--paragraphs', type=int, default=1000)
+    parser.add_argument('--density', type=float, default=0.1)
+    parser.add_argument('--tikz', type=int, default=0)
+    parser.add_argument('--transclusions', type=int, default=0)
+    parser.add_argument('--length', type=int, default=60,
+                        help='words per paragraph')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def corpus_options(args):
+    # The `make_document` options from parsed command-line arguments.
+    return {name: getattr(args, name) for name in
+            ['paragraphs', 'density', 'tikz', 'transclusions', 'length',
+             'seed']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    add_options(parser)
+    parser.add_argument('outdir')
+    args = parser.parse_args()
+    filename = write_corpus(args.outdir, **corpus_options(args))
+    with open(filename) as f:
+        nodes = count_nodes(json.load(f))
+    print('Wrote {} ({} nodes)'.format(filename, nodes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+Time both filters on a synthetic corpus, reporting the results as JSON.
+
+Run from the root of the repository:
+
+    python benchmarks/run.py [--filters python,lua]
+        [--formats latex,html5,revealjs,docx] [--repeat 3]
+        [--output results.json] [corpus options (see corpus.py)]
+
+Each filter is run on the corpus (see `corpus.py`) for each output format, in
+draft and in final mode. The Python filter is run on its own, just as pandoc
+would run it; the Lua filter is run by `pandoc -f json`, and the time pandoc
+takes without the filter is subtracted. For each run this reports the best
+time of `--repeat` runs, throughput (nodes and MB of JSON per second), and
+the peak resident memory of the process.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from os import path
+from tempfile import mkdtemp
+from shutil import rmtree
+
+from corpus import add_options, corpus_options, count_nodes, write_corpus
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+PYTHON_FILTER = path.join(ROOT, 'pandocCommentFilter.py')
+LUA_FILTER = path.join(ROOT, 'pandocCommentFilter.lua')
+EXTENSIONS = {'latex': '.tex', 'html5': '.html', 'revealjs': '.html',
+              'docx': '.docx'}
+
+
+def pandoc_version():
+    # Version and API version of pandoc, or (None, None) if it is missing.
+    try:
+        version = subprocess.check_output(['pandoc', '--version'])
+        api = subprocess.check_output(['pandoc', '-f', 'markdown', '-t',
+                                       'json'], input=b'')
+    except OSError:
+        return None, None
+    return (version.decode('utf-8').split('\n')[0],
+            json.loads(api.decode('utf-8'))['pandoc-api-version'])
+
+
+def run(command, inputFile, cwd):
+    # Run `command` with `inputFile` as stdin, returning the wall time, peak
+    # memory (in MB), and an error message (or None).
+    with open(inputFile, 'rb') as stdin:
+        start = time.perf_counter()
+        p = subprocess.Popen(command, stdin=stdin, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, cwd=cwd)
+        errors = p.stderr.read()
+        p.stderr.close()
+        status, usage = os.wait4(p.pid, 0)[1:]
+        elapsed = time.perf_counter() - start
+        p.returncode = status = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere.
+    rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    error = None
+    if status:
+        error = 'exit status {}: {}'.format(
+            status, errors.decode('utf-8', 'replace')[-500:])
+    return elapsed, rss, error
+
+
+def best_run(command, inputFile, cwd, repeat):
+    # The fastest of `repeat` runs (stopping at the first error).
+    best = None
+    for _ in range(repeat):
+        result = run(command, inputFile, cwd)
+        if result[2]:
+            return result
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    add_options(parser)
+    parser.add_argument('--filters', default='python,lua')
+    parser.add_argument('--formats', default='latex,html5,revealjs,docx')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='file for the results '
+                        '(default: standard output)')
+    args = parser.parse_args()
+
+    pandoc, api = pandoc_version()
+    workdir = mkdtemp()
+    try:
+        corpus = write_corpus(workdir, **corpus_options(args))
+        with open(corpus) as f:
+            document = json.load(f)
+        if api:
+            document['pandoc-api-version'] = api
+        nodes = count_nodes(document)
+        inputs = {}
+        for draft in [True, False]:
+            document['meta'] = {'draft': {'t': 'MetaBool', 'c': draft}}
+            inputs[draft] = path.join(workdir, 'draft.json' if draft else
+                                      'final.json')
+            with open(inputs[draft], 'w') as f:
+                json.dump(document, f)
+        megabytes = path.getsize(inputs[True]) / (1024 * 1024)
+
+        results = []
+        for name in args.filters.split(','):
+            for docFormat in args.formats.split(','):
+                for draft in [True, False]:
+                    result = {'filter': name, 'format': docFormat,
+                              'draft': draft}
+                    results.append(result)
+                    if name == 'python':
+                        command = [sys.executable, PYTHON_FILTER, docFormat]
+                        baseline = None
+                    elif not pandoc:
+                        result['error'] = 'pandoc not found'
+                        continue
+                    else:
+                        baseline = ['pandoc', '-f', 'json', '-t', docFormat,
+                                    '-o', 'out' + EXTENSIONS.get(docFormat,
+                                                                 '.txt')]
+                        command = baseline + ['--lua-filter', LUA_FILTER]
+                    seconds, rss, error = best_run(command, inputs[draft],
+                                                   workdir, args.repeat)
+                    if error:
+                        result['error'] = error
+                        continue
+                    if baseline:
+                        result['pandoc_seconds'] = best_run(
+                            baseline, inputs[draft], workdir, args.repeat)[0]
+                        seconds = max(seconds - result['pandoc_seconds'],
+                                      1e-9)
+                    result.update({
+                        'seconds': round(seconds, 4),
+                        'nodes_per_second': round(nodes / seconds),
+                        'mb_per_second': round(megabytes / seconds, 2),
+                        'peak_rss_mb': round(rss, 1)})
+    finally:
+        rmtree(workdir)
+
+    report = {'corpus': dict(corpus_options(args), nodes=nodes,
+                             megabytes=round(megabytes, 2)),
+              'python': sys.version.split()[0], 'pandoc': pandoc,
+              'repeat': args.repeat, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -118,6 +118,18 @@ Note: if putting LaTeX into these spans, must enclose it in code spans
 
     ~~~
 
+## File Transclusion
+
+A paragraph consisting of just `@[](file.md)` is replaced by the contents of
+`file.md`, which may transclude other files in turn (with paths relative to the
+file that transcludes them). A file that would end up transcluding itself is
+reported as an error. Each file is parsed only once per run, however often it
+is transcluded. To keep the parsed files from one run to the next, set
+`transclusion-cache` in the YAML header (or the
+`PANDOC_COMMENT_FILTER_TRANSCLUSION_CACHE` environment variable) to a
+directory; they are stored there under a hash of their name and contents.
+
+
 ## Processing .tex Images
 
 This filter will take an image of the form
@@ -125,6 +137,19 @@ This filter will take an image of the form
 from that file, converting it to the appropriate file format for the desired
 output.
 
+Images (and TikZ and GraphViz figures) that need to be downloaded, copied,
+typeset, or converted are made once the whole document has been read, several
+at a time. Set the number made at once with `figure-workers` in the YAML
+header or with the `PANDOC_COMMENT_FILTER_WORKERS` environment variable
+(default: number of CPUs).
+
+Local images are made again only when their contents, or the commands that
+make them, change. `IMAGE_PATH/manifest.txt` records, for each image, the file
+it was made from, a hash of that file's contents and of the commands, and the
+file's inode, size and modification time: a file whose inode, size and
+modification time have not changed is not read again. (All the files are
+checked with a single `stat`.)
+
 
 -- ## Macros:
 
@@ -167,6 +192,32 @@ local IMAGE_PATH = HOME_PATH .. '/tmp/pandoc/Figures/'
 -- Default font for `tikz` figures
 local DEFAULT_FONT = 'fbb'
 
+-- Images to make once the whole document has been read (see `runImageJobs`):
+-- each job is a shell command, keyed by the image file it makes, with the
+-- files in the order they were queued.
+local IMAGE_JOBS = {}
+local IMAGE_JOB_ORDER = {}
+-- How the images in IMAGE_PATH were made, keyed by image file, as read from
+-- (and written to) MANIFEST_FILE: each entry has the `source` file, its `stat`
+-- (inode, size and modification time), the `hash` of its contents, and the
+-- `recipe` (a hash of the commands that made the image).
+local MANIFEST = nil
+local MANIFEST_FILE = IMAGE_PATH .. 'manifest.txt'
+-- Environment variable for the number of image jobs to run at once
+local WORKERS_VARIABLE = 'PANDOC_COMMENT_FILTER_WORKERS'
+
+-- Blocks of the files transcluded so far, keyed by a hash of file name and
+-- contents
+local TRANSCLUSIONS = {}
+-- Files being transcluded, to catch a file transcluding itself
+local TRANSCLUDING = {}
+-- Environment variable for the directory of parsed transcluded files (which
+-- can also be set with `transclusion-cache` in the YAML header)
+local TRANSCLUSION_CACHE_VARIABLE = 'PANDOC_COMMENT_FILTER_TRANSCLUSION_CACHE'
+-- Environment variable that, set to `1`, styles HTML output with classes
+-- (which can also be set with `css-classes` in the YAML header)
+local CSS_CLASSES_VARIABLE = 'PANDOC_COMMENT_FILTER_CSS_CLASSES'
+
 
 function latex(text)
     return pandoc.RawInline("latex", text)
@@ -298,6 +349,26 @@ REVEALJS_TEXT.rp = {}
 REVEALJS_TEXT.rp.Open = '<a href="#'
 REVEALJS_TEXT.rp.Close = '">here</a>'
 
+-- HTML and revealjs markup using classes instead of `style` attributes (see
+-- `useCSSClasses`), and the stylesheet for them
+local CLASS_TEXT = {}
+CLASS_TEXT.block_comment = '<div class="pcf-block-comment">'
+CLASS_TEXT.block_box = '<div class="pcf-box">'
+CLASS_TEXT.block_center = '<div class="pcf-center">'
+CLASS_TEXT.comment = '<span class="pcf-comment">'
+CLASS_TEXT.margin = '<span class="pcf-margin">'
+CLASS_TEXT.fixme = '<span class="pcf-fixme">'
+local CLASS_STYLESHEET = string.format([[<style type="text/css">
+.pcf-block-comment, .pcf-comment { color: %s; }
+.pcf-margin { color: %s; %s }
+.pcf-fixme { color: %s; }
+.pcf-fixme::before { content: "Fix this!"; %s }
+.pcf-center { text-align: center; }
+.pcf-box { border: 1px solid black; padding: 1.5ex; }
+</style>]], COLORS.comment, COLORS.margin, MARGIN_STYLE, COLORS.fixme,
+        MARGIN_STYLE)
+local CSS_CLASSES = false
+
 function docx(text)
     return pandoc.RawInline("openxml", text)
 end
@@ -398,6 +469,30 @@ function isWord(text)
 end
 
 
+function useCSSClasses(meta)
+    -- Style HTML output with classes if `css-classes` is set in the YAML
+    -- header or CSS_CLASSES_VARIABLE in the environment.
+    local cssClasses = meta["css-classes"]
+    if cssClasses == nil then
+        cssClasses = os.getenv(CSS_CLASSES_VARIABLE) or ''
+    elseif type(cssClasses) ~= "boolean" then
+        cssClasses = pandoc.utils.stringify(cssClasses)
+    end
+    if type(cssClasses) == "string" then
+        cssClasses = cssClasses:lower()
+        cssClasses = cssClasses == '1' or cssClasses == 'true' or
+                     cssClasses == 'yes'
+    end
+    CSS_CLASSES = cssClasses
+    if CSS_CLASSES then
+        for name, text in pairs(CLASS_TEXT) do
+            HTML_TEXT[name].Open = html(text)
+            REVEALJS_TEXT[name].Open = html(text)
+        end
+    end
+end
+
+
 function getYAML(meta)
     -- Record metadata for later use, and count words.
     for key, value in pairs(meta) do
@@ -440,6 +535,7 @@ function getYAML(meta)
             end
         end
     end
+    useCSSClasses(meta)
     -- Set defaults for inlines if not already set manually.
     if YAML_VARS.draft then
         YAML_VARS.comment   = YAML_VARS.comment   or pandoc.MetaInlines({pandoc.Str('draft')})
@@ -479,6 +575,15 @@ function setYAML(meta)
             table.insert(meta["header-includes"], pandoc.MetaList(rawInlines))
         end
     end
+    if CSS_CLASSES and (isHTML(FORMAT) or FORMAT == "revealjs") then
+        -- Need to add the stylesheet for the classes
+        local rawInlines = {pandoc.MetaInlines({html(CLASS_STYLESHEET)})}
+        if meta["header-includes"] == nil then
+            meta["header-includes"] = pandoc.MetaList(rawInlines)
+        else
+            table.insert(meta["header-includes"], pandoc.MetaList(rawInlines))
+        end
+    end
     print(string.format("Words: %d │ Abstract: %d │ Notes: %d │ Body: %d",
           WORD_COUNT - YAML_WORDS + ABSTRACT_COUNT, ABSTRACT_COUNT, NOTE_COUNT,
           WORD_COUNT - NOTE_COUNT - YAML_WORDS))
@@ -498,28 +603,133 @@ local function fileExists(name)
 end
 
 
-function handleTransclusion(para)
-    -- Process file transclusion
+local function shellQuote(text)
+    -- Quote text as a single word for the shell
+    return "'" .. text:gsub("'", "'\\''") .. "'"
+end
+
+
+local function normalizePath(fileName)
+    -- Returns `fileName` without `.` and `dir/..` segments (or repeated
+    -- slashes), so that a file has one name however it is reached.
+    local absolute = fileName:sub(1, 1) == "/"
+    local parts = {}
+    for part in fileName:gmatch("[^/]+") do
+        if part == ".." and #parts > 0 and parts[#parts] ~= ".." then
+            table.remove(parts)
+        elseif part == ".." and absolute then
+            -- (`/..` is `/`.)
+        elseif part ~= "." then
+            table.insert(parts, part)
+        end
+    end
+    local normalized = table.concat(parts, "/")
+    if absolute then
+        return "/" .. normalized
+    elseif normalized == "" then
+        return "."
+    end
+    return normalized
+end
+
+
+local function tmpSuffix()
+    -- Returns a suffix for the name of a temporary file that no other build
+    -- is using. (`os.tmpname` creates the file it names, so that is removed.)
+    local name = os.tmpname()
+    os.remove(name)
+    return pandoc.sha1(name .. os.time() .. os.clock())
+end
+
+
+local function transclusionError(message, fileName)
+    -- Report an error, returning a paragraph that shows it in the document
+    print("ERROR: " .. message .. " " .. fileName .. "!")
+    return pandoc.Para({
+        pandoc.Math("InlineMath", "\\Longrightarrow"),
+        pandoc.Str(" ERROR: " .. message .. " "),
+        pandoc.Code(fileName),
+        pandoc.Str("! "),
+        pandoc.Math("InlineMath", "\\Longleftarrow")
+        })
+end
+
+
+local function readTransclusion(fileName, text)
+    -- Returns the blocks of a transcluded file with contents `text`, parsing
+    -- it only if it has not been parsed before (in this run, or in the
+    -- transclusion cache).
+    local key = pandoc.sha1(fileName .. "\0" .. text)
+    if TRANSCLUSIONS[key] == nil then
+        local directory = os.getenv(TRANSCLUSION_CACHE_VARIABLE)
+        if YAML_VARS["transclusion-cache"] then
+            directory = pandoc.utils.stringify(YAML_VARS["transclusion-cache"])
+        end
+        local cacheFile = nil
+        local doc = nil
+        if directory and directory ~= "" and pandoc.write then
+            -- (Parsed files are stored as JSON, which depends on the version
+            -- of pandoc.)
+            cacheFile = directory .. "/" ..
+                pandoc.sha1(key .. tostring(PANDOC_VERSION)) .. ".json"
+            local f = io.open(cacheFile, "r")
+            if f then
+                doc = pandoc.read(f:read("*all"), "json")
+                f:close()
+            end
+        end
+        if doc == nil then
+            doc = pandoc.read(text)
+            if cacheFile then
+                os.execute("mkdir -p " .. shellQuote(directory))
+                local tmpfile = cacheFile .. "." .. tmpSuffix()
+                local f = io.open(tmpfile, "w")
+                if f then
+                    f:write(pandoc.write(doc, "json"))
+                    f:close()
+                    os.rename(tmpfile, cacheFile)
+                end
+            end
+        end
+        TRANSCLUSIONS[key] = doc.blocks
+    end
+    return TRANSCLUSIONS[key]
+end
+
+
+function handleTransclusion(para, directory)
+    -- Process file transclusion, including any transclusions in the
+    -- transcluded file. `directory` is that of the file containing `para`
+    -- (if it is itself transcluded). Files are known by their normalized
+    -- names, so that a cycle is caught however its files are named (`./a.md`
+    -- or `../d/a.md` in `d/a.md`, e.g.).
     if FORMAT == "markdown" then  -- Don't change anything if translating to .md
         return
     elseif #para.content == 2 and
             para.content[1].text == "@" and
             para.content[2].t == "Link" then
-        fileName = para.content[2].target
+        local fileName = para.content[2].target
+        if directory and not fileName:match("^[/~]") then
+            fileName = directory .. fileName
+        end
+        fileName = normalizePath(fileName)
         if not fileExists(fileName) then
-            print("ERROR: Cannot find " .. fileName .. "!")
-            return pandoc.Para({
-                pandoc.Math("InlineMath", "\\Longrightarrow"),
-                pandoc.Str(" ERROR: Cannot find "),
-                pandoc.Code(fileName),
-                pandoc.Str("! "),
-                pandoc.Math("InlineMath", "\\Longleftarrow")
-                })
+            return transclusionError("Cannot find", fileName)
+        elseif TRANSCLUDING[fileName] then
+            return transclusionError("Transclusion cycle at", fileName)
         end
         local file = io.open(fileName, "r")
         local text = file:read("*all")
         file:close()
-        return pandoc.read(text).blocks
+        local blocks = readTransclusion(fileName, text)
+        local fileDirectory = fileName:match("^(.*/)") or ""
+        TRANSCLUDING[fileName] = true
+        local div = pandoc.walk_block(pandoc.Div(blocks), {
+            Para = function(p)
+                return handleTransclusion(p, fileDirectory)
+            end})
+        TRANSCLUDING[fileName] = nil
+        return div.content
     end
 end
 
@@ -548,56 +758,226 @@ function handleNoIndent(para)
 end
 
 
-local function imageOutdated(original, imageFile)
-    -- Takes two filepaths and checks to see if original is newer than
-    -- imageFile (if imageFile is outdated). Returns `true` if outdated.
-    local f = io.popen('stat -f %m "' .. original .. '"')
-    -- local f = io.popen('stat -f %m ' .. original)
-    local originalModified = f:read()
-    if originalModified == nil then
-        return true
+local function readManifest()
+    -- Returns MANIFEST, reading it from MANIFEST_FILE the first time.
+    if MANIFEST == nil then
+        MANIFEST = {}
+        local f = io.open(MANIFEST_FILE, 'r')
+        if f then
+            for line in f:lines() do
+                local imageFile, source, stat, hash, recipe =
+                    line:match("^([^\t]+)\t([^\t]+)\t(%d+ %d+ %d+)\t(%x+)\t(%x+)$")
+                if imageFile then
+                    MANIFEST[imageFile] = {source = source, stat = stat,
+                                           hash = hash, recipe = recipe}
+                end
+            end
+            f:close()
+        end
+    end
+    return MANIFEST
+end
+
+
+local function writeManifest()
+    -- Write MANIFEST to MANIFEST_FILE (by way of a temporary file, so that
+    -- other builds never read a partly written manifest).
+    local imageFiles = {}
+    for imageFile, _ in pairs(MANIFEST) do
+        table.insert(imageFiles, imageFile)
+    end
+    table.sort(imageFiles)
+    local tmpfile = MANIFEST_FILE .. '.' .. tmpSuffix()
+    local f = io.open(tmpfile, 'w')
+    if f == nil then
+        print('ERROR: Could not write ' .. MANIFEST_FILE .. '.')
+        return
+    end
+    for _, imageFile in ipairs(imageFiles) do
+        local entry = MANIFEST[imageFile]
+        f:write(table.concat({imageFile, entry.source, entry.stat, entry.hash,
+                              entry.recipe}, '\t') .. '\n')
     end
     f:close()
-    f = io.popen('stat -f %m "' .. imageFile .. '"')
-    local copiedModified = f:read()
+    os.rename(tmpfile, MANIFEST_FILE)
+end
+
+
+local function fileHash(name)
+    -- Returns the sha1 hash of a file's contents (or nil if it can't be read)
+    local f = io.open(name, 'rb')
+    if f == nil then
+        return nil
+    end
+    local contents = f:read("*all")
     f:close()
-    if originalModified > copiedModified then  -- Need to update....
-        return true
-    else  -- Image is current.
-        return false
+    return pandoc.sha1(contents)
+end
+
+
+local function fileStats(files)
+    -- Returns the inode, size and modification time of each file (as a string,
+    -- keyed by file name), from one run of `stat` (GNU, or else BSD).
+    local stats = {}
+    if #files == 0 then
+        return stats
+    end
+    local quoted = {}
+    for _, name in ipairs(files) do
+        table.insert(quoted, shellQuote(name))
+    end
+    quoted = table.concat(quoted, ' ')
+    local p = io.popen("stat -L -c '%i %s %Y %n' " .. quoted .. " 2>/dev/null" ..
+        " || stat -L -f '%i %z %m %N' " .. quoted .. " 2>/dev/null")
+    for line in p:lines() do
+        local stat, name = line:match("^(%d+ %d+ %d+) (.*)$")
+        if stat then
+            stats[name] = stat
+        end
     end
+    p:close()
+    return stats
 end
 
 
-function convertImage(imageToConvert, convertedImage)
-    -- Converts image to new file format
-    if os.execute("convert -density 300 " .. imageToConvert ..
-               " -quality 100 " .. convertedImage) then
-        print('Successfully converted ' .. imageToConvert .. ' to ' ..
-            convertedImage .. '.')
-    else
-        print('ERROR: Could not convert ' .. imageToConvert .. ' to ' ..
-            convertedImage .. '.')
+local function convertCommand(imageToConvert, convertedImage)
+    -- Shell command that converts image to new file format
+    return 'convert -density 300 ' .. shellQuote(imageToConvert) ..
+        ' -quality 100 ' .. shellQuote(convertedImage)
+end
+
+
+local function queueImageJob(imageFile, commands, source, tmpfiles)
+    -- Queue shell commands (run in order, stopping at the first that fails)
+    -- that make imageFile. If the image is made from a local `source` file, it
+    -- is made only if the manifest shows that it is out of date. `tmpfiles`
+    -- are removed once the job is done.
+    if IMAGE_JOBS[imageFile] == nil then
+        IMAGE_JOBS[imageFile] = {command = table.concat(commands, ' && '),
+                                 source = source, tmpfiles = tmpfiles or {}}
+        table.insert(IMAGE_JOB_ORDER, imageFile)
     end
 end
 
 
-function typeset(outputLocation, filehead, filetype, codeType)
-    -- filetype is the desired output filetype (`.pdf` or `.png`).
-    local success = nil
-    if codeType == "dot" then
-        -- Note: outputLocation is the actual file
-        success = os.execute("dot -T" .. string.sub(filetype, 2) .. " -o " .. outputLocation .. " " .. filehead)
-    elseif codeType == "tex" then
-        -- Note: outputLocation is the directory
-        success = os.execute("pdflatex -output-directory " .. outputLocation .. " " ..
-            filehead)
+local function dropCurrentJobs()
+    -- Remove the jobs for images that are up to date from the queue,
+    -- returning true if the manifest has changed. Sets `hash`, `stat` and
+    -- `recipe` of each remaining job that has a source file.
+    local manifest = readManifest()
+    local sources = {}
+    for _, imageFile in ipairs(IMAGE_JOB_ORDER) do
+        if IMAGE_JOBS[imageFile].source then
+            table.insert(sources, IMAGE_JOBS[imageFile].source)
+        end
     end
-    if success then
-        print('Successfully typeset ' .. filehead .. '.')
-    else
-        print('ERROR: Could not typeset ' .. filehead .. '.')
+    local stats = fileStats(sources)
+    local changed = false
+    local jobOrder = {}
+    for _, imageFile in ipairs(IMAGE_JOB_ORDER) do
+        local job = IMAGE_JOBS[imageFile]
+        local entry = manifest[imageFile]
+        local current = false
+        if job.source then
+            job.stat = stats[job.source] or "0 0 0"
+            job.recipe = pandoc.sha1(job.command)
+            if entry and entry.source == job.source and
+                    entry.stat == job.stat then
+                job.hash = entry.hash
+            else
+                job.hash = fileHash(job.source)
+            end
+            current = job.hash ~= nil and entry ~= nil and
+                entry.source == job.source and entry.hash == job.hash and
+                entry.recipe == job.recipe and fileExists(imageFile)
+            if current and entry.stat ~= job.stat then
+                -- Touched, but not changed: don't read it again next time.
+                entry.stat = job.stat
+                changed = true
+            end
+        end
+        if current then
+            IMAGE_JOBS[imageFile] = nil
+        else
+            table.insert(jobOrder, imageFile)
+        end
+    end
+    IMAGE_JOB_ORDER = jobOrder
+    return changed
+end
+
+
+local function imageWorkers()
+    -- Number of image jobs to run at once: `figure-workers` in the YAML
+    -- header, WORKERS_VARIABLE in the environment, or the number of CPUs.
+    local workers = os.getenv(WORKERS_VARIABLE)
+    if YAML_VARS["figure-workers"] then
+        workers = pandoc.utils.stringify(YAML_VARS["figure-workers"])
+    end
+    workers = tonumber(workers or "")
+    if workers == nil then
+        local p = io.popen("getconf _NPROCESSORS_ONLN 2>/dev/null")
+        workers = tonumber(p:read("*l") or "")
+        p:close()
     end
+    return math.max(1, math.floor(workers or 1))
+end
+
+
+function runImageJobs(doc)
+    -- Run the queued image jobs that are needed, `imageWorkers()` at a time,
+    -- with `xargs -P`. Their output goes to stderr; each reports on stdout
+    -- whether it succeeded.
+    if #IMAGE_JOB_ORDER == 0 then
+        return
+    end
+    local changed = dropCurrentJobs()
+    if #IMAGE_JOB_ORDER == 0 then
+        if changed then
+            writeManifest()
+        end
+        return
+    end
+    local listFile = os.tmpname()
+    local f = io.open(listFile, 'w')
+    for n, imageFile in ipairs(IMAGE_JOB_ORDER) do
+        f:write('(' .. IMAGE_JOBS[imageFile].command .. ') </dev/null >&2 ' ..
+            '&& echo "ok ' .. n .. '" || echo "failed ' .. n .. '"\0')
+    end
+    f:close()
+    local succeeded = {}
+    local p = io.popen('xargs -0 -n 1 -P ' .. imageWorkers() .. ' sh -c < ' ..
+        shellQuote(listFile))
+    for line in p:lines() do
+        local status, n = line:match("^(%a+) (%d+)$")
+        if status == "ok" then
+            succeeded[tonumber(n)] = true
+        end
+    end
+    p:close()
+    os.remove(listFile)
+    local manifest = readManifest()
+    for n, imageFile in ipairs(IMAGE_JOB_ORDER) do
+        local job = IMAGE_JOBS[imageFile]
+        if succeeded[n] then
+            print('Created image ' .. imageFile .. '.')
+            if job.hash then
+                manifest[imageFile] = {source = job.source, stat = job.stat,
+                                       hash = job.hash, recipe = job.recipe}
+            else
+                manifest[imageFile] = nil
+            end
+        else
+            print('ERROR: Could not create ' .. imageFile .. '.')
+            manifest[imageFile] = nil
+        end
+        for _, tmpfile in ipairs(job.tmpfiles) do
+            os.remove(tmpfile)
+        end
+    end
+    writeManifest()
+    IMAGE_JOBS = {}
+    IMAGE_JOB_ORDER = {}
 end
 
 
@@ -622,25 +1002,27 @@ function handleImages(image)
     if imageFile:find("^https?://") then
         -- It's an online image; need to download to IMAGE_PATH
         imageBaseName = IMAGE_PATH .. imageBaseName
-        if fileExists(imageBaseName .. imageExtension) then
+        local downloadedFile = imageBaseName .. imageExtension
+        local commands = {}
+        if fileExists(downloadedFile) then
             print(imageFile .. " already exists.")
         else
-            print("Downloading " .. imageFile .. " to " .. imageBaseName ..
-                imageExtension .. ".")
-            if os.execute("wget --quiet " .. imageFile .. " --output-document=" ..
-                    imageBaseName .. imageExtension) then
-                print('Successfully downloaded ' .. imageFile .. '.')
-            else
-                print('ERROR: Could not download ' .. imageFile .. '.')
-            end
-            -- Because sometimes the downloaded file is old, this prevents it
-            -- from being automatically deleted.
-            os.execute("touch " .. imageBaseName .. imageExtension)
+            print("Downloading " .. imageFile .. " to " .. downloadedFile .. ".")
+            commands = {
+                "wget --quiet " .. shellQuote(imageFile) ..
+                    " --output-document=" .. shellQuote(downloadedFile),
+                -- Because sometimes the downloaded file is old, this prevents
+                -- it from being automatically deleted.
+                "touch " .. shellQuote(downloadedFile)}
         end
         -- Convert image if necessary....
         if imageExtension ~= filetype and
                 not fileExists(imageBaseName .. filetype) then
-            convertImage(imageBaseName .. imageExtension, imageBaseName .. filetype)
+            table.insert(commands, convertCommand(downloadedFile,
+                imageBaseName .. filetype))
+        end
+        if #commands > 0 then
+            queueImageJob(imageBaseName .. filetype, commands)
         end
     else  --Local image.
         -- Pandoc gives filename with spaces represented by '%20'. Need to
@@ -674,31 +1056,26 @@ function handleImages(image)
             end
             imageBaseName = string.gsub(imageBaseName, "%%20", "_")
             local newImageFile = IMAGE_PATH .. imageBaseName .. newImageExtension
-            -- Typeset image if necessary, or copy to IMAGE_PATH
-            if not fileExists(newImageFile) or imageOutdated(imageFile,
-                    newImageFile) then
-                if imageExtension == ".tex" then  -- i.e., if it's LaTeX file...
-                    typeset(IMAGE_PATH, imageFile, filetype, "tex")
-                elseif imageExtension == ".dot" then
-                    typeset(newImageFile, imageFile, filetype, "dot")
-                else
-                    if os.execute('cp -f "' .. imageFile .. '" "' .. newImageFile
-                            .. '"') then
-                        print('Successfully copied file ' .. imageFile .. '.')
-                    else
-                        print('ERROR: Could not copy ' .. imageFile .. ' to ' ..
-                            newImageFile .. '.')
-                    end
-                end
-            end
-            imageFile = newImageFile
             imageBaseName = IMAGE_PATH .. imageBaseName
-            -- Convert image if necessary....
-            if newImageExtension ~= filetype and (not fileExists(imageBaseName ..
-                    filetype) or imageOutdated(imageFile, imageBaseName .. filetype))
-                    then
-                convertImage(imageFile, imageBaseName .. filetype)
+            -- Typeset image, or copy it to IMAGE_PATH, and then convert it if
+            -- necessary, unless that has been done since it last changed.
+            local commands = {}
+            if imageExtension == ".tex" then  -- i.e., if it's LaTeX file...
+                commands = {"pdflatex -interaction=nonstopmode " ..
+                    "-output-directory " .. shellQuote(IMAGE_PATH) .. " " ..
+                    shellQuote(imageFile)}
+            elseif imageExtension == ".dot" then
+                commands = {"dot -T" .. string.sub(filetype, 2) .. " -o " ..
+                    shellQuote(newImageFile) .. " " .. shellQuote(imageFile)}
+            else
+                commands = {"cp -f " .. shellQuote(imageFile) .. " " ..
+                    shellQuote(newImageFile)}
             end
+            if newImageExtension ~= filetype then
+                table.insert(commands, convertCommand(newImageFile,
+                    imageBaseName .. filetype))
+            end
+            queueImageJob(imageBaseName .. filetype, commands, imageFile)
         end
     end
     local attr = pandoc.Attr(image.identifier, image.classes, image.attributes)
@@ -708,39 +1085,35 @@ end
 
 
 function tikz2image(tikz, filetype, outfile)
-    -- Given text of a TikZ LaTeX image, create an image of given filetype in
-    -- given location.
+    -- Given text of a TikZ LaTeX image, queue a job to create an image of
+    -- given filetype in given location.
     local tmphead = os.tmpname()
     local tmpdir = tmphead:match("^(.*[\\/])") or "."
     local f = io.open(tmphead .. ".tex", 'w')
     f:write(tikz)
     f:close()
-    typeset(tmpdir, tmphead, filetype, "tex")
+    local commands = {"pdflatex -interaction=nonstopmode -output-directory " ..
+        shellQuote(tmpdir) .. " " .. shellQuote(tmphead .. ".tex")}
     if filetype == '.pdf' then
-        os.rename(tmphead .. ".pdf", outfile)
+        table.insert(commands, "mv -f " .. shellQuote(tmphead .. ".pdf") ..
+            " " .. shellQuote(outfile))
     else
-        convertImage(tmphead .. '.pdf', outfile)
+        table.insert(commands, convertCommand(tmphead .. ".pdf", outfile))
     end
-    os.remove(tmphead .. ".tex")
-    os.remove(tmphead .. ".pdf")
+    queueImageJob(outfile, commands, nil, {tmphead, tmphead .. ".tex",
+        tmphead .. ".pdf", tmphead .. ".aux", tmphead .. ".log"})
 end
 
 
 function dot2image(dot, filetype, outfile)
-    -- Given text of a GraphViz image, create an image of given filetype in
-    -- given location.
+    -- Given text of a GraphViz image, queue a job to create an image of given
+    -- filetype in given location.
     local tmpfile = os.tmpname()
     local f = io.open(tmpfile, 'w')
     f:write(dot)
     f:close()
-    typeset(outfile, tmpfile, filetype, "dot")
-    if filetype ~= '.pdf' then
-        os.rename(tmpfile .. ".pdf", outfile)
-    else
-        convertImage(tmpfile .. '.pdf', outfile)
-    end
-    os.remove(tmpfile)
-    os.remove(tmpfile .. ".pdf")
+    queueImageJob(outfile, {"dot -T" .. string.sub(filetype, 2) .. " -o " ..
+        shellQuote(outfile) .. " " .. shellQuote(tmpfile)}, nil, {tmpfile})
 end
 
 
@@ -779,7 +1152,6 @@ function generateImage(code, format)
         elseif format == 'dot' then
             dot2image(code.text, filetype, outfile)
         end
-        print('Created image ' .. outfile)
     else
         print(outfile .. ' already exists.')
     end
@@ -1028,6 +1400,7 @@ local COMMENT_FILTER = {
     {Div = handleBlocks},         -- Comment blocks (before inlines)
     -- {Inlines = Inlines},
     {Image = handleImages},       -- Images (so captions get inline filters)
+    {Pandoc = runImageJobs},      -- Make the images (after all are queued)
     -- {Math = handleMacros},        -- Replace macros from YAML data
     -- {Quoted = handleQuotes},      -- LaTeX: auto use csquotes' `\blockquote`
     {Span = handleInlines},       -- Comment and cross-ref inlines
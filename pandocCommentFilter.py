@@ -82,6 +82,46 @@ Copyright (C) 2017 Bennett Helm
     - `[text-for-index]{.i}`: create LaTeX index (`\\index{text-for-index}`)
 
 
+## Cross-References
+
+In LaTeX, references are left to `\\cref` and `\\cpageref`. In HTML and docx,
+the filter resolves them itself: before the document is walked, it indexes
+every label (including the identifiers of headers and figures) with the
+section it is in and the figure it is in, if any. A reference then becomes a
+link reading, e.g., "figure 3", or "section 2.1" if sections are numbered
+(page references too, since there are no pages). Pandoc does not tell filters
+about `--number-sections`, so set `number-sections: true` in the YAML header
+(or the `PANDOC_COMMENT_FILTER_NUMBER_SECTIONS` environment variable) when
+using it; otherwise, and for unnumbered sections, a reference reads the
+section's title. References to labels that are not in the index are reported,
+and read "??".
+
+To resolve references to other documents (the chapters of a book built one
+file at a time, e.g.), set `label-index` in the YAML header (or the
+`PANDOC_COMMENT_FILTER_LABEL_INDEX` environment variable) to a file to which
+the document's index is written as JSON, and `label-index-url` to the URL of
+the document's output (`chapter1.html`, e.g.). Then list those files under
+`label-index-import` in the YAML header of the other documents (or in
+`PANDOC_COMMENT_FILTER_LABEL_INDEX_IMPORT`, separated by `:`). Labels in the
+document itself take precedence over imported ones.
+
+
+## Macros
+
+Math is abused to make easy macros. Define them in the YAML header:
+
+    macros:
+    - first: This is the *first* macro.
+      second: This is the **second** macro. [With fixme.]{.fixme}
+
+and then use them in the text as `$first$` and `$second$`. Each is replaced by
+its definition, which may contain any of the markup above (and other macros).
+(Where pandoc does not read `$...$` as math, such as with
+`-f markdown-tex_math_dollars`, macros in the text are found all the same.) As
+long as the names of the macros are not identical to any actual math, there
+should be no problem.
+
+
 ## Images: Allow for tikZ figures in code blocks. They should have the
    following format:
 
@@ -92,29 +132,210 @@ Copyright (C) 2017 Bennett Helm
 
 ~~~
 
-Note that the caption can be formatted text in markdown.
+Note that the caption can be formatted text in markdown. Captions that use
+only emphasis, strong emphasis, code, math, links and spans are read by the
+filter itself; the rest are run through pandoc (all at once).
+
+Figures that are not already in `IMAGE_PATH` are typeset once the whole
+document has been read, several at a time. Set the number of simultaneous
+`pdflatex` runs with `figure-workers` in the YAML header or with the
+`PANDOC_COMMENT_FILTER_WORKERS` environment variable (default: number of
+CPUs). Figures with the same font and TikZ libraries are typeset together, as
+the pages of one document (split into separate files by `pdfseparate` for PDF
+output, or by a single `convert` run for PNG output), each worker taking a
+share of them; if that fails, they are typeset one at a time. So that
+`standalone`, the font and TikZ need not be loaded for each document, the
+preamble is first made into a LaTeX format (with `mylatexformat`), which is
+kept in `IMAGE_PATH` until the version of `pdflatex` changes (or it is evicted
+like a figure; see below).
+
+Figures are cached in `IMAGE_PATH` under a hash of their code, font, TikZ
+libraries, file type and `pdflatex` version, and are recorded in
+`IMAGE_PATH/index.sqlite`. Once the figures (and formats) recorded there
+grow beyond `figure-cache-size` megabytes (YAML header or
+`PANDOC_COMMENT_FILTER_CACHE_SIZE`; default 1024), the least recently used are
+deleted. Only those count: the Lua filter's images and manifest, and figures
+made before the index was, are left alone. Temporary files left behind by
+interrupted builds are deleted after an hour.
+
+
+## HTML Styles
+
+By default, comments, margin notes and the like are styled in HTML and
+revealjs output by `style` attributes on each element. With `css-classes:
+true` in the YAML header (or the `PANDOC_COMMENT_FILTER_CSS_CLASSES`
+environment variable set to `1`), they are given classes (`pcf-comment`,
+`pcf-margin`, `pcf-fixme`, `pcf-smcaps`, `pcf-block-comment`, `pcf-box`,
+`pcf-center`, `pcf-speaker`) instead, and one stylesheet for them is added to
+`header-includes`.
+
+
+## File Transclusion
+
+A paragraph consisting of just `@[](file.md)` is replaced by the contents of
+`file.md`, which may transclude other files in turn (with paths relative to the
+file that transcludes them). A file that would end up transcluding itself is
+reported as an error. Each file is parsed (by pandoc) only once per run,
+however often it is transcluded. To keep the parsed files from one run to the
+next, set `transclusion-cache` in the YAML header (or the
+`PANDOC_COMMENT_FILTER_TRANSCLUSION_CACHE` environment variable) to a
+directory; they are stored there under a hash of their name and contents.
+
+
+## Large Documents
+
+Documents that contain none of the markup above (and all documents converted
+to markdown) are passed through unchanged, without being parsed.
+
+Set the `PANDOC_COMMENT_FILTER_STREAM` environment variable (to, e.g., `1`) to
+have the filter read and write the document one top-level block at a time,
+instead of loading all of it into memory at once. The output is the same.
+
+To speed up rebuilding a long document after small changes, set
+`block-cache` in the YAML header (or the `PANDOC_COMMENT_FILTER_BLOCK_CACHE`
+environment variable) to a directory. The filtered output of each top-level
+block is stored there, and reused the next time the same block is filtered
+in the same state (inside a comment, e.g.) for the same output format. The
+document is then read a block at a time, as above. Blocks not used for 30
+days are removed.
+
+To filter many documents without starting Python for each one, run
+`pandocCommentFilter.py --serve` (reading from stdin) or
+`pandocCommentFilter.py --serve SOCKET` (listening on a Unix socket). Send
+each document (pandoc's JSON output) as a line `FORMAT LENGTH` followed by
+LENGTH bytes of JSON; the reply is a line `ok LENGTH` followed by the filtered
+JSON, or `error LENGTH` followed by a message. (Documents with none of the
+filter's markup are sent back as they are, without being parsed, so malformed
+JSON without markup comes back `ok`.)
+
+Python programs can instead import this file and call
+`filter_document(document, format)` on a parsed JSON document, which returns
+the filtered document. Several documents can be filtered at once in threads.
+
+
+## Startup Time
+
+`pandocCommentFilter.py --profile-startup [FORMAT]` reports how long the
+filter takes to start and which imports are slowest. Python compiles a script
+each time it is run, but caches the compiled code of modules it imports, so the
+filter starts faster (by 10 ms or so) when pandoc is given a wrapper script
+like this one (with `pandocCommentFilter.py` on `PYTHONPATH`):
+
+    #!/usr/bin/env python
+    from pandocCommentFilter import main
+    main()
+
+
+## Profiling
+
+With the `PANDOC_COMMENT_FILTER_PROFILE` environment variable set to `1`, the
+filter reports on stderr, when it exits, how many times it did each kind of
+work and how long that took: each kind of element `handle_comments` looked at
+(by span class, tag, and so on; the time for a span includes the elements
+inside it), each kind of subprocess (`pandoc`, `pdflatex`, `convert`), reading
+and writing JSON, and hits and misses of the figure and caption caches. Set
+the variable to a file name instead to have the report written there as JSON.
+When the variable is not set, none of this is recorded.
 
 """
 
 
-from pandocfilters import json, sys, walk, elt, stringify,\
-    RawInline, Para, Plain, Image, Str
-from os import path, mkdir, chdir, getcwd
-from shutil import copyfile, rmtree
+import json
+import sys
+from os import path, makedirs, environ, cpu_count, close, remove, replace, \
+    pathsep
+from re import compile as re_compile
+from copy import deepcopy
+from functools import partial
 from sys import getfilesystemencoding, stderr
-from subprocess import call, Popen, PIPE
-from hashlib import sha1
+from time import perf_counter
+# `pandocfilters` (for `stringify`), `subprocess`, `shutil` and `hashlib` are
+# imported only when first needed, since importing them takes longer than
+# filtering most documents.
 
 IMAGE_PATH = path.expanduser('~/tmp/pandoc/Figures')
 DEFAULT_FONT = 'fbb'
-INLINE_TAG_STACK = []
-BLOCK_COMMENT = False
-INLINE_COMMENT = False
-INLINE_MARGIN = False
-INLINE_HIGHLIGHT = False
-INLINE_FONT_COLOR_STACK = ['black']
-USED_BOX = False
-DRAFT = False
+# Number of figures typeset concurrently. Set with `figure-workers` in the
+# YAML header or with this environment variable; defaults to the CPU count.
+WORKERS_VARIABLE = 'PANDOC_COMMENT_FILTER_WORKERS'
+# Size limit of the figures indexed in IMAGE_PATH in megabytes. Set with
+# `figure-cache-size` in the YAML header or with this environment variable.
+# When it is exceeded, the least recently used figures are deleted.
+CACHE_SIZE_VARIABLE = 'PANDOC_COMMENT_FILTER_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+EVICTION_GRACE = 60 * 60  # Seconds
+# sqlite database in IMAGE_PATH recording the figures stored there.
+FIGURE_INDEX = 'index.sqlite'
+# If this environment variable is set (to anything but an empty string), the
+# document is read and written a top-level block at a time rather than all at
+# once.
+STREAM_VARIABLE = 'PANDOC_COMMENT_FILTER_STREAM'
+# Directory of the cache of filtered blocks (see `BlockCache`). Set with
+# `block-cache` in the YAML header or with this environment variable; there is
+# no cache unless one of them is set.
+BLOCK_CACHE_VARIABLE = 'PANDOC_COMMENT_FILTER_BLOCK_CACHE'
+BLOCK_CACHE = 'blocks.sqlite'
+BLOCK_CACHE_AGE = 30 * 24 * 60 * 60  # Seconds a block is kept after last use
+# Directory of parsed transcluded files. Set with `transclusion-cache` in the
+# YAML header or with this environment variable; they are not stored unless one
+# of them is set.
+TRANSCLUSION_CACHE_VARIABLE = 'PANDOC_COMMENT_FILTER_TRANSCLUSION_CACHE'
+# Environment variables for the file the label index is written to, the URL
+# of the document's output that it records, and the label index files to read
+# (separated by `os.pathsep`) (can also be set with `label-index`,
+# `label-index-url` and `label-index-import` in the YAML header)
+LABEL_INDEX_VARIABLE = 'PANDOC_COMMENT_FILTER_LABEL_INDEX'
+LABEL_INDEX_URL_VARIABLE = 'PANDOC_COMMENT_FILTER_LABEL_INDEX_URL'
+LABEL_INDEX_IMPORT_VARIABLE = 'PANDOC_COMMENT_FILTER_LABEL_INDEX_IMPORT'
+# Environment variable that, set to `1`, has references read section numbers,
+# for documents converted with `--number-sections` (can also be set with
+# `number-sections` or `numbersections` in the YAML header)
+NUMBER_SECTIONS_VARIABLE = 'PANDOC_COMMENT_FILTER_NUMBER_SECTIONS'
+# Environment variable that, set to `1`, styles HTML output with classes (can
+# also be set with `css-classes` in the YAML header)
+CSS_CLASSES_VARIABLE = 'PANDOC_COMMENT_FILTER_CSS_CLASSES'
+# Set by `profile_startup` in the filter it runs, to have it report when it
+# reaches the document.
+STARTUP_VARIABLE = 'PANDOC_COMMENT_FILTER_STARTUP'
+STARTUP_TARGET = 30  # Milliseconds from launch to first node
+# If this environment variable is set, the filter times its work and reports at
+# exit: to stderr if it is `1`, or otherwise as JSON to the file it names.
+PROFILE_VARIABLE = 'PANDOC_COMMENT_FILTER_PROFILE'
+PROFILE = None  # The `Profile` being recorded, if any
+READ_SIZE = 64 * 1024  # Characters read at a time when streaming
+SPOOL_SIZE = 16 * 1024 * 1024  # Filtered blocks kept in memory when streaming
+PDFLATEX_VERSION = None
+# `pdflatex`'s report of the number of pages it wrote
+PDF_PAGES = re_compile(r'Output written on .*\((\d+) pages?')
+PANDOC_VERSION = None
+# Blocks of transcluded files, keyed by `transclusion_key`.
+TRANSCLUSIONS = {}
+# Formatted TikZ captions, keyed by caption text.
+CAPTIONS = {}
+# Captions starting like this might be read by pandoc as something other than
+# a paragraph (a list, a header, a quotation, ...), so are left to pandoc.
+BLOCK_START = re_compile(r'^(\(?([0-9]+|[A-Za-z]|[ivxlcdmIVXLCDM]+|#|@[\w-]*)'
+                         r'[.)]( |$)|[-+*]( |$)|[>|:#%=~]|\(@)')
+# Characters in captions that `parse_inlines` does not handle as text: markup
+# it parses, and anything it leaves to pandoc (raw HTML, entities, citations,
+# superscripts, subscripts, and quotes that pandoc would make curly).
+CAPTION_MARKUP = frozenset('\\*_`$[]{}<>&@^~"\'')
+# Characters that may follow markup without a space
+MARKUP_FOLLOWERS = frozenset('.,;:!?')
+# Characters that a backslash makes literal
+ESCAPABLE = frozenset('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~')
+# Words after which pandoc puts a non-breaking space instead of a space
+ABBREVIATIONS = frozenset([
+    'Mr.', 'Mrs.', 'Ms.', 'Capt.', 'Dr.', 'Prof.', 'Gen.', 'Gov.', 'e.g.',
+    'i.e.', 'Sgt.', 'St.', 'vol.', 'vs.', 'Sen.', 'Rep.', 'Pres.', 'Hon.',
+    'Rev.', 'Ph.D.', 'M.D.', 'M.A.', 'p.', 'pp.', 'ch.', 'chap.', 'sec.',
+    'cf.', 'cp.'])
+LAST_TOKEN = re_compile(r'[^\W_][\w.]*$')
+LINK_TARGET = re_compile(r'\(([A-Za-z0-9_/:.~%#?=+-]+)(?: "([^"\\&]*)")?\)')
+SPAN_ATTRIBUTE = re_compile(r'\.([\w-]+)$|#([\w:.-]+)$|([\w-]+)='
+                            r'(?:"([^"\\&\s]*)"|([^"\'\\&\s]+))$')
+# Span classes that pandoc turns into other elements
+SPECIAL_SPAN_CLASSES = frozenset(['smallcaps', 'underline', 'ul', 'mark'])
 
 COLORS = {
     '<!comment>': 'red',
@@ -201,6 +422,32 @@ REVEALJS_TEXT = {
     '<smcaps>': '<span style="font-variant: small-caps;">',
     '</smcaps>': '</span>'
 }
+# Markup for HTML and revealjs using classes instead of `style` attributes,
+# styled by CLASS_STYLESHEET (see `css_classes`)
+CLASS_TEXT = {
+    '<!comment>': '<div class="pcf-block-comment">',
+    '<comment>': '<span class="pcf-comment">',
+    '<margin>': '<span class="pcf-margin">',
+    '<fixme>': '<span class="pcf-fixme">',
+    '<center>': '<div class="pcf-center">',
+    '<!box>': '<div class="pcf-box">',
+    '<!speaker>': '<div class="pcf-speaker">',
+    '<smcaps>': '<span class="pcf-smcaps">'
+}
+HTML_CLASS_TEXT = dict(HTML_TEXT, **CLASS_TEXT)
+REVEALJS_CLASS_TEXT = dict(REVEALJS_TEXT, **CLASS_TEXT)
+REVEALJS_CLASS_TEXT['<!speaker>'] = REVEALJS_TEXT['<!speaker>']
+CLASS_STYLESHEET = (
+    '<style type="text/css">\n'
+    '.pcf-block-comment, .pcf-comment, .pcf-speaker {{ color: {}; }}\n'
+    '.pcf-margin {{ color: {}; {} }}\n'
+    '.pcf-fixme {{ color: {}; }}\n'
+    '.pcf-fixme::before {{ content: "Fix this!"; {} }}\n'
+    '.pcf-center {{ text-align: center; }}\n'
+    '.pcf-box {{ border: 1px solid black; padding: 1.5ex; }}\n'
+    '.pcf-smcaps {{ font-variant: small-caps; }}\n'
+    '</style>').format(COLORS['<comment>'], COLORS['<margin>'], MARGIN_STYLE,
+                       COLORS['<fixme>'], MARGIN_STYLE)
 DOCX_TEXT = {
     '<!comment>': '',
     '</!comment>': '',
@@ -222,40 +469,1010 @@ DOCX_TEXT = {
     '</smcaps>': ''
 }
 
+# Output formats the filter marks up, with the format of their raw elements
+# and the markup to use.
+FORMAT_TEXT = {
+    'latex': ('latex', LATEX_TEXT),
+    'beamer': ('latex', LATEX_TEXT),
+    'html': ('html', HTML_TEXT),
+    'html5': ('html', HTML_TEXT),
+    'revealjs': ('html', REVEALJS_TEXT),
+    'docx': ('openxml', DOCX_TEXT)
+}
+# Output formats that can be styled with classes, and the markup to use
+CLASS_FORMAT_TEXT = {
+    'html': ('html', HTML_CLASS_TEXT),
+    'html5': ('html', HTML_CLASS_TEXT),
+    'revealjs': ('html', REVEALJS_CLASS_TEXT)
+}
+# Span classes the filter handles; a span with more than one of them is
+# treated according to the one listed first.
+SPAN_CLASSES = {name: priority for priority, name in enumerate(
+    ['comment', 'margin', 'fixme', 'highlight', 'smcaps', 'i', 'l', 'r',
+     'rp'])}
+# Byte strings, one of which appears in the JSON of any document the filter
+# would change (see `needs_filter`): tags and `< ` paragraphs begin with '<',
+# TikZ figures have a `tikz` class or a `tikzpicture`, transclusions begin with
+# '@', and spans have one of the SPAN_CLASSES. (Documents that write a label
+# index have `label-index`, and those with macros have `macros`.)
+MARKERS = (b'"<', b'\\u003c', b'\\u003C', b'"tikz"', b'{tikzpicture}',
+           b'"@"', b'"label-index"', b'"macros"')
+SPAN_MARKERS = tuple(json.dumps(name).encode('ascii') for name in SPAN_CLASSES)
+# Labels and references: (class/tag name, LaTeX markup, HTML markup). (In HTML,
+# references are resolved with the label index instead.)
+REFERENCES = [
+    ('l', u'\\label{{{}}}', u'<a name="{}"></a>'),
+    ('r', u'\\cref{{{}}}', None),
+    ('rp', u'\\cpageref{{{}}}', None)
+]
+# Output formats in which the filter resolves references itself (see
+# `LabelIndex`)
+REFERENCE_FORMATS = frozenset(['html', 'html5', 'docx'])
+# Actions in the dispatch tables (see `build_dispatch_table`)
+WRAP = 'wrap'              # Wrap contents in opening and closing markup
+CONTENT = 'content'        # Output contents without markup
+DROP = 'drop'              # Output nothing
+IGNORE = 'ignore'          # Leave element alone
+TEMPLATE = 'template'      # Output raw markup containing the text
+INLINE_TAG = 'inline tag'  # Tag-style comment, fixme, margin, or highlight
+SMCAPS_TAG = 'smcaps tag'  # Tag-style small caps
+BLOCK_TAG = 'block tag'    # Opening or closing block element
+REFERENCE = 'reference'    # Label or reference resolved with the label index
+# Ranges of blocks or inlines that are suppressed in final output (opening
+# tag: closing tag), which `prune_comments` cuts out whole
+BLOCK_RANGES = {'<!comment>': '</!comment>'}
+INLINE_RANGES = {'<comment>': '</comment>', '<margin>': '</margin>'}
+# Elements (besides paragraphs and the document) whose contents
+# `prune_comments` checks: the index of the list in the element's contents
+# (None for the contents themselves), and the ranges to look for
+PRUNED_LISTS = {
+    'Plain': (None, INLINE_RANGES),
+    'Header': (2, INLINE_RANGES),
+    'Div': (1, BLOCK_RANGES),
+    'BlockQuote': (None, BLOCK_RANGES)
+}
+# Markup that does nothing (such as highlighting or coloring nothing, or
+# changing the color twice in a row), which `merge_raw_inlines` removes from
+# runs of raw inlines, by raw format. Only the filter's own empty spans are
+# dropped: a user's `<span id="...">` is an anchor, and the fixme span holds
+# its label in CSS.
+NO_OP_MARKUP = {
+    'latex': re_compile(r'\\hl\{\}|\\textsc\{\}|\\textcolor\{[^{}]*\}\{\}|'
+                        r'\\color\{[^{}]*\}\{\}(?=\\color\{[^{}]*\}\{\})'),
+    'html': re_compile(r'<mark></mark>|'
+                       r'<span(?: style="[^"<>]*"| class="pcf-(?!fixme")'
+                       r'[a-z]+")?></span>')
+}
+# Macro tables (see `macro_table`), keyed by the JSON of the `macros` metadata
+MACRO_TABLES = {}
+# Dispatch tables, keyed by (output format, draft status, CSS classes)
+DISPATCH_TABLES = {}
+# Elements with no other elements inside them, which `walk_inplace` need not
+# look into
+LEAF_ELEMENTS = frozenset(['Str', 'Space', 'SoftBreak', 'LineBreak', 'Code',
+                           'Math', 'RawInline', 'RawBlock', 'CodeBlock',
+                           'HorizontalRule', 'Null'])
+# Elements that can be neither labels nor tags, which `LabelIndex` skips
+UNLABELLED = LEAF_ELEMENTS - frozenset(['RawInline', 'RawBlock', 'CodeBlock'])
+# Elements that `handle_comments` leaves alone if all the elements in them
+# are (see `inert`), with the index of the list in their contents (None for
+# the contents themselves)
+INERT_CONTAINERS = {'Emph': None, 'Strong': None, 'Strikeout': None,
+                    'Underline': None, 'Superscript': None, 'Subscript': None,
+                    'SmallCaps': None, 'Quoted': 1, 'Link': 1, 'Image': 1,
+                    'Para': None, 'Plain': None, 'Header': 2}
+
 
 def debug(text):
     stderr.write("*****\n" + str(text) + "\n*****\n")
 
 
 def my_sha1(x):
+    from hashlib import sha1
     return sha1(x.encode(getfilesystemencoding())).hexdigest()
 
 
-def tikz2image(tikz, filetype, outfile):
-    from tempfile import mkdtemp
+class Profile(object):
+    # How many times the filter did each kind of work, and how long it took
+    # (see "Profiling" above). `destination` is the value of PROFILE_VARIABLE.
+
+    def __init__(self, destination):
+        import atexit
+        from threading import Lock
+        self.destination = destination
+        self.start = perf_counter()
+        self.counts = {}
+        self.seconds = {}
+        self.lock = Lock()  # (Figures are typeset in several threads.)
+        atexit.register(self.report)
+
+    def add(self, name, seconds=None):
+        # Count `name`, adding `seconds` to its time (events that are only
+        # counted have no time).
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if seconds is not None:
+                self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def action(self, action):
+        # Wrap an action for `walk_inplace` so that it is timed.
+        def profiled(key, value, format, meta):
+            start = perf_counter()
+            result = action(key, value, format, meta)
+            self.add(node_name(key, value), perf_counter() - start)
+            return result
+        return profiled
+
+    def report(self):
+        # Write the report to stderr or to the file named by `destination`.
+        total = perf_counter() - self.start
+        names = sorted(self.counts,
+                       key=lambda n: (-self.seconds.get(n, -1), n))
+        if self.destination != '1':
+            with open(self.destination, 'w') as f:
+                json.dump({'seconds': total, 'work': [
+                    {'name': name, 'count': self.counts[name],
+                     'seconds': self.seconds.get(name)} for name in names]},
+                    f, indent=2)
+            return
+        stderr.write('Profile ({:.1f} ms in all):\n{:>9} {:>11} {:>11}  {}\n'
+                     .format(total * 1000, 'count', 'total ms', 'mean us',
+                             'work'))
+        for name in names:
+            if name in self.seconds:
+                stderr.write('{:9d} {:11.1f} {:11.1f}  {}\n'.format(
+                    self.counts[name], self.seconds[name] * 1000,
+                    self.seconds[name] * 1e6 / self.counts[name], name))
+            else:
+                stderr.write('{:9d} {:>11} {:>11}  {}\n'.format(
+                    self.counts[name], '-', '-', name))
+
+
+def node_name(key, value):
+    # How an element passed to `handle_comments` is reported when profiling:
+    # its type, and its class or tag if it is one the filter handles.
+    if key == 'Span':
+        classes = [c for c in value[0][1] if c in SPAN_CLASSES]
+        if classes:
+            return 'Span .' + min(classes, key=SPAN_CLASSES.get)
+    elif key in ['RawInline', 'RawBlock'] and value[0] == 'html':
+        tag = value[1].lower()
+        if ' ' in tag and tag.endswith('>'):
+            tag = tag[:tag.index(' ')] + ' ...>'
+        if tag in HTML_TEXT or tag in ['<i ...>', '<l ...>', '<r ...>',
+                                       '<rp ...>']:
+            return '{} {}'.format(key, tag)
+    elif key == 'CodeBlock' and is_figure(value[0][1], value[1]):
+        return 'CodeBlock (TikZ)'
+    return key
+
+
+class Timer(object):
+    # Context manager that adds the time taken by its body to PROFILE under
+    # `name` (or does nothing if not profiling).
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if PROFILE is not None:
+            self.start = perf_counter()
+
+    def __exit__(self, *exception):
+        if PROFILE is not None:
+            PROFILE.add(self.name, perf_counter() - self.start)
+
+
+def count(name):
+    # Count an event (a cache hit, e.g.) in PROFILE, if profiling.
+    if PROFILE is not None:
+        PROFILE.add(name)
+
+
+if environ.get(PROFILE_VARIABLE):
+    PROFILE = Profile(environ[PROFILE_VARIABLE])
+
+
+def tikz2image(tikz, filetype, outfile, fmt=None):
+    # Note: this runs in worker threads, so must not change the working
+    # directory of the process. The image is written to a temporary file in
+    # IMAGE_PATH and then renamed, so other builds sharing IMAGE_PATH never see
+    # a partly written file. `fmt` is as for `run_pdflatex`. If the image
+    # cannot be made, nothing is written (so that it is tried again next
+    # time), the error is reported, and False is returned.
+    from tempfile import mkdtemp, mkstemp
+    from shutil import copyfile, rmtree
+    from subprocess import call, DEVNULL
     tmpdir = mkdtemp()
-    olddir = getcwd()
-    chdir(tmpdir)
-    f = open('tikz.tex', 'w')
+    f = open(path.join(tmpdir, 'tikz.tex'), 'w')
     f.write(tikz)
     f.close()
-    call(['pdflatex', 'tikz.tex'], stdout=stderr)
-    chdir(olddir)
-    if filetype == '.pdf':
-        copyfile(path.join(tmpdir, 'tikz.pdf'), outfile + filetype)
-    else:
-        call(['convert', '-density', '300', path.join(tmpdir, 'tikz.pdf'),
-              '-quality', '100', outfile + filetype])
-    rmtree(tmpdir)
+    status = run_pdflatex(tmpdir, fmt)
+    pdf = path.join(tmpdir, 'tikz.pdf')
+    handle, tmpfile = mkstemp(suffix=filetype, dir=IMAGE_PATH)
+    close(handle)
+    try:
+        if status or not path.isfile(pdf):
+            error = 'pdflatex failed (exit status {})'.format(status)
+        elif filetype == '.pdf':
+            copyfile(pdf, tmpfile)
+            error = None
+        else:
+            with Timer('subprocess convert'):
+                status = call(['convert', '-density', '300', pdf, '-quality',
+                               '100', tmpfile], stdin=DEVNULL)
+            error = 'convert failed (exit status {})'.format(status) \
+                if status else None
+        if error is None and not path.getsize(tmpfile):
+            error = 'the image is empty'
+        if error is not None:
+            debug('ERROR: Could not make {}{}: {}!'.format(outfile, filetype,
+                                                         error))
+            return False
+        replace(tmpfile, outfile + filetype)
+        return True
+    except OSError as e:  # (No `convert`, e.g.)
+        debug('ERROR: Could not make {}{}: {}!'.format(outfile, filetype, e))
+        return False
+    finally:
+        if path.exists(tmpfile):
+            remove(tmpfile)
+        rmtree(tmpdir)
+
+
+def tikz2images(preamble, figures, fmt=None):
+    # Typeset several figures with the same preamble and file type (`figures`
+    # is a list of (code, filetype, outfile)) as the pages of one document,
+    # with a single `pdflatex` run, splitting the pages with `pdfseparate`
+    # (for PDF) or a single `convert` run. Returns the figures that could not
+    # be made this way (all of them if there is an error in any), which
+    # `tikz2image` can then typeset one at a time. Like `tikz2image`, this
+    # runs in worker threads.
+    from tempfile import mkdtemp, mkstemp
+    from shutil import copyfile, rmtree, which
+    from subprocess import call, DEVNULL
+    filetype = figures[0][1]
+    if filetype == '.pdf' and which('pdfseparate') is None:
+        return figures
+    tmpdir = mkdtemp()
+    try:
+        with open(path.join(tmpdir, 'tikz.tex'), 'w') as f:
+            f.write(figure_document(preamble, [figure[0] for figure
+                                               in figures]))
+        status = run_pdflatex(tmpdir, fmt)
+        if status or pdf_pages(path.join(tmpdir, 'tikz.log')) != len(figures):
+            return figures
+        pdf = path.join(tmpdir, 'tikz.pdf')
+        if filetype == '.pdf':
+            with Timer('subprocess pdfseparate'):
+                status = call(['pdfseparate', pdf,
+                               path.join(tmpdir, 'page-%d.pdf')],
+                              stdin=DEVNULL)
+            first = 1
+        else:
+            with Timer('subprocess convert'):
+                status = call(['convert', '-density', '300', pdf, '-quality',
+                               '100', path.join(tmpdir, 'page-%d' + filetype)],
+                              stdin=DEVNULL)
+            first = 0
+        if status:
+            return figures
+        failed = []
+        for n, figure in enumerate(figures, first):
+            page = path.join(tmpdir, 'page-{}{}'.format(n, filetype))
+            if not path.isfile(page) or not path.getsize(page):
+                failed.append(figure)
+                continue
+            handle, tmpfile = mkstemp(suffix=filetype, dir=IMAGE_PATH)
+            close(handle)
+            try:
+                copyfile(page, tmpfile)
+                replace(tmpfile, figure[2] + filetype)
+            finally:
+                if path.exists(tmpfile):
+                    remove(tmpfile)
+        return failed
+    finally:
+        rmtree(tmpdir)
+
+
+def run_pdflatex(tmpdir, fmt=None):
+    # Run `pdflatex` on `tikz.tex` in tmpdir, returning its exit status. With
+    # `fmt` (see `figure_format`), the preamble comes ready-made from that
+    # format; if that fails, `pdflatex` is run again without it. (`pdflatex`
+    # must never wait for input: with `--serve`, stdin is the filter's.)
+    from subprocess import call, DEVNULL
+    options = ['-interaction=nonstopmode', '-halt-on-error']
+    if fmt:
+        with Timer('subprocess pdflatex'):
+            status = call(['pdflatex', '-fmt=' + fmt] + options +
+                          ['tikz.tex'], stdin=DEVNULL, stdout=stderr,
+                          cwd=tmpdir)
+        if status == 0:
+            return status
+    with Timer('subprocess pdflatex'):
+        return call(['pdflatex'] + options + ['tikz.tex'], stdin=DEVNULL,
+                    stdout=stderr, cwd=tmpdir)
+
+
+def figure_format(preamble):
+    # Path (without `.fmt`) of a LaTeX format in IMAGE_PATH with `preamble`
+    # already loaded, made with `mylatexformat` if it isn't there yet, or
+    # None if it cannot be made. Formats are named by a hash of the preamble
+    # and the `pdflatex` version, since a format only works with the version
+    # of TeX that made it. (The document's own preamble is skipped when it
+    # is typeset with the format.)
+    from tempfile import mkdtemp, mkstemp
+    from shutil import copyfile, rmtree
+    from subprocess import call, DEVNULL
+    name = 'tikz-' + my_sha1(preamble + pdflatex_version())
+    fmt = path.join(IMAGE_PATH, name)
+    if path.isfile(fmt + '.fmt'):
+        count('figure format hit')
+        return fmt
+    count('figure format miss')
+    tmpdir = mkdtemp()
+    try:
+        with open(path.join(tmpdir, name + '.tex'), 'w') as f:
+            f.write(figure_document(preamble, []))
+        with Timer('subprocess pdflatex -ini'):
+            status = call(['pdflatex', '-ini', '-interaction=nonstopmode',
+                           '-halt-on-error', '-jobname=' + name, '&pdflatex',
+                           'mylatexformat.ltx', name + '.tex'],
+                          stdin=DEVNULL, stdout=stderr, cwd=tmpdir)
+        built = path.join(tmpdir, name + '.fmt')
+        if status or not path.isfile(built):
+            return None
+        handle, tmpfile = mkstemp(suffix='.fmt', dir=IMAGE_PATH)
+        close(handle)
+        try:
+            copyfile(built, tmpfile)
+            replace(tmpfile, fmt + '.fmt')
+        finally:
+            if path.exists(tmpfile):
+                remove(tmpfile)
+        return fmt
+    except OSError:  # (No `pdflatex`, e.g.)
+        return None
+    finally:
+        rmtree(tmpdir)
+
+
+def pdf_pages(logFile):
+    # Number of pages `pdflatex` reports in its log (or None).
+    try:
+        with open(logFile, encoding='latin-1') as f:
+            match = PDF_PAGES.search(f.read())
+    except OSError:
+        return None
+    return int(match.group(1)) if match else None
+
+
+def figure_preamble(font, library):
+    # Preamble of a document of TikZ figures (see `figure_document`).
+    preamble = ('\\documentclass[multi]{{standalone}}\n'
+                '\\usepackage{{{}}}\n'
+                '\\usepackage{{tikz}}\n'
+                '\\newenvironment{{tikzfigure}}{{}}{{}}\n'
+                '\\standaloneenv{{tikzfigure}}\n').format(font)
+    if library:
+        preamble += '\\usetikzlibrary{{{}}}\n'.format(library)
+    return preamble
+
+
+def figure_document(preamble, codes):
+    # A LaTeX document with one page (a `tikzfigure`) for each figure's code.
+    return preamble + '\\begin{document}\n' + ''.join(
+        '\\begin{{tikzfigure}}\n{}\n\\end{{tikzfigure}}\n'.format(code)
+        for code in codes) + '\\end{document}\n'
+
+
+def typeset_figures(preamble, figures, fmt=None):
+    # Typeset figures with the same preamble and file type, together if
+    # there is more than one, and otherwise (or if that fails) one at a time.
+    # `fmt` is as for `run_pdflatex`.
+    if len(figures) > 1:
+        figures = tikz2images(preamble, figures, fmt)
+    for code, filetype, outfile in figures:
+        tikz2image(figure_document(preamble, [code]), filetype, outfile, fmt)
+
+
+def pdflatex_version():
+    # First line of `pdflatex --version` (or '' if it is not installed), so
+    # that figures are regenerated when TeX is updated.
+    global PDFLATEX_VERSION
+    if PDFLATEX_VERSION is None:
+        from subprocess import Popen, PIPE, DEVNULL
+        try:
+            with Timer('subprocess pdflatex --version'):
+                p = Popen(['pdflatex', '--version'], stdin=DEVNULL,
+                          stdout=PIPE)
+                PDFLATEX_VERSION = p.communicate()[0].decode('utf-8') \
+                    .split('\n')[0]
+        except OSError:
+            PDFLATEX_VERSION = ''
+    return PDFLATEX_VERSION
+
+
+def figure_file(code, font, library, filetype):
+    # Path (without extension) of the cached figure for the given inputs.
+    key = '\n\0'.join([code, font, library, filetype, pdflatex_version()])
+    return path.join(IMAGE_PATH, my_sha1(key))
+
+
+def meta_text(value):
+    # The text of a metadata value. (`stringify` leaves out a MetaString, as
+    # given by `pandoc -M`, unless it is in a list.)
+    if value['t'] == 'MetaString':
+        return value['c']
+    from pandocfilters import stringify
+    return stringify(value)
+
+
+def meta_option(meta, name, variable, default):
+    # Value of an option set in the YAML header or, failing that, in an
+    # environment variable.
+    if name in meta:
+        return meta_text(meta[name])
+    return environ.get(variable, default)
+
+
+def meta_list(meta, name, variable):
+    # Values of an option that may be a list, set in the YAML header or,
+    # failing that, in an environment variable (separated by `os.pathsep`).
+    if name in meta:
+        value = meta[name]
+        items = value['c'] if value['t'] == 'MetaList' else [value]
+        return [meta_text(item) for item in items]
+    value = environ.get(variable, '')
+    return value.split(pathsep) if value else []
+
+
+def meta_flag(meta, name, variable):
+    # Value of a yes/no option set in the YAML header or, failing that, in an
+    # environment variable.
+    value = meta.get(name)
+    if value is not None and value['t'] == 'MetaBool':
+        return value['c']
+    return meta_option(meta, name, variable, '').lower() in \
+        ['1', 'true', 'yes']
+
+
+def css_classes(meta):
+    # Whether to style HTML output with classes (and CLASS_STYLESHEET).
+    return meta_flag(meta, 'css-classes', CSS_CLASSES_VARIABLE)
+
+
+def figure_workers(meta):
+    # Number of worker threads to use for typesetting figures.
+    workers = meta_option(meta, 'figure-workers', WORKERS_VARIABLE, '')
+    try:
+        return max(1, int(workers))
+    except ValueError:
+        return cpu_count() or 1
+
+
+def figure_cache_size(meta):
+    # Maximum size of the figures indexed in IMAGE_PATH, in bytes.
+    size = meta_option(meta, 'figure-cache-size', CACHE_SIZE_VARIABLE, '')
+    try:
+        return int(float(size) * 1024 * 1024)
+    except ValueError:
+        return DEFAULT_CACHE_SIZE
+
+
+def use_figure(state, sourceFile, font, library, filetype):
+    # Record that the document uses a figure, for the figure index.
+    state.usedFigures[path.basename(sourceFile)] = (font, library, filetype)
+
+
+def queue_figure(state, preamble, code, filetype, outfile):
+    # Record a TikZ figure to be typeset by `render_figures`. The `Image`
+    # node only needs the file name, so it can be created right away.
+    state.pendingFigures.setdefault(outfile + filetype,
+                                    (preamble, code, filetype, outfile))
+
+
+def render_figures(state, meta):
+    # Typeset all queued TikZ figures, running up to `figure_workers(meta)`
+    # `pdflatex` processes at once, and then update the figure index. Figures
+    # with the same preamble and file type are shared out among the workers,
+    # and each worker typesets its share together (see `typeset_figures`),
+    # using a format with the preamble already loaded (see `figure_format`).
+    if not state.usedFigures:
+        return
+    try:
+        makedirs(IMAGE_PATH)
+        debug('Created directory {}\n\n'.format(IMAGE_PATH))
+    except OSError:
+        pass
+    jobs = list(state.pendingFigures.items())
+    state.pendingFigures.clear()
+    workers = min(figure_workers(meta), len(jobs))
+    groups = {}
+    for sourceFile, (preamble, code, filetype, outfile) in jobs:
+        groups.setdefault((preamble, filetype), []).append(
+            (code, filetype, outfile))
+    preambles = sorted(set(preamble for preamble, filetype in groups))
+    batches = []
+    formats = {}
+    if workers == 1:
+        formats = dict(zip(preambles, map(figure_format, preambles)))
+    elif workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            formats = dict(zip(preambles, pool.map(figure_format, preambles)))
+    for (preamble, filetype), figures in groups.items():
+        size = -(-len(figures) // workers)
+        batches += [(preamble, figures[n:n + size], formats[preamble])
+                    for n in range(0, len(figures), size)]
+    if workers == 1:
+        for batch in batches:
+            typeset_figures(*batch)
+    elif workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(typeset_figures, *batch)
+                           for batch in batches]:
+                future.result()
+    for sourceFile, job in jobs:
+        if path.isfile(sourceFile):
+            debug('Created image {}\n\n'.format(sourceFile))
+    # The formats take up room in IMAGE_PATH too, so they are indexed (and
+    # evicted) like figures.
+    used = dict(state.usedFigures)
+    for fmt in formats.values():
+        if fmt:
+            used[path.basename(fmt) + '.fmt'] = (None, None, '.fmt')
+    with Timer('figure index'):
+        update_figure_index(used, [path.basename(f) for f, job in jobs],
+                            figure_cache_size(meta))
+
+
+def update_figure_index(used, created, maxSize):
+    # Record the figures (and LaTeX formats, with file type `.fmt`) `used` by
+    # a document in the index of IMAGE_PATH, then delete the least recently
+    # used figures until those indexed are no larger than maxSize. Figures
+    # used in the last EVICTION_GRACE seconds are kept, since other builds
+    # sharing IMAGE_PATH may be about to use them. (Files the index does not
+    # know of are not counted; see `remove_temporaries`.)
+    import sqlite3
+    from time import time
+    now = time()
+    remove_temporaries(now - EVICTION_GRACE)
+    index = sqlite3.connect(path.join(IMAGE_PATH, FIGURE_INDEX), timeout=60)
+    try:
+        with index:
+            index.execute('CREATE TABLE IF NOT EXISTS figures ('
+                          'name TEXT PRIMARY KEY, font TEXT, library TEXT, '
+                          'filetype TEXT, pdflatex TEXT, size INTEGER, '
+                          'created REAL, last_used REAL, hits INTEGER)')
+            for name, (font, library, filetype) in used.items():
+                try:
+                    size = path.getsize(path.join(IMAGE_PATH, name))
+                except OSError:
+                    continue
+                if name in created:
+                    index.execute('INSERT OR REPLACE INTO figures VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                                  (name, font, library, filetype,
+                                   pdflatex_version(), size, now, now))
+                else:
+                    index.execute('INSERT INTO figures VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?, ?, 1) '
+                                  'ON CONFLICT(name) DO UPDATE SET '
+                                  'last_used = excluded.last_used, '
+                                  'hits = hits + 1',
+                                  (name, font, library, filetype,
+                                   pdflatex_version(), size, now, now))
+        with index:
+            total = index.execute('SELECT TOTAL(size) FROM figures')\
+                .fetchone()[0]
+            if total <= maxSize:
+                return
+            for name, size in index.execute(
+                    'SELECT name, size FROM figures WHERE last_used < ? '
+                    'ORDER BY last_used', (now - EVICTION_GRACE,)).fetchall():
+                try:
+                    remove(path.join(IMAGE_PATH, name))
+                except OSError:
+                    pass
+                index.execute('DELETE FROM figures WHERE name = ?', (name,))
+                total -= size
+                if total <= maxSize:
+                    break
+    finally:
+        index.close()
+
+
+def remove_temporaries(before):
+    # Delete the temporary files (made by `mkstemp`, so named `tmp...`) in
+    # IMAGE_PATH last changed before `before`, which a build that was killed
+    # (while `pdflatex` was running, e.g.) left behind.
+    from os import scandir
+    try:
+        entries = list(scandir(IMAGE_PATH))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.name.startswith('tmp') and entry.is_file() and \
+                    entry.stat().st_mtime < before:
+                remove(entry.path)
+                count('temporary file removed')
+        except OSError:
+            pass
 
 
 def toFormat(string, fromThis, toThis):
     # Process string through pandoc to get formatted JSON string.
-    p1 = Popen(['echo'] + string.split(), stdout=PIPE)
-    p2 = Popen(['pandoc', '-f', fromThis, '-t', toThis], stdin=p1.stdout,
-               stdout=PIPE)
-    p1.stdout.close()
-    return p2.communicate()[0].decode('utf-8').strip('\n')
+    from subprocess import Popen, PIPE
+    with Timer('subprocess pandoc'):
+        p = Popen(['pandoc', '-f', fromThis, '-t', toThis], stdin=PIPE,
+                  stdout=PIPE)
+        text = string + '\n'
+        output = p.communicate(text.encode('utf-8'))[0]
+    return output.decode('utf-8').strip('\n')
+
+
+def pandoc_version():
+    # First line of `pandoc --version` (or '' if it is not installed), since
+    # the JSON that pandoc writes depends on its version.
+    global PANDOC_VERSION
+    if PANDOC_VERSION is None:
+        from subprocess import Popen, PIPE, DEVNULL
+        try:
+            with Timer('subprocess pandoc --version'):
+                p = Popen(['pandoc', '--version'], stdin=DEVNULL,
+                          stdout=PIPE)
+                PANDOC_VERSION = p.communicate()[0].decode('utf-8') \
+                    .split('\n')[0]
+        except OSError:
+            PANDOC_VERSION = ''
+    return PANDOC_VERSION
+
+
+def json_blocks(jsonString):
+    # Return the list of blocks from pandoc's JSON output.
+    document = json.loads(jsonString)
+    if 'blocks' in document:
+        return document['blocks']
+    else:  # old API
+        return document[1]
+
+
+def transclusion_file(value):
+    # The file named by a transclusion paragraph (`@[](file.md)`), given the
+    # paragraph's contents, or None if it is some other paragraph.
+    if len(value) == 2 and value[0] == {'t': 'Str', 'c': '@'} and \
+            value[1]['t'] == 'Link':
+        return value[1]['c'][-1][0]
+    return None
+
+
+def transclusion_key(fileName, text):
+    # Key of a transcluded file in TRANSCLUSIONS and the transclusion cache.
+    return my_sha1(fileName + '\n\0' + text)
+
+
+def transclusion_error(message, fileName):
+    # Report an error, returning a paragraph that shows it in the document.
+    debug('ERROR: {} {}!'.format(message, fileName))
+    return Para([Math({'t': 'InlineMath'}, '\\Longrightarrow'),
+                 Str(' ERROR: {} '.format(message)),
+                 Code(['', [], []], fileName), Str('! '),
+                 Math({'t': 'InlineMath'}, '\\Longleftarrow')])
+
+
+def parse_transclusion(fileName, text, meta):
+    # Return (a copy of) the blocks of a transcluded file with contents
+    # `text`. Each file is run through pandoc only once per process, and not
+    # at all if it is found in the transclusion cache.
+    key = transclusion_key(fileName, text)
+    if key in TRANSCLUSIONS:
+        count('transclusion cache hit')
+        return deepcopy(TRANSCLUSIONS[key])
+    directory = meta_option(meta, 'transclusion-cache',
+                            TRANSCLUSION_CACHE_VARIABLE, '')
+    cacheFile = None
+    if directory:
+        cacheFile = path.join(directory, my_sha1(key + pandoc_version()) +
+                              '.json')
+        try:
+            with open(cacheFile, encoding='utf-8') as f:
+                TRANSCLUSIONS[key] = json.load(f)
+            count('transclusion cache hit (stored)')
+            return deepcopy(TRANSCLUSIONS[key])
+        except (OSError, ValueError):
+            pass
+    count('transclusion cache miss')
+    blocks = json_blocks(toFormat(text, 'markdown', 'json'))
+    TRANSCLUSIONS[key] = blocks
+    if cacheFile:
+        from tempfile import mkstemp
+        try:
+            makedirs(directory)
+        except OSError:
+            pass
+        handle, tmpfile = mkstemp(suffix='.json', dir=directory)
+        with open(handle, 'w', encoding='utf-8') as f:
+            json.dump(blocks, f)
+        replace(tmpfile, cacheFile)
+    return deepcopy(blocks)
+
+
+def transcluded_blocks(fileName, meta, directory='', transcluding=()):
+    # Return the blocks of a transcluded file, with the files it transcludes
+    # in turn put in their place, or a paragraph reporting an error.
+    # `directory` is that of the file naming `fileName` (if it was itself
+    # transcluded), and `transcluding` the files being transcluded already.
+    # Files are known by their real paths, so that a cycle is caught however
+    # its files are named (`./a.md` or `../d/a.md` in `d/a.md`, e.g.).
+    if directory and not path.isabs(fileName):
+        fileName = path.join(directory, fileName)
+    fileName = path.realpath(fileName)
+    if fileName in transcluding:
+        return [transclusion_error('Transclusion cycle at', fileName)]
+    try:
+        with open(fileName, encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        return [transclusion_error('Cannot find', fileName)]
+    blocks = parse_transclusion(fileName, text, meta)
+    transclude(blocks, meta, path.dirname(fileName),
+               transcluding + (fileName,))
+    prepare_captions(blocks)
+    return blocks
+
+
+def transclude(x, meta, directory='', transcluding=()):
+    # Replace each transclusion paragraph in x, in place, with the blocks of
+    # the file it names (see `transcluded_blocks`).
+    if isinstance(x, list):
+        i = 0
+        while i < len(x):
+            item = x[i]
+            if isinstance(item, dict) and item.get('t') == 'Para':
+                fileName = transclusion_file(item['c'])
+                if fileName is not None:
+                    blocks = transcluded_blocks(fileName, meta, directory,
+                                                transcluding)
+                    x[i:i + 1] = blocks
+                    i += len(blocks)
+                    continue
+            if isinstance(item, (list, dict)):
+                transclude(item, meta, directory, transcluding)
+            i += 1
+    elif isinstance(x, dict) and x.get('t') not in LEAF_ELEMENTS:
+        transclude(x.get('c'), meta, directory, transcluding)
+
+
+def is_figure(classes, code):
+    # True if a CodeBlock is a TikZ figure.
+    return 'tikz' in classes or '\\begin{tikzpicture}' in code
+
+
+def figure_captions(x):
+    # Yield the `caption` attribute of every TikZ CodeBlock in x.
+    if isinstance(x, list):
+        for item in x:
+            for caption in figure_captions(item):
+                yield caption
+    elif isinstance(x, dict):
+        if x.get('t') == 'CodeBlock':
+            (id, classes, attributes), code = x['c']
+            if is_figure(classes, code):
+                for a, b in attributes:
+                    if a == 'caption' and b:
+                        yield b
+                        break
+        else:
+            for caption in figure_captions(x.get('c')):
+                yield caption
+
+
+class CaptionSyntax(Exception):
+    # Raised by `parse_inlines` on markdown it leaves to pandoc.
+    pass
+
+
+def parse_caption(caption):
+    # Return the inlines that pandoc's markdown reader would make of a
+    # caption, or None if the caption uses markdown that `parse_inlines` does
+    # not handle.
+    text = ' '.join(caption.split())
+    if not text or BLOCK_START.match(text):
+        return None
+    try:
+        return parse_inlines(text)
+    except CaptionSyntax:
+        return None
+
+
+def parse_inlines(text):
+    # Parse a subset of pandoc's inline markdown: words, emphasis, strong
+    # emphasis, code, math, links, spans, and backslash escapes. Markup must
+    # start a word, and be followed by a space, punctuation, or the end of
+    # the text. Raises CaptionSyntax on anything else, since pandoc might not
+    # read it as plain text (e.g., it makes quotes curly and `--` a dash).
+    inlines = []
+    word = []  # Characters of the current word
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == ' ':
+            add_word(inlines, word)
+            inlines.append({'t': 'Space'})
+            i += 1
+        elif c == '\\':
+            if text[i + 1:i + 2] not in ESCAPABLE:  # (Or the end of the text)
+                raise CaptionSyntax(text)
+            word.append(text[i + 1])
+            i += 2
+        elif c in '*_`$[':
+            if i and text[i - 1] != ' ':
+                raise CaptionSyntax(text)
+            element, i = parse_markup(text, i)
+            inlines.append(element)
+            if i < len(text) and text[i] != ' ' and \
+                    text[i] not in MARKUP_FOLLOWERS:
+                raise CaptionSyntax(text)
+        elif c in CAPTION_MARKUP or text.startswith('--', i) or \
+                text.startswith('..', i) or text.startswith('![', i):
+            raise CaptionSyntax(text)
+        else:
+            word.append(c)
+            i += 1
+    add_word(inlines, word)
+    return inlines
+
+
+def add_word(inlines, word):
+    # Add the characters in `word` (if any) to `inlines` as a `Str`, and
+    # empty it.
+    if word:
+        text = ''.join(word)
+        token = LAST_TOKEN.search(text)
+        if token and token.group() in ABBREVIATIONS:
+            raise CaptionSyntax(text)
+        inlines.append(Str(text))
+        del word[:]
+
+
+def parse_markup(text, i):
+    # Parse the markup at text[i] (see `parse_inlines`), returning the element
+    # and the index just past the markup.
+    c = text[i]
+    if c in '*_':
+        n = 2 if text.startswith(c * 2, i) else 1
+        end = text.find(c, i + n)
+        content = text[i + n:end]
+        if end < 0 or not content or content[0] == ' ' or \
+                content[-1] in ' \\' or text[i + n] == c or \
+                text[end:end + n] != c * n or text[end + n:end + n + 1] == c:
+            raise CaptionSyntax(text)
+        return (Strong if n == 2 else Emph)(parse_inlines(content)), end + n
+    elif c in '`$':
+        end = text.find(c, i + 1)
+        content = text[i + 1:end]
+        if end < 0 or not content or content[0] in ' ' + c or \
+                content[-1] in ' \\' or text[end + 1:end + 2] == c:
+            raise CaptionSyntax(text)
+        if c == '`':
+            return Code(['', [], []], content), end + 1
+        return Math({'t': 'InlineMath'}, content), end + 1
+    # Brackets: a link or a span
+    depth = 1
+    for end in range(i + 1, len(text)):
+        if text[end] == '[' and text[end - 1] != '\\':
+            depth += 1
+        elif text[end] == ']' and text[end - 1] != '\\':
+            depth -= 1
+            if not depth:
+                break
+    else:
+        raise CaptionSyntax(text)
+    content = text[i + 1:end]
+    if content[:1] == ' ' or content[-1:] == ' ' or '`' in content or \
+            '$' in content:
+        raise CaptionSyntax(text)
+    inlines = parse_inlines(content)
+    link = LINK_TARGET.match(text, end + 1)
+    if link:
+        return (Link(['', [], []], inlines, [link.group(1),
+                                             link.group(2) or '']),
+                link.end())
+    close = text.find('}', end + 1)
+    if text[end + 1:end + 2] != '{' or close < 0:
+        raise CaptionSyntax(text)
+    identifier = ''
+    classes = []
+    attributes = []
+    for attribute in text[end + 2:close].split(' '):
+        match = SPAN_ATTRIBUTE.match(attribute)
+        if not match or match.group(3) in ['id', 'class']:
+            raise CaptionSyntax(text)
+        name, ident, key, quoted, value = match.groups()
+        if name:
+            classes.append(name)
+        elif ident:
+            identifier = ident
+        else:
+            attributes.append([key, quoted if value is None else value])
+    if SPECIAL_SPAN_CLASSES.intersection(classes):
+        raise CaptionSyntax(text)
+    return Span([identifier, classes, attributes], inlines), close + 1
+
+
+def prepare_captions(document):
+    # Convert all TikZ captions in the document at once, memoizing the results
+    # in CAPTIONS: captions `parse_caption` can read are converted directly,
+    # and the rest are put into fenced divs and run through a single pandoc
+    # process. If the output
+    # cannot be matched up with the captions (e.g., with old versions of
+    # pandoc), `caption_inlines` falls back to converting them one at a time.
+    pending = []
+    for caption in figure_captions(document):
+        if caption in CAPTIONS or caption in pending:
+            count('caption cache hit')
+            continue
+        inlines = parse_caption(caption)
+        if inlines is None:
+            count('caption cache miss (pandoc)')
+            pending.append(caption)
+        else:
+            count('caption cache miss (parsed)')
+            CAPTIONS[caption] = inlines
+    if not pending:
+        return
+    markdown = '\n\n'.join('::: caption\n{}\n:::'.format(' '.join(c.split()))
+                            for c in pending)
+    try:
+        blocks = json_blocks(toFormat(markdown, 'markdown', 'json'))
+    except ValueError:
+        return
+    if len(blocks) != len(pending) or \
+            any(block['t'] != 'Div' or not block['c'][1] for block in blocks):
+        return
+    for caption, block in zip(pending, blocks):
+        CAPTIONS[caption] = block['c'][1][0]['c']
+
+
+def caption_inlines(caption):
+    # Return formatted inlines for a TikZ caption (written in markdown).
+    if caption not in CAPTIONS:
+        count('caption cache miss (pandoc, one at a time)')
+        # Need to run this through pandoc to get JSON representation so that
+        # captions can be formatted text.
+        CAPTIONS[caption] = json_blocks(
+            toFormat(' '.join(caption.split()), 'markdown', 'json'))[0]['c']
+    return deepcopy(CAPTIONS[caption])
+
+
+def elt(eltType, numargs):
+    # Make a function that creates pandoc elements of type `eltType`, like
+    # `pandocfilters.elt`.
+    def fun(*args):
+        if len(args) != numargs:
+            raise ValueError('{} expects {} arguments, but given {}'.format(
+                eltType, numargs, len(args)))
+        if numargs == 1:
+            return {'t': eltType, 'c': args[0]}
+        return {'t': eltType, 'c': list(args)}
+    return fun
+
+
+RawInline = elt('RawInline', 2)
+Para = elt('Para', 1)
+Plain = elt('Plain', 1)
+Image = elt('Image', 3)
+Str = elt('Str', 1)
+Emph = elt('Emph', 1)
+Strong = elt('Strong', 1)
+Code = elt('Code', 2)
+Math = elt('Math', 2)
+Link = elt('Link', 3)
+Span = elt('Span', 2)
 
 
 def latex(text):
@@ -270,9 +1487,605 @@ def docx(text):
     return RawInline('openxml', text)
 
 
-def handle_comments(key, value, docFormat, meta):
-    global INLINE_TAG_STACK, BLOCK_COMMENT, INLINE_COMMENT, INLINE_MARGIN,\
-        INLINE_HIGHLIGHT, INLINE_FONT_COLOR_STACK, USED_BOX, DRAFT
+def dispatch_table(docFormat, draft, cssClasses=False):
+    # Return the dispatch table for docFormat, draft status and whether HTML
+    # is styled with classes, building it the first time it is needed.
+    try:
+        return DISPATCH_TABLES[docFormat, draft, cssClasses]
+    except KeyError:
+        table = build_dispatch_table(docFormat, draft, cssClasses)
+        DISPATCH_TABLES[docFormat, draft, cssClasses] = table
+        return table
+
+
+def build_dispatch_table(docFormat, draft, cssClasses=False):
+    # Build the table `handle_comments` uses to look up what to do with each
+    # element. Keys are (element, class or tag); values are tuples whose first
+    # item is the action (`WRAP`, `CONTENT`, ...) and whose other items are
+    # the ready-made elements to output. (The table is nested, as
+    # `table[element][class or tag]`, to make lookups cheaper.)
+    if cssClasses and docFormat in CLASS_FORMAT_TEXT:
+        rawFormat, text = CLASS_FORMAT_TEXT[docFormat]
+    else:
+        rawFormat, text = FORMAT_TEXT.get(docFormat, (None, None))
+    isLatex = docFormat in ['latex', 'beamer']
+    isHtml = docFormat in ['html', 'html5']
+
+    def raw(markup):
+        return RawInline(rawFormat, markup)
+
+    def wrap(name):
+        return (WRAP, raw(text['<{}>'.format(name)]),
+                raw(text['</{}>'.format(name)]))
+
+    table = {'Span': {}, 'RawInline': {}, 'Block': {}, 'Para': {}}
+
+    # Spans
+    if draft:
+        table['Span']['comment'] = wrap('comment') if rawFormat else (CONTENT,)
+        table['Span']['margin'] = wrap('margin') if isLatex or isHtml or \
+            docFormat == 'revealjs' else (DROP,)
+        table['Span']['fixme'] = wrap('fixme') if rawFormat else (CONTENT,)
+        table['Span']['highlight'] = wrap('highlight') if rawFormat \
+            else (CONTENT,)
+    else:
+        table['Span']['comment'] = (DROP,)
+        table['Span']['margin'] = (DROP,)
+        table['Span']['fixme'] = (CONTENT,)
+        table['Span']['highlight'] = (CONTENT,)
+    # Always show small caps---don't worry about draft status!
+    # FIXME: Other formats should run `content` through a filter that
+    # capitalizes all strings.
+    table['Span']['smcaps'] = wrap('smcaps') if rawFormat else (CONTENT,)
+    # Alternate way of marking index entries, labels, and references that's
+    # required by pandoc2.
+    if docFormat == 'latex':  # (Index is senseless in beamer.)
+        table['Span']['i'] = (TEMPLATE, 'latex', u'\\index{{{}}}')
+    else:
+        table['Span']['i'] = (DROP,)
+    for name, latexTemplate, htmlTemplate in REFERENCES:
+        if isLatex:
+            table['Span'][name] = (TEMPLATE, 'latex', latexTemplate)
+        elif isHtml and htmlTemplate:
+            table['Span'][name] = (TEMPLATE, 'html', htmlTemplate)
+        elif docFormat in REFERENCE_FORMATS:
+            table['Span'][name] = (REFERENCE, rawFormat, name)
+        else:
+            table['Span'][name] = (DROP,)
+
+    # Tag-style inlines. Opening tags (and closing tags in docx) have a second
+    # version for use inside highlighting, which cannot change colors in LaTeX.
+    for name in ['comment', 'fixme', 'margin', 'highlight']:
+        for tag in ['<{}>'.format(name), '</{}>'.format(name)]:
+            if docFormat in ['latex', 'beamer', 'docx']:
+                inHighlight = text['</highlight>'] + text[tag] + \
+                    text['<highlight>']
+                table['RawInline'][tag] = (INLINE_TAG, raw(text[tag]),
+                                           raw(inHighlight))
+            elif isHtml or docFormat == 'revealjs':
+                table['RawInline'][tag] = (INLINE_TAG, raw(text[tag]))
+            else:
+                table['RawInline'][tag] = (INLINE_TAG, [])
+    for tag in ['<smcaps>', '</smcaps>']:
+        table['RawInline'][tag] = (SMCAPS_TAG, raw(text[tag]) if rawFormat
+                                   else [])
+    if docFormat == 'latex':
+        table['RawInline']['<i '] = (TEMPLATE, 'latex', '\\index{{{}}}')
+    else:
+        table['RawInline']['<i '] = (DROP,)
+    for name, latexTemplate, htmlTemplate in REFERENCES:
+        if isLatex:
+            table['RawInline']['<{} '.format(name)] = (TEMPLATE, 'latex',
+                                                       latexTemplate)
+        elif isHtml and htmlTemplate:
+            table['RawInline']['<{} '.format(name)] = (TEMPLATE, 'html',
+                                                       htmlTemplate)
+        elif docFormat in REFERENCE_FORMATS:
+            table['RawInline']['<{} '.format(name)] = (REFERENCE, rawFormat,
+                                                       name)
+        else:
+            table['RawInline']['<{} '.format(name)] = (IGNORE,)
+
+    # Block elements
+    for tag in ['<!comment>', '<!box>', '<center>', '<!speaker>',
+                '</!comment>', '</!box>', '</center>', '</!speaker>']:
+        if isLatex:
+            table['Block'][tag] = (BLOCK_TAG, Para([latex(text[tag])]))
+        elif isHtml or docFormat == 'revealjs':
+            table['Block'][tag] = (BLOCK_TAG, Plain([html(text[tag])]))
+        else:
+            table['Block'][tag] = (BLOCK_TAG, None)
+
+    # Non-indented paragraphs
+    if isLatex:
+        table['Para']['< '] = ([latex('\\noindent{}')], [])
+    elif isHtml:
+        table['Para']['< '] = ([html('<div class="noindent">')],
+                               [html('</div>')])
+    else:
+        table['Para']['< '] = ([], [])
+
+    return table
+
+
+class Walked(list):
+    # A list of replacement elements that have already been walked, which
+    # `walk_inplace` should not walk again.
+    pass
+
+
+def walk_inplace(x, action, format, meta, skip=None):
+    # Like `pandocfilters.walk`, but changes `x` in place rather than building
+    # a copy of it. A list is only rebuilt when `action` replaces one of its
+    # elements. As with `walk`, the contents of replacement elements are
+    # walked (unless they are `Walked`), but the replacements themselves are
+    # not passed to `action`. Elements for which `skip` (if given) returns
+    # True are neither passed to `action` nor walked. Returns `x`.
+    if isinstance(x, list):
+        newList = None
+        for i, item in enumerate(x):
+            if isinstance(item, dict) and 't' in item:
+                if skip is not None and skip(item):
+                    res = None
+                else:
+                    res = action(item['t'], item.get('c'), format, meta)
+                    if res is None and item['t'] not in LEAF_ELEMENTS and \
+                            'c' in item:
+                        walk_inplace(item['c'], action, format, meta, skip)
+                if res is None:
+                    if newList is not None:
+                        newList.append(item)
+                    continue
+                if not isinstance(res, list):
+                    res = [res]
+                if not isinstance(res, Walked):
+                    for z in res:
+                        walk_inplace(z, action, format, meta, skip)
+                if newList is None:
+                    newList = x[:i]
+                newList.extend(res)
+            else:
+                if isinstance(item, (list, dict)):
+                    walk_inplace(item, action, format, meta, skip)
+                if newList is not None:
+                    newList.append(item)
+        if newList is not None:
+            x[:] = newList
+    elif isinstance(x, dict):
+        if 't' in x:  # (Leaves have no contents to walk.)
+            if x['t'] not in LEAF_ELEMENTS and 'c' in x:
+                walk_inplace(x['c'], action, format, meta, skip)
+        else:
+            for value in x.values():
+                if isinstance(value, (list, dict)):
+                    walk_inplace(value, action, format, meta, skip)
+    return x
+
+
+def inert(item):
+    # Whether `handle_comments` would leave an element and everything in it
+    # alone, when it is neither suppressing output nor expanding macros:
+    # text, and paragraphs, headers and inline markup with only text in
+    # them. (Paragraphs that may be tags, `< ` paragraphs and transclusions
+    # are not inert.) This only looks as far as the first element that might
+    # not be, so it is much cheaper than walking.
+    kind = item['t']
+    if kind in UNLABELLED:
+        return True
+    elif kind not in INERT_CONTAINERS:
+        return False
+    index = INERT_CONTAINERS[kind]
+    items = item['c'] if index is None else item['c'][index]
+    if kind == 'Para' and items and items[0]['t'] == 'Str' and \
+            (len(items) == 1 or items[0]['c'] in ['<', '@']):
+        return False
+    for child in items:
+        if not inert(child):
+            return False
+    return True
+
+
+def element_tag(item):
+    # The tag an element may be: the text of a raw HTML block or inline, or of
+    # a paragraph of a single word (since pandoc may read block tags as
+    # paragraphs). None for anything else.
+    kind = item['t']
+    if kind == 'RawInline' or kind == 'RawBlock':
+        elementFormat, tag = item['c']
+        if elementFormat != 'html':
+            return None
+        return tag.lower() if kind == 'RawBlock' else tag
+    elif kind == 'Para' and len(item['c']) == 1 and \
+            item['c'][0]['t'] == 'Str':
+        return item['c'][0]['c']
+    return None
+
+
+def prune_comments(items, ranges):
+    # Cut each range in `ranges` (see BLOCK_RANGES) out of a list of blocks or
+    # inlines, from the opening tag to the first closing tag after it, in
+    # one slice, so that nothing in it is walked. (For final output only.)
+    # A range that is not closed in the same list (one spanning paragraphs,
+    # e.g.) is left for `handle_comments` to suppress element by element;
+    # `report_unclosed` reports it if it is never closed.
+    start = None
+    cuts = []
+    for i, item in enumerate(items):
+        tag = element_tag(item)
+        if tag is None:
+            continue
+        if start is None:
+            if tag in ranges:
+                start, opening = i, tag
+        elif tag == ranges[opening]:
+            cuts.append((start, i + 1))
+            start = None
+    for start, end in reversed(cuts):
+        count('comment range pruned')
+        del items[start:end]
+
+
+def report_unclosed(state):
+    # Warn about a comment or margin note still open at the end of the
+    # document, which has left out everything after it in final output.
+    if state.draft:
+        return
+    for tag, unclosed in [('<!comment>', state.blockComment),
+                          ('<comment>', state.inlineComment),
+                          ('<margin>', state.inlineMargin)]:
+        if unclosed:
+            debug('WARNING: Unclosed {}: everything after it is left out!'
+                  .format(tag))
+
+
+def merge_raw_inlines(x):
+    # Merge each run of raw inlines of the same format in x (a list of
+    # blocks or inlines), in place, into one, without the markup in
+    # NO_OP_MARKUP (dropping it if nothing is left). The filter's markup comes
+    # in many small pieces---wrapping each span, and changing colors around
+    # each tag---which pandoc would otherwise read and write one at a time.
+    # Merged elements are new, since the old ones may be shared (with the
+    # dispatch tables, e.g.).
+    previous = None
+    adjacent = False
+    for item in x:
+        if isinstance(item, dict):
+            kind = item.get('t')
+            if kind == 'RawInline':
+                if previous is not None and previous[0] == item['c'][0]:
+                    adjacent = True
+                previous = item['c']
+                continue
+            elif kind not in LEAF_ELEMENTS and isinstance(item.get('c'), list):
+                merge_raw_inlines(item['c'])
+        elif isinstance(item, list):
+            merge_raw_inlines(item)
+        previous = None
+    if not adjacent:
+        return
+    newList = []
+    merged = []  # Indexes in newList of merged elements
+    for item in x:
+        if isinstance(item, dict) and item.get('t') == 'RawInline' and \
+                newList and isinstance(newList[-1], dict) and \
+                newList[-1].get('t') == 'RawInline' and \
+                newList[-1]['c'][0] == item['c'][0]:
+            if not merged or merged[-1] != len(newList) - 1:
+                merged.append(len(newList) - 1)
+            newList[-1] = RawInline(item['c'][0],
+                                    newList[-1]['c'][1] + item['c'][1])
+        else:
+            newList.append(item)
+    for i in reversed(merged):
+        rawFormat, text = newList[i]['c']
+        noOp = NO_OP_MARKUP.get(rawFormat)
+        if noOp is not None:
+            shorter = noOp.sub('', text)
+            while shorter != text:
+                text, shorter = shorter, noOp.sub('', shorter)
+            if not text:
+                del newList[i]
+            else:
+                newList[i]['c'][1] = text
+    x[:] = newList
+
+
+class LabelIndex(object):
+    # Labels (and the identifiers of headers and figures), each with the
+    # section and figure it is in, collected before the document is walked so
+    # that references can be resolved wherever they are (see
+    # `reference`). Each entry has the section's `section` number (as
+    # pandoc's `--number-sections` numbers it, `0.1` for a subsection before
+    # the first section included, or '' if sections are not numbered) and
+    # `title`, and the `figure` number (or None); entries imported from
+    # other documents' indexes also have the `url` of the document. In final
+    # output, labels in comments and margin notes are left out.
+
+    def __init__(self, meta, draft):
+        self.draft = draft
+        self.numbered = any(meta_flag(meta, name, NUMBER_SECTIONS_VARIABLE)
+                            for name in ['number-sections', 'numbersections'])
+        self.labels = {}
+        self.imported = {}
+        self.unresolved = set()
+        self.counters = [0] * 6
+        self.section = ''
+        self.title = ''
+        self.figures = 0
+        self.figure = None
+        self.closing = None  # Closing tag of the comment being skipped
+        for fileName in meta_list(meta, 'label-index-import',
+                                  LABEL_INDEX_IMPORT_VARIABLE):
+            self.load(fileName)
+
+    def load(self, fileName):
+        # Import the labels in an index written by `save`.
+        try:
+            with open(fileName, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            debug('ERROR: Could not read label index {}: {}!'.format(
+                fileName, e))
+            return
+        for label, entry in data['labels'].items():
+            self.imported[label] = dict(entry, url=data.get('url', ''))
+
+    def save(self, meta):
+        # Write the index to the file named by `label-index`, if any.
+        fileName = meta_option(meta, 'label-index', LABEL_INDEX_VARIABLE, '')
+        if not fileName:
+            return
+        url = meta_option(meta, 'label-index-url', LABEL_INDEX_URL_VARIABLE,
+                          '')
+        with open(fileName + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'url': url, 'labels': self.labels}, f, indent=1,
+                      sort_keys=True)
+        replace(fileName + '.tmp', fileName)
+
+    def add_blocks(self, blocks):
+        # Index the labels in a list of top-level blocks (which may be the
+        # document's blocks one piece at a time).
+        self.add_list(blocks, True)
+
+    def add_list(self, items, topLevel=False):
+        # Index a list of blocks or inlines, skipping comment ranges (see
+        # BLOCK_RANGES) in final output.
+        closing = self.closing if topLevel else None
+        for item in items:
+            if isinstance(item, dict) and item.get('t') in UNLABELLED:
+                continue
+            tag = element_tag(item) if not self.draft and \
+                isinstance(item, dict) else None
+            if closing is not None:
+                if tag == closing:
+                    closing = None
+            elif tag in BLOCK_RANGES or tag in INLINE_RANGES:
+                closing = BLOCK_RANGES.get(tag) or INLINE_RANGES[tag]
+            else:
+                self.add(item)
+        if topLevel:
+            self.closing = closing
+
+    def add(self, x):
+        # Index the labels in an element (or list of elements).
+        if isinstance(x, list):
+            self.add_list(x)
+            return
+        elif not isinstance(x, dict):
+            return
+        kind = x.get('t')
+        if kind == 'Header':
+            level, (itemID, classes, keyValues), inlines = x['c']
+            if 'unnumbered' in classes or '-' in classes:
+                self.section = ''
+            else:
+                self.counters[level - 1:] = [self.counters[level - 1] + 1] + \
+                    [0] * (len(self.counters) - level)
+                self.section = '.'.join(str(n) for n in
+                                        self.counters[:level]) \
+                    if self.numbered else ''
+            self.title = header_title(inlines)
+            self.add_label(itemID)
+            self.add_list(inlines)
+        elif kind == 'CodeBlock':
+            (itemID, classes, keyValues), code = x['c']
+            if is_figure(classes, code):
+                self.figures += 1
+                self.figure = self.figures
+                self.add_label(itemID)
+                self.figure = None
+        elif kind == 'Para' and len(x['c']) == 1 and \
+                x['c'][0]['t'] == 'Image' and \
+                x['c'][0]['c'][2][1].startswith('fig:'):
+            (itemID, classes, keyValues), caption, target = x['c'][0]['c']
+            self.add_figure(itemID, caption)
+        elif kind == 'Figure':
+            (itemID, classes, keyValues), caption, blocks = x['c']
+            self.add_figure(itemID, [caption, blocks])
+        elif kind == 'Span':
+            (itemID, classes, keyValues), content = x['c']
+            cls = min(classes, key=lambda c: SPAN_CLASSES.get(c, 99)) \
+                if classes else None
+            if cls == 'l':
+                from pandocfilters import stringify
+                self.add_label(stringify(content))
+            elif self.draft or cls not in ['comment', 'margin']:
+                self.add_list(content)
+        elif kind == 'RawInline':
+            elementFormat, tag = x['c']
+            if elementFormat == 'html' and tag.startswith('<l ') and \
+                    tag.endswith('>'):
+                self.add_label(tag[3:-1])
+        elif kind not in LEAF_ELEMENTS:
+            self.add(x.get('c'))
+
+    def add_figure(self, itemID, caption):
+        # Index a figure, with the labels in its caption.
+        self.figures += 1
+        self.figure = self.figures
+        self.add_label(itemID)
+        self.add(caption)
+        self.figure = None
+
+    def add_label(self, label):
+        # Record that `label` is here.
+        if not label:
+            return
+        if label in self.labels:
+            debug('WARNING: Duplicate label {}!'.format(label))
+            return
+        self.labels[label] = {'section': self.section, 'title': self.title,
+                              'figure': self.figure}
+
+    def lookup(self, label):
+        # The entry for `label`, or None (reported once) if there is none.
+        entry = self.labels.get(label) or self.imported.get(label)
+        if entry is None and label not in self.unresolved:
+            self.unresolved.add(label)
+            debug('WARNING: Undefined label {}!'.format(label))
+        return entry
+
+    def referenced(self, x):
+        # The labels referred to in x, with their entries (for `BlockCache`
+        # keys).
+        if isinstance(x, list):
+            return [ref for item in x for ref in self.referenced(item)]
+        elif not isinstance(x, dict) or x.get('t') in LEAF_ELEMENTS and \
+                x.get('t') != 'RawInline':
+            return []
+        kind = x.get('t')
+        if kind == 'Span' and set(x['c'][0][1]) & set(['r', 'rp']):
+            from pandocfilters import stringify
+            label = stringify(x['c'][1])
+            return [[label, self.lookup(label)]]
+        elif kind == 'RawInline':
+            tag = x['c'][1]
+            if tag.startswith(('<r ', '<rp ')) and tag.endswith('>'):
+                label = tag[tag.index(' ') + 1:-1]
+                return [[label, self.lookup(label)]]
+            return []
+        return self.referenced(x.get('c'))
+
+
+def header_title(inlines):
+    # The text of a header, without its labels and index entries.
+    from pandocfilters import stringify
+    return stringify([x for x in inlines if not (
+        x['t'] == 'Span' and set(x['c'][0][1]) & set(['l', 'i']))]).strip()
+
+
+def reference_text(entry):
+    # What a resolved reference reads.
+    if entry['figure']:
+        return 'figure {}'.format(entry['figure'])
+    elif entry['section']:
+        return 'section {}'.format(entry['section'])
+    return entry['title'] or 'here'
+
+
+def reference(state, entry, label):
+    # The element for a label or reference, given its dispatch table entry,
+    # in a format in which references are resolved with the label index.
+    rawFormat, name = entry[1:]
+    if name == 'l':  # An anchor for links to it
+        return Span([label, [], []], [])
+    target = state.labelIndex.lookup(label) if state.labelIndex else None
+    if target is None:
+        text, href = '??', '#' + label
+    else:
+        text, href = reference_text(target), \
+            target.get('url', '') + '#' + label
+    count('reference resolved' if target else 'reference unresolved')
+    if rawFormat == 'html':
+        from html import escape
+        return RawInline('html', '<a href="{}">{}</a>'.format(escape(href),
+                                                              escape(text)))
+    return Link(['', [], []], [Str(text)], [href, ''])
+
+
+def macro_inlines(value):
+    # The inlines of a macro's definition (a metadata value), or None if it
+    # has none.
+    kind = value['t']
+    if kind == 'MetaInlines':
+        return value['c']
+    elif kind == 'MetaString':
+        return [Str(value['c'])]
+    elif kind == 'MetaBlocks':
+        inlines = []
+        for block in value['c']:
+            if block['t'] in ['Para', 'Plain']:
+                if inlines:
+                    inlines.append({'t': 'Space'})
+                inlines += block['c']
+        return inlines
+    return None
+
+
+def macro_table(meta):
+    # The macros defined in `macros` in the metadata, as (definitions, regular
+    # expression), or None if there are none. The definitions are the JSON of
+    # each macro's inlines, keyed by name, so that each use needs only a
+    # lookup and `json.loads` (faster than `deepcopy`). The regular expression
+    # matches `$NAME$` for any of the names at once, for finding macros in
+    # Str elements. Both are made once for each set of macros.
+    if 'macros' not in meta:
+        return None
+    key = json.dumps(meta['macros'], sort_keys=True)
+    try:
+        return MACRO_TABLES[key]
+    except KeyError:
+        pass
+    maps = meta['macros']
+    maps = maps['c'] if maps['t'] == 'MetaList' else [maps]
+    definitions = {}
+    for macros in maps:
+        if macros['t'] != 'MetaMap':
+            continue
+        for name, value in macros['c'].items():
+            inlines = macro_inlines(value)
+            if inlines is None:
+                debug('WARNING: Macro {} has no inline text!'.format(name))
+            else:
+                definitions[name] = json.dumps(inlines)
+    if definitions:
+        from re import escape
+        # (Longer names first, so that `$ab$` is not taken for `$a$`.)
+        names = sorted(definitions, key=len, reverse=True)
+        table = (definitions, re_compile(r'\$({})\$'.format(
+            '|'.join(escape(name) for name in names))))
+    else:
+        table = None
+    MACRO_TABLES[key] = table
+    return table
+
+
+def expand_macros(state, names, docFormat, meta):
+    # The inlines of the macros in `names` (with strings in between), walked,
+    # so that the markup and macros in them are handled. A macro used in its
+    # own definition is reported and left alone.
+    definitions = state.macros[0]
+    inlines = []
+    for n, name in enumerate(names):
+        if n % 2 == 0:  # Text between macros
+            if name:
+                inlines.append(Str(name))
+        elif name in state.expanding:
+            debug('WARNING: Macro {} is used in its own definition!'
+                  .format(name))
+            inlines.append(Math({'t': 'InlineMath'}, name))
+        else:
+            count('macro expanded')
+            state.expanding.add(name)
+            inlines += walk_inplace(json.loads(definitions[name]),
+                                    state.action, docFormat, meta)
+            state.expanding.discard(name)
+    return Walked(inlines)
+
+
+def handle_comments(state, key, value, docFormat, meta):
+    # The action for `walk_inplace`, once the document's FilterState has been
+    # filled in with `partial(handle_comments, state)`.
 
     # If translating to markdown, leave everything alone.
     if docFormat == 'markdown':
@@ -289,490 +2102,913 @@ def handle_comments(key, value, docFormat, meta):
         else:
             tag = value[0]['c']
 
-        if not DRAFT:
-            if BLOCK_COMMENT:  # Need to suppress output
+        if not state.draft:
+            if state.blockComment:  # Need to suppress output
                 if tag == '</!comment>':
-                    BLOCK_COMMENT = False
+                    state.blockComment = False
                 return []
 
         # Not currently suppressing output ...
 
-        if tag in ['<!comment>', '<!box>', '<center>', '<!speaker>']:
+        entry = dispatch_table(docFormat, state.draft,
+                               state.cssClasses)['Block'].get(tag)
+        if entry:
             if tag == '<!comment>':
-                BLOCK_COMMENT = True
-                if not DRAFT:
+                state.blockComment = True
+                if not state.draft:
                     return []
-                INLINE_FONT_COLOR_STACK.append(COLORS[tag])
+                state.inlineFontColorStack.append(COLORS[tag])
             elif tag == '<!box>':
-                USED_BOX = True
-            if docFormat in ['latex', 'beamer']:
-                return Para([latex(LATEX_TEXT[tag])])
-            elif docFormat in ['html', 'html5']:
-                return Plain([html(HTML_TEXT[tag])])
-            elif docFormat == 'revealjs':
-                return Plain([html(REVEALJS_TEXT[tag])])
-            else:
-                return
-        elif tag in ['</!comment>', '</!box>', '</center>', '</!speaker>']:
-            if INLINE_TAG_STACK:
-                debug('Need to close all inline elements before closing '
-                      + 'block elements!\n\n{}\n\nbefore\n\n{}\n\n'
-                      .format(str(INLINE_TAG_STACK), tag))
-                exit(1)
-            if tag == '</!comment>':
-                BLOCK_COMMENT = False
-                if not DRAFT:
-                    return []
-                INLINE_FONT_COLOR_STACK.pop()
-            if docFormat in ['latex', 'beamer']:
-                return Para([latex(LATEX_TEXT[tag])])
-            elif docFormat in ['html', 'html5']:
-                return Plain([html(HTML_TEXT[tag])])
-            elif docFormat == 'revealjs':
-                return Plain([html(REVEALJS_TEXT[tag])])
-            else:
-                return
-        # else:
-        #     return  # TODO Is this the right thing to do?
-
-    if not DRAFT and BLOCK_COMMENT:
+                state.usedBox = True
+            elif tag[1] == '/':
+                if state.inlineTagStack:
+                    debug('Need to close all inline elements before closing '
+                          + 'block elements!\n\n{}\n\nbefore\n\n{}\n\n'
+                          .format(str(state.inlineTagStack), tag))
+                    sys.exit(1)
+                if tag == '</!comment>':
+                    state.blockComment = False
+                    if not state.draft:
+                        return []
+                    state.inlineFontColorStack.pop()
+            # (A copy, since `walk_inplace` may change its contents.)
+            return deepcopy(entry[1])
+
+    if not state.draft and state.blockComment:
         return []  # Need to suppress output
 
     elif key == 'Span':
         [itemID, classes, keyValues], content = value
-        if "comment" in classes:
-            if DRAFT:
-                if docFormat in ['latex', 'beamer']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [latex(LATEX_TEXT["<comment>"])] + newContent +\
-                           [latex(LATEX_TEXT["</comment>"])]
-                elif docFormat in ['html', 'html5']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(HTML_TEXT["<comment>"])] + newContent +\
-                           [html(HTML_TEXT["</comment>"])]
-                elif docFormat == 'revealjs':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(REVEALJS_TEXT["<comment>"])] + newContent +\
-                           [html(REVEALJS_TEXT["</comment>"])]
-                elif docFormat == 'docx':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [docx(DOCX_TEXT["<comment>"])] + newContent +\
-                           [docx(DOCX_TEXT["</comment>"])]
-                else:
-                    return content
-            else:
-                return []
-        elif "margin" in classes:
-            if DRAFT:
-                if docFormat in ['latex', 'beamer']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [latex(LATEX_TEXT["<margin>"])] + newContent +\
-                           [latex(LATEX_TEXT["</margin>"])]
-                elif docFormat in ['html', 'html5']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(HTML_TEXT["<margin>"])] + newContent +\
-                           [html(HTML_TEXT["</margin>"])]
-                elif docFormat == 'revealjs':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(REVEALJS_TEXT["<margin>"])] + newContent +\
-                           [html(REVEALJS_TEXT["</margin>"])]
-                else:
-                    # return content
-                    return []
-            else:
-                return []
-        elif "fixme" in classes:
-            if DRAFT:
-                if docFormat in ['latex', 'beamer']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [latex(LATEX_TEXT["<fixme>"])] + newContent +\
-                           [latex(LATEX_TEXT["</fixme>"])]
-                elif docFormat in ['html', 'html5']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(HTML_TEXT["<fixme>"])] + newContent +\
-                           [html(HTML_TEXT["</fixme>"])]
-                elif docFormat == 'revealjs':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(REVEALJS_TEXT["<fixme>"])] + newContent +\
-                           [html(REVEALJS_TEXT["</fixme>"])]
-                elif docFormat == 'docx':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [docx(DOCX_TEXT["<fixme>"])] + newContent +\
-                           [docx(DOCX_TEXT["</fixme>"])]
-                else:
-                    return content
-            else:
-                return content
-        elif "highlight" in classes:
-            if DRAFT:
-                if docFormat in ['latex', 'beamer']:
-                    # Note: Because of limitations of highlighting in LaTeX,
-                    # can't nest any comments inside here: will get LaTeX
-                    # error.
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [latex(LATEX_TEXT["<highlight>"])] + newContent +\
-                           [latex(LATEX_TEXT["</highlight>"])]
-                elif docFormat in ['html', 'html5']:
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(HTML_TEXT["<highlight>"])] + newContent +\
-                           [html(HTML_TEXT["</highlight>"])]
-                elif docFormat == 'revealjs':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [html(REVEALJS_TEXT["<highlight>"])] + newContent +\
-                           [html(REVEALJS_TEXT["</highlight>"])]
-                elif docFormat == 'docx':
-                    newContent = walk(content, handle_comments, docFormat,
-                                      meta)
-                    return [docx(DOCX_TEXT["<highlight>"])] + newContent +\
-                           [docx(DOCX_TEXT["</highlight>"])]
-                else:
-                    return content
-            else:
-                return content
-        elif "smcaps" in classes:
-            # Always show this---don't worry about draft status!
-            if docFormat in ['latex', 'beamer']:
-                newContent = walk(content, handle_comments, docFormat, meta)
-                return [latex(LATEX_TEXT["<smcaps>"])] + newContent +\
-                       [latex(LATEX_TEXT["</smcaps>"])]
-            elif docFormat in ['html', 'html5']:
-                newContent = walk(content, handle_comments, docFormat, meta)
-                return [html(HTML_TEXT["<smcaps>"])] + newContent +\
-                       [html(HTML_TEXT["</smcaps>"])]
-            elif docFormat == 'revealjs':
-                newContent = walk(content, handle_comments, docFormat, meta)
-                return [html(REVEALJS_TEXT["<smcaps>"])] + newContent +\
-                       [html(REVEALJS_TEXT["</smcaps>"])]
-            elif docFormat == 'docx':
-                return docx(DOCX_TEXT[tag])
-            else:
-                # FIXME: I should run this through a filter that capitalizes
-                # all strings in `content`.
-                return content
-
-        # Alternate way of marking index entries that's required by pandoc2.
-        elif "i" in classes:  # Index
-            if docFormat == 'latex':  # (This is senseless in beamer.)
-                return latex(u'\\index{{{}}}'.format(stringify(content)))
-            else:
-                return []
-
-        elif "l" in classes:  # Label
-            if docFormat in ['latex', 'beamer']:
-                return latex(u'\\label{{{}}}'.format(stringify(content)))
-                # return latex('\\label{{{}}}'.format(tag[3:-1]))
-            elif docFormat in ['html', 'html5']:
-                return html(u'<a name="{}"></a>'.format(stringify(content)))
-                # return html('<a name="{}"></a>'.format(tag[3:-1]))
-            else:
-                return []
-
-        elif "r" in classes:  # Reference
-            if docFormat in ['latex', 'beamer']:
-                return latex(u'\\cref{{{}}}'.format(stringify(content)))
-                # return latex('\\cref{{{}}}'.format(tag[3:-1]))
-            elif docFormat in ['html', 'html5']:
-                return html(u'<a href="#{}">here</a>'
-                            .format(stringify(content)))
-                # return html('<a href="#{}">here</a>'.format(tag[3:-1]))
-            else:
-                return []
-
-        elif "rp" in classes:  # Page reference
-            if docFormat in ['latex', 'beamer']:
-                return latex(u'\\cpageref{{{}}}'.format(stringify(content)))
-                # return latex('\\cpageref{{{}}}'.format(tag[4:-1]))
-            elif docFormat in ['html', 'html5']:
-                return html(u'<a href="#{}">here</a>'
-                            .format(stringify(content)))
-                # return html('<a href="#{}">here</a>'.format(tag[4:-1]))
-            else:
-                return []
-
-    # Then check to see if we're changing INLINE_TAG_STACK...
+        table = DISPATCH_TABLES.get((docFormat, state.draft,
+                                     state.cssClasses)) or \
+            dispatch_table(docFormat, state.draft, state.cssClasses)
+        if len(classes) == 1:
+            cls = classes[0]
+        elif classes:
+            # Use the first class in SPAN_CLASSES that the span has.
+            cls = min(classes, key=lambda c: SPAN_CLASSES.get(c, 99))
+        else:
+            return
+        entry = table['Span'].get(cls)
+        if entry is None:
+            return
+        action = entry[0]
+        if action == DROP:
+            return []
+        elif action == CONTENT:
+            return content
+        elif action == WRAP:
+            return Walked([entry[1]] + walk_inplace(
+                content, state.action, docFormat, meta, state.skip) +
+                [entry[2]])
+        from pandocfilters import stringify
+        if action == REFERENCE:
+            return reference(state, entry, stringify(content))
+        else:  # TEMPLATE
+            return RawInline(entry[1], entry[2].format(stringify(content)))
+
+    # Then check to see if we're changing the inline tag stack...
     elif key == 'RawInline':
         elementFormat, tag = value
         if elementFormat != 'html':
             return
+        return handle_tag(tag, dispatch_table(docFormat, state.draft,
+                                              state.cssClasses),
+                          docFormat, state)
+
+    elif not state.draft and (state.inlineComment or state.inlineMargin):
+        # Suppress all output, up to the closing tag, which may be in a later
+        # paragraph
+        if key == 'Para' or key == 'Plain':
+            inlines = walk_inplace(value, state.action, docFormat, meta,
+                                   state.skip)
+            return Walked([{'t': key, 'c': inlines}]) if inlines else []
+        return []
 
-        # Check to see if need to suppress output. We do this only for
-        # `<comment>` and `<margin>` tags; with `<fixme>` and `<highlight>`
-        # tags, we merely suppress the tag.
-        if not DRAFT:
-            if tag == '<comment>':
-                INLINE_COMMENT = True
-                return []
-            elif tag == '<margin>':
-                INLINE_MARGIN = True
-                return []
-            elif INLINE_COMMENT:  # Need to suppress output
-                if tag == '</comment>':
-                    INLINE_COMMENT = False
-                return []
-            elif INLINE_MARGIN:  # Need to suppress output
-                if tag == '</margin>':
-                    INLINE_MARGIN = False
-                return []
-            elif tag in ['<fixme>', '<highlight>', '</fixme>',
-                         '</highlight>']:
-                return []  # Suppress the tag (but not the subsequent text)
+    # Macros
+    elif key == 'Math' and state.macros and \
+            value[0]['t'] == 'InlineMath' and \
+            value[1].strip() in state.macros[0]:
+        return expand_macros(state, ['', value[1].strip()], docFormat, meta)
+    elif key == 'Str' and state.macros and '$' in value:
+        names = state.macros[1].split(value)
+        if len(names) > 1:
+            return expand_macros(state, names, docFormat, meta)
 
-        # Not currently suppressing output....
+    # Check some cases at beginnings of paragraphs
+    elif key == 'Para':
+        if not state.draft:
+            prune_comments(value, INLINE_RANGES)
+        fileName = transclusion_file(value)
+        if fileName is not None:
+            return transcluded_blocks(fileName, meta)
+        # If translating to LaTeX, beginning a paragraph with '< '
+        # will cause '\noindent{}' to be output first.
+        elif len(value) > 1 and value[0]['t'] == 'Str' and \
+                value[0]['c'] == '<' and value[1]['t'] == 'Space':
+            before, after = dispatch_table(docFormat, state.draft,
+                                           state.cssClasses)['Para']['< ']
+            return Para(before + value[2:] + after)
+        else:
+            return  # Normal paragraph, not affected by this filter
 
-        if tag in ['<comment>', '<fixme>', '<margin>', '<highlight>',
-                   '</comment>', '</fixme>', '</margin>', '</highlight>']:
-            # LaTeX gets treated differently than HTML
-            if docFormat in ['latex', 'beamer', 'docx']:
-                preText = ''
-                postText = ''
-                # Cannot change COLORS within highlighting in LaTeX (but
-                # don't do anything when closing the highlight tag!)
-                if INLINE_HIGHLIGHT and tag != '</highlight>':
-                    if docFormat in ['latex', 'beamer']:
+    # Check for tikz CodeBlock. If it exists, try typesetting figure
+    elif key == 'CodeBlock':
+        return handle_figure(value, docFormat, meta, state)
+
+    elif not state.draft and key in PRUNED_LISTS:
+        index, ranges = PRUNED_LISTS[key]
+        prune_comments(value if index is None else value[index], ranges)
+        return
+
+    else:  # Not text this filter modifies....
+        return
+
+
+def handle_tag(tag, table, docFormat, state):
+    # Handle a tag-style inline (a raw HTML inline).
+
+    # Check to see if need to suppress output. We do this only for
+    # `<comment>` and `<margin>` tags; with `<fixme>` and `<highlight>`
+    # tags, we merely suppress the tag.
+    if not state.draft:
+        if tag == '<comment>':
+            state.inlineComment = True
+            return []
+        elif tag == '<margin>':
+            state.inlineMargin = True
+            return []
+        elif state.inlineComment:  # Need to suppress output
+            if tag == '</comment>':
+                state.inlineComment = False
+            return []
+        elif state.inlineMargin:  # Need to suppress output
+            if tag == '</margin>':
+                state.inlineMargin = False
+            return []
+        elif tag in ['<fixme>', '<highlight>', '</fixme>', '</highlight>']:
+            return []  # Suppress the tag (but not the subsequent text)
+
+    # Not currently suppressing output....
+
+    table = table['RawInline']
+    entry = table.get(tag)
+    if entry is None and tag.endswith('>') and ' ' in tag:
+        # Tags with arguments: `<i ...>`, `<l ...>`, `<r ...>`, `<rp ...>`
+        entry = table.get(tag[:tag.index(' ') + 1])
+    if entry is None:
+        return
+    action = entry[0]
+
+    if action == INLINE_TAG:
+        opening = tag[1] != '/'
+        # LaTeX gets treated differently than HTML
+        if docFormat in ['latex', 'beamer', 'docx']:
+            # Cannot change COLORS within highlighting in LaTeX (but don't do
+            # anything when closing the highlight tag!)
+            inHighlight = state.inlineHighlight and tag != '</highlight>'
+            if opening:
+                if tag == '<comment>':
+                    state.inlineComment = True
+                    state.inlineFontColorStack.append(COLORS[tag])
+                elif tag == '<fixme>':
+                    state.inlineFontColorStack.append(COLORS[tag])
+                elif tag == '<margin>':
+                    state.inlineMargin = True
+                    state.inlineFontColorStack.append(COLORS[tag])
+                elif tag == '<highlight>':
+                    state.inlineHighlight = True
+                    state.inlineFontColorStack.append(
+                        state.inlineFontColorStack[-1])
+                state.inlineTagStack.append(tag)
+                return entry[2] if inHighlight else entry[1]
+            else:
+                if tag == '</comment>':
+                    state.inlineComment = False
+                elif tag == '</margin>':
+                    state.inlineMargin = False
+                elif tag == '</highlight>':
+                    state.inlineHighlight = False
+                state.inlineFontColorStack.pop()
+                previousColor = state.inlineFontColorStack[-1]
+                currentInlineStatus = state.inlineTagStack.pop()
+                if currentInlineStatus[1:] == tag[2:]:
+                    # matching opening tag
+                    if docFormat == 'docx':
+                        return entry[2] if inHighlight else entry[1]
+                    preText = postText = ''
+                    if inHighlight:
                         preText = LATEX_TEXT['</highlight>']
                         postText = LATEX_TEXT['<highlight>']
-                    elif docFormat == 'docx':
-                        preText = DOCX_TEXT['</highlight>']
-                        postText = DOCX_TEXT['<highlight>']
-                if tag in ['<comment>', '<fixme>', '<margin>',
-                           '<highlight>']:  # If any opening tag
-                    if tag == '<comment>':
-                        INLINE_COMMENT = True
-                        INLINE_FONT_COLOR_STACK.append(COLORS[tag])
-                    elif tag == '<fixme>':
-                        INLINE_FONT_COLOR_STACK.append(COLORS[tag])
-                    elif tag == '<margin>':
-                        INLINE_MARGIN = True
-                        INLINE_FONT_COLOR_STACK.append(COLORS[tag])
-                    elif tag == '<highlight>':
-                        INLINE_HIGHLIGHT = True
-                        INLINE_FONT_COLOR_STACK.append(
-                            INLINE_FONT_COLOR_STACK[-1])
-                    INLINE_TAG_STACK.append(tag)
-                    if docFormat in ['latex', 'beamer']:
-                        return latex(preText + LATEX_TEXT[tag] + postText)
-                    elif docFormat == 'docx':
-                        return docx(preText + DOCX_TEXT[tag] + postText)
-                elif tag in ['</comment>', '</fixme>', '</margin>',
-                             '</highlight>']:
-                    if tag == '</comment>':
-                        INLINE_COMMENT = False
-                    elif tag == '</fixme>':
-                        pass
-                    elif tag == '</margin>':
-                        INLINE_MARGIN = False
-                    elif tag == '</highlight>':
-                        INLINE_HIGHLIGHT = False
-                    INLINE_FONT_COLOR_STACK.pop()
-                    previousColor = INLINE_FONT_COLOR_STACK[-1]
-                    currentInlineStatus = INLINE_TAG_STACK.pop()
-                    if currentInlineStatus[1:] == tag[2:]:
-                        # matching opening tag
-                        if docFormat in ['latex', 'beamer']:
-                            return latex('{}{}\\color{{{}}}{{}}{}'.format(
-                                    preText, LATEX_TEXT[tag], previousColor,
-                                    postText))
-                        elif docFormat == 'docx':
-                            return docx(preText + DOCX_TEXT[tag] + postText)
-                    else:
-                        debug('Closing tag ({}) does not match opening tag '
-                              + '({}).\n\n'.format(tag, currentInlineStatus))
-                        exit(1)
-            else:  # Some docFormat other than LaTeX/beamer
-                if tag in ['<comment>', '<fixme>', '<margin>',
-                           '<highlight>']:
-                    if tag == '<highlight>':
-                        INLINE_HIGHLIGHT = True
-                    INLINE_TAG_STACK.append(tag)
-                else:
-                    if tag == '</highlight>':
-                        INLINE_HIGHLIGHT = False
-                    INLINE_TAG_STACK.pop()
-                if docFormat in ['html', 'html5']:
-                    return html(HTML_TEXT[tag])
-                elif docFormat == 'revealjs':
-                    return html(REVEALJS_TEXT[tag])
+                    return latex('{}{}\\color{{{}}}{{}}{}'.format(
+                        preText, LATEX_TEXT[tag], previousColor, postText))
                 else:
-                    return []
-
-        elif tag in ['<smcaps>', '</smcaps>']:
-            if tag == '<smcaps>':
-                INLINE_TAG_STACK.append(tag)
-            else:
-                INLINE_TAG_STACK.pop()
-            if docFormat in ['latex', 'beamer']:
-                return latex(LATEX_TEXT[tag])
-            elif docFormat in ['html', 'html5']:
-                return html(HTML_TEXT[tag])
-            elif docFormat == 'revealjs':
-                return html(REVEALJS_TEXT[tag])
-            elif docFormat == 'docx':
-                return docx(DOCX_TEXT[tag])
+                    debug('Closing tag ({}) does not match opening tag '
+                          '({}).\n\n'.format(tag, currentInlineStatus))
+                    sys.exit(1)
+        else:  # Some docFormat other than LaTeX/beamer
+            if opening:
+                if tag == '<highlight>':
+                    state.inlineHighlight = True
+                state.inlineTagStack.append(tag)
             else:
-                return []
+                if tag == '</highlight>':
+                    state.inlineHighlight = False
+                state.inlineTagStack.pop()
+            return entry[1]
+
+    elif action == SMCAPS_TAG:
+        if tag == '<smcaps>':
+            state.inlineTagStack.append(tag)
+        else:
+            state.inlineTagStack.pop()
+        return entry[1]
 
-        elif tag.startswith('<i ') and tag.endswith('>'):  # Index
-            if docFormat == 'latex':  # (This is senseless in beamer.)
-                return latex('\\index{{{}}}'.format(tag[3:-1]))
-            else:
-                return []
+    elif action == TEMPLATE:
+        return RawInline(entry[1], entry[2].format(tag[tag.index(' ') + 1:-1]))
 
-        elif tag.startswith('<l ') and tag.endswith('>'):
-            # My definition of a label
-            if docFormat in ['latex', 'beamer']:
-                return latex('\\label{{{}}}'.format(tag[3:-1]))
-            elif docFormat in ['html', 'html5']:
-                return html('<a name="{}"></a>'.format(tag[3:-1]))
-
-        elif tag.startswith('<r ') and tag.endswith('>'):
-            # My definition of a reference
-            if docFormat in ['latex', 'beamer']:
-                return latex('\\cref{{{}}}'.format(tag[3:-1]))
-            elif docFormat in ['html', 'html5']:
-                return html('<a href="#{}">here</a>'.format(tag[3:-1]))
-
-        elif tag.startswith('<rp ') and tag.endswith('>'):
-            # My definition of a page reference
-            if docFormat in ['latex', 'beamer']:
-                return latex('\\cpageref{{{}}}'.format(tag[4:-1]))
-            elif docFormat in ['html', 'html5']:
-                return html('<a href="#{}">here</a>'.format(tag[4:-1]))
-
-    elif not DRAFT and (INLINE_COMMENT or INLINE_MARGIN):
-        # Suppress all output
+    elif action == REFERENCE:
+        return reference(state, entry, tag[tag.index(' ') + 1:-1])
+
+    elif action == DROP:
         return []
 
-    # Check some cases at beginnings of paragraphs
-    elif key == 'Para':
-        try:
-            # If translating to LaTeX, beginning a paragraph with '< '
-            # will cause '\noindent{}' to be output first.
-            if value[0]['t'] == 'Str' and value[0]['c'] == '<' \
-                    and value[1]['t'] == 'Space':
-                if docFormat in ['latex', 'beamer']:
-                    return Para([latex('\\noindent{}')] + value[2:])
-                elif docFormat in ['html', 'html5']:
-                    return Para([html('<div class="noindent">')] +
-                                value[2:] + [html('</div>')])
-                else:
-                    return Para(value[2:])
 
-            else:
-                return  # Normal paragraph, not affected by this filter
+def handle_figure(value, docFormat, meta, state):
+    # Replace a TikZ CodeBlock with the typeset figure.
+    (id, classes, attributes), code = value
+    if is_figure(classes, code):
+        if 'fontfamily' in meta:
+            font = meta['fontfamily']['c'][0]['c']
+        else:
+            font = DEFAULT_FONT
+        filetype = '.pdf' if docFormat in ['latex', 'beamer'] else '.png'
+        caption = ''
+        library = ''
+        for a, b in attributes:
+            if a == 'caption':
+                caption = b
+            elif a == 'tikzlibrary':
+                library = b
+        outfile = figure_file(code, font, library, filetype)
+        sourceFile = outfile + filetype
+        use_figure(state, sourceFile, font, library, filetype)
+        if path.isfile(sourceFile):
+            count('figure cache hit')
+        else:
+            count('figure cache miss')
+            queue_figure(state, figure_preamble(font, library), code,
+                         filetype, outfile)
+        if caption:
+            formattedCaption = caption_inlines(caption)
+        else:
+            formattedCaption = [Str('')]
+        return Para([Image((id, classes, attributes), formattedCaption,
+                    [sourceFile, caption])])
+    else:  # CodeBlock, but not tikZ
+        return
 
-        except:
-            return  # May happen if the paragraph is empty.
 
-    # Check for tikz CodeBlock. If it exists, try typesetting figure
-    elif key == 'CodeBlock':
-        (id, classes, attributes), code = value
-        if 'tikz' in classes or '\\begin{tikzpicture}' in code:
-            if 'fontfamily' in meta:
-                font = meta['fontfamily']['c'][0]['c']
-            else:
-                font = DEFAULT_FONT
-            outfile = path.join(IMAGE_PATH, my_sha1(code + font))
-            filetype = '.pdf' if docFormat in ['latex', 'beamer'] else '.png'
-            sourceFile = outfile + filetype
-            caption = ''
-            library = ''
-            for a, b in attributes:
-                if a == 'caption':
-                    caption = b
-                elif a == 'tikzlibrary':
-                    library = b
-            if not path.isfile(sourceFile):
-                try:
-                    mkdir(IMAGE_PATH)
-                    debug('Created directory {}\n\n'.format(IMAGE_PATH))
-                except OSError:
-                    pass
-                codeHeader = '\\documentclass{{standalone}}\n' + \
-                             '\\usepackage{{{}}}\n' + \
-                             '\\usepackage{{tikz}}\n'.format(font)
-                if library:
-                    codeHeader += '\\usetikzlibrary{{{}}}\n'.format(library)
-                codeHeader += '\\begin{document}\n'
-                codeFooter = '\n\\end{document}\n'
-                tikz2image(codeHeader + code + codeFooter, filetype,
-                           outfile)
-                debug('Created image {}\n\n'.format(sourceFile))
-            if caption:
-                # Need to run this through pandoc to get JSON
-                # representation so that captions can be docFormatted text.
-                jsonString = toFormat(caption, 'markdown', 'json')
-                if "blocks" in jsonString:
-                    formattedCaption = eval(jsonString)["blocks"][0]['c']
-                else:  # old API
-                    formattedCaption = eval(jsonString)[1][0]['c']
+class FilterState(object):
+    # What is remembered while filtering one document. Each document gets its
+    # own, so that several can be filtered at once (in threads, e.g.).
+    __slots__ = ['draft', 'inlineTagStack', 'inlineFontColorStack',
+                 'blockComment', 'inlineComment', 'inlineMargin',
+                 'inlineHighlight', 'usedBox', 'pendingFigures', 'usedFigures',
+                 'cssClasses', 'labelIndex', 'macros', 'expanding',
+                 'action', 'skip']
+
+    def __init__(self, metadata):
+        # Take the draft status from the document's metadata.
+        if 'draft' in metadata:
+            self.draft = metadata['draft']['c']
+        else:
+            self.draft = False
+        self.inlineTagStack = []
+        self.inlineFontColorStack = ['black']
+        self.blockComment = False
+        self.inlineComment = False
+        self.inlineMargin = False
+        self.inlineHighlight = False
+        self.usedBox = False
+        # TikZ figures waiting to be typeset, keyed by output file
+        self.pendingFigures = {}
+        # TikZ figures used by the document, keyed by file name
+        self.usedFigures = {}
+        self.cssClasses = css_classes(metadata)
+        # The LabelIndex, if references are resolved (see `use_label_index`)
+        self.labelIndex = None
+        # The document's macros (see `macro_table`), and those being expanded
+        self.macros = macro_table(metadata)
+        self.expanding = set()
+        # The action for `walk_inplace`
+        self.action = partial(handle_comments, self)
+        if PROFILE is not None:
+            self.action = PROFILE.action(self.action)
+        # What `walk_inplace` may skip (see `inert`; with macros, any text
+        # may be one)
+        self.skip = None if self.macros else self.inert
+
+    def inert(self, item):
+        # Whether `walk_inplace` can skip an element: it is `inert`, and
+        # output is not being suppressed.
+        if not self.draft and (self.blockComment or self.inlineComment or
+                               self.inlineMargin):
+            return False
+        return inert(item)
+
+    def snapshot(self):
+        # The state that affects how the rest of the document is filtered,
+        # as a list that can be stored as JSON (for `BlockCache`).
+        return [self.draft, self.inlineTagStack, self.inlineFontColorStack,
+                self.blockComment, self.inlineComment, self.inlineMargin,
+                self.inlineHighlight]
+
+    def restore(self, snapshot):
+        # Return to a state from `snapshot`.
+        (self.draft, inlineTagStack, inlineFontColorStack, self.blockComment,
+         self.inlineComment, self.inlineMargin, self.inlineHighlight) = \
+            snapshot
+        self.inlineTagStack = list(inlineTagStack)
+        self.inlineFontColorStack = list(inlineFontColorStack)
+
+
+def finish_metadata(format, metadata, state):
+    # Add any needed entries to `metadata` once the document has been
+    # processed. Returns True if `metadata` was changed.
+
+    MetaList = elt('MetaList', 1)
+    MetaInlines = elt('MetaInlines', 1)
+    rawinlines = []
+    # Need to ensure the LaTeX/beamer template knows if `mdframed` package is
+    # required (when `<!box>` has been used).
+    if (format == 'latex' or format == 'beamer') and state.usedBox:
+        rawinlines.append(MetaInlines([
+            RawInline('tex', '\\RequirePackage{mdframed}')]))
+    # HTML styled with classes needs their stylesheet.
+    if state.cssClasses and format in CLASS_FORMAT_TEXT:
+        rawinlines.append(MetaInlines([RawInline('html', CLASS_STYLESHEET)]))
+    if not rawinlines:
+        return False
+    if 'header-includes' in metadata:
+        headerIncludes = metadata['header-includes']
+        if headerIncludes['t'] == 'MetaList':
+            rawinlines += headerIncludes['c']
+        else:  # headerIncludes['t'] == 'MetaInlines'
+            rawinlines += [headerIncludes]
+    metadata['header-includes'] = MetaList(rawinlines)
+    return True
+
+
+def use_label_index(state, format, metadata):
+    # Give `state` a LabelIndex, if references are resolved in `format` or the
+    # index is to be written out.
+    if format in REFERENCE_FORMATS or \
+            meta_option(metadata, 'label-index', LABEL_INDEX_VARIABLE, ''):
+        state.labelIndex = LabelIndex(metadata, state.draft)
+
+
+def needs_filter(data, format):
+    # Cheaply check whether a document (pandoc's JSON output, as bytes) might
+    # contain anything the filter would change, so that documents without
+    # need not be parsed and written out again. (This assumes that, as in
+    # pandoc's output, letters are not written as `\\u` escapes.) Documents
+    # are always filtered when the label index is to be written out, since
+    # even one without markup has headers to index.
+    if format == 'markdown':
+        return False
+    if environ.get(LABEL_INDEX_VARIABLE):
+        return True
+    for marker in MARKERS:
+        if marker in data:
+            return True
+    if b'"Span"' in data:
+        for marker in SPAN_MARKERS:
+            if marker in data:
+                return True
+    return False
+
+
+def filter_document(document, format):
+    # Run a document (pandoc's JSON output, parsed) through `handle_comments`
+    # and return the result. The document is changed in place. This is safe
+    # to call from several threads at once.
+
+    # If translating to markdown, leave everything alone.
+    if format == 'markdown':
+        return document
+
+    if 'meta' in document:           # new API
+        metadata = document['meta']
+    elif document[0]:                # old API
+        metadata = document[0]['unMeta']
+    # `handle_comments` sees (and LaTeX output gets) the metadata as it was
+    # before being walked.
+    metadata = deepcopy(metadata)
+    state = FilterState(metadata)
+    blocks = document['blocks'] if 'blocks' in document else document[1]
+    if not state.draft:
+        prune_comments(blocks, BLOCK_RANGES)
+    with Timer('captions'):
+        prepare_captions(blocks)
+    use_label_index(state, format, metadata)
+    if state.labelIndex is not None:
+        with Timer('label index'):
+            transclude(blocks, metadata)
+            state.labelIndex.add_blocks(blocks)
+
+    with Timer('walk'):
+        newDocument = walk_inplace(document, state.action, format, metadata,
+                                   state.skip)
+    report_unclosed(state)
+    with Timer('merge raw inlines'):
+        merge_raw_inlines(blocks)
+    with Timer('figures'):
+        render_figures(state, metadata)
+    if state.labelIndex is not None:
+        state.labelIndex.save(metadata)
+
+    if finish_metadata(format, metadata, state):
+        newDocument['meta'] = metadata
+    return newDocument
+
+
+def filter_block(block, state, format, metadata):
+    # Filter a top-level block, returning the JSON text of the blocks that
+    # replace it, separated by commas.
+    with Timer('captions'):
+        prepare_captions([block])
+    with Timer('walk'):
+        newBlocks = walk_inplace([block], state.action, format, metadata,
+                                 state.skip)
+    with Timer('merge raw inlines'):
+        merge_raw_inlines(newBlocks)
+    with Timer('JSON write'):
+        return ', '.join(json.dumps(newBlock) for newBlock in newBlocks)
+
+
+class BlockCache(object):
+    # Filtered top-level blocks, stored in a sqlite database in `directory`.
+    # Blocks are keyed by a hash of their JSON, the FilterState when they are
+    # reached, the output format, the metadata the filter uses, the filter
+    # itself, and the versions of `pdflatex` (which names figures) and pandoc
+    # (which converts captions), since the output depends on nothing else.
+    # The FilterState after the block, and any figures it uses, are stored
+    # with the output.
+
+    def __init__(self, directory, format, metadata):
+        import sqlite3
+        from time import time
+        try:
+            makedirs(directory)
+        except OSError:
+            pass
+        with open(path.abspath(__file__), encoding='utf-8') as f:
+            source = f.read()
+        self.salt = my_sha1('\n\0'.join([
+            source, format, IMAGE_PATH, pdflatex_version(), pandoc_version(),
+            str(css_classes(metadata)),
+            json.dumps(metadata.get('fontfamily'), sort_keys=True),
+            json.dumps(metadata.get('macros'), sort_keys=True)])) + '\n'
+        self.now = time()
+        self.new = []   # Rows to add
+        self.used = []  # Keys of reused blocks not used for a day or more
+        self.db = sqlite3.connect(path.join(directory, BLOCK_CACHE),
+                                  timeout=60)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS blocks ('
+                            'key TEXT PRIMARY KEY, output TEXT, after TEXT, '
+                            'last_used REAL)')
+
+    def key(self, text, state):
+        # Key for a block with JSON `text`, reached in `state`.
+        return my_sha1(self.salt + json.dumps(state.snapshot()) + '\n' + text)
+
+    def get(self, key, state):
+        # Return the stored output of a block, updating `state` as filtering
+        # it would, or None if it must be filtered (because it is not stored,
+        # or a figure it uses has been removed).
+        row = self.db.execute('SELECT output, after, last_used FROM blocks '
+                              'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            count('block cache miss')
+            return None
+        output, after, lastUsed = row
+        after = json.loads(after)
+        for name, font, library, filetype in after['figures']:
+            if not path.isfile(path.join(IMAGE_PATH, name)):
+                count('block cache miss (figure removed)')
+                return None
+        count('block cache hit')
+        for name, font, library, filetype in after['figures']:
+            state.usedFigures[name] = (font, library, filetype)
+        state.restore(after['state'])
+        state.usedBox = state.usedBox or after['usedBox']
+        if lastUsed < self.now - 24 * 60 * 60:
+            self.used.append((self.now, key))
+        return output
+
+    def filter_block(self, key, block, state, format, metadata):
+        # Filter a block (see `filter_block`) and store the result.
+        usedBox, usedFigures = state.usedBox, state.usedFigures
+        state.usedBox, state.usedFigures = False, {}
+        output = filter_block(block, state, format, metadata)
+        after = {'state': state.snapshot(), 'usedBox': state.usedBox,
+                 'figures': [[name] + list(figure) for name, figure
+                             in state.usedFigures.items()]}
+        self.new.append((key, output, json.dumps(after), self.now))
+        state.usedBox = state.usedBox or usedBox
+        usedFigures.update(state.usedFigures)
+        state.usedFigures = usedFigures
+        return output
+
+    def close(self):
+        # Store the new blocks, and remove those not used for
+        # BLOCK_CACHE_AGE seconds.
+        with Timer('block cache update'):
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO blocks VALUES '
+                                    '(?, ?, ?, ?)', self.new)
+                self.db.executemany('UPDATE blocks SET last_used = ? '
+                                    'WHERE key = ?', self.used)
+                self.db.execute('DELETE FROM blocks WHERE last_used < ?',
+                                (self.now - BLOCK_CACHE_AGE,))
+            self.db.close()
+
+
+class JSONReader(object):
+    # Reads a JSON file a piece at a time (for `stream_document`).
+
+    def __init__(self, infile):
+        self.infile = infile
+        self.buffer = ''
+        self.pos = 0
+        self.chunkSize = READ_SIZE
+        self.decoder = json.JSONDecoder()
+
+    def read(self):
+        # Read more of the file into the buffer. Returns False at end of file.
+        chunk = self.infile.read(self.chunkSize)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return bool(chunk)
+
+    def peek(self):
+        # Skip whitespace and return the next character ('' at end of file).
+        while True:
+            while self.pos < len(self.buffer) and \
+                    self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.read():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        # Skip past the next character, which must be `char`.
+        if self.peek() != char:
+            raise ValueError('Expected {!r} at {!r} in JSON input'.format(
+                char, self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+
+    def value(self, raw=False):
+        # Read the next JSON value. If it isn't all in the buffer yet, read
+        # ever larger chunks until it is. With `raw`, return the value and its
+        # JSON text.
+        self.peek()
+        while True:
+            start = self.pos
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, start)
+                # (A number at the end of the buffer may be incomplete.)
+                if end < len(self.buffer) or \
+                        not isinstance(value, (int, float)):
+                    break
+            except ValueError:
+                pass
+            self.chunkSize *= 2
+            if not self.read():
+                start = self.pos
+                value, end = self.decoder.raw_decode(self.buffer, start)
+                break
+        self.pos = end
+        self.chunkSize = READ_SIZE
+        if raw:
+            return value, self.buffer[start:end]
+        return value
+
+
+def index_blocks(reader, labelIndex, metadata):
+    # Read the document's blocks (a JSON list) from `reader`, adding them to
+    # `labelIndex`, and return a JSONReader that reads them again from a
+    # temporary file (with transclusions done). For `stream_document`, which
+    # must index the whole document before filtering any of it.
+    from tempfile import SpooledTemporaryFile
+    spool = SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+')
+    spool.write('[')
+    reader.expect('[')
+    first = True
+    with Timer('label index'):
+        while reader.peek() != ']':
+            if not first:
+                reader.expect(',')
+                spool.write(', ')
+            first = False
+            block, text = reader.value(raw=True)
+            blocks = [block]
+            if '"@"' in text:
+                transclude(blocks, metadata)
+                text = ', '.join(json.dumps(b) for b in blocks)
+            labelIndex.add_blocks(blocks)
+            spool.write(text)
+    reader.expect(']')
+    spool.write(']')
+    spool.seek(0)
+    return JSONReader(spool)
+
+
+def stream_document(infile, outfile, format):
+    # Filter a document without holding all of it in memory: top-level blocks
+    # are read, filtered, and written one at a time. They are written to a
+    # temporary file first, since the metadata is output before the blocks but
+    # is only finished at the end. (TikZ captions are converted a block at a
+    # time.) If there is a block cache (see `BlockCache`), blocks found there
+    # are not filtered again. Documents that don't have `meta` before `blocks`
+    # are read in full and passed to `filter_document`.
+    from tempfile import SpooledTemporaryFile
+    from shutil import copyfileobj
+    if format == 'markdown':  # Nothing to do
+        copyfileobj(infile, outfile)
+        return
+    reader = JSONReader(infile)
+    if reader.peek() != '{':  # old API
+        json.dump(filter_document(reader.value(), format), outfile)
+        return
+    reader.expect('{')
+    before = []     # (key, value) for entries before `blocks`
+    after = []      # (key, value) for entries after `blocks`
+    metadata = None
+    spool = None
+    while reader.peek() != '}':
+        if before or spool is not None:
+            reader.expect(',')
+        key = reader.value()
+        reader.expect(':')
+        if key != 'blocks' or metadata is None or spool is not None:
+            value = reader.value()
+            if key == 'meta':
+                metadata = deepcopy(value)  # (See `filter_document`.)
+            (after if spool is not None else before).append((key, value))
+            continue
+
+        state = FilterState(metadata)
+        action = state.action
+        use_label_index(state, format, metadata)
+        blockReader = reader
+        if state.labelIndex is not None:
+            blockReader = index_blocks(reader, state.labelIndex, metadata)
+        cacheDirectory = meta_option(metadata, 'block-cache',
+                                     BLOCK_CACHE_VARIABLE, '')
+        cache = BlockCache(cacheDirectory, format, metadata) \
+            if cacheDirectory else None
+        for k, v in before:
+            walk_inplace(v, action, format, metadata)
+        spool = SpooledTemporaryFile(max_size=SPOOL_SIZE, mode='w+')
+        separator = ''
+        blockReader.expect('[')
+        first = True
+        while blockReader.peek() != ']':
+            if not first:
+                blockReader.expect(',')
+            first = False
+            if cache is None:
+                with Timer('JSON read'):
+                    block = blockReader.value()
+                output = filter_block(block, state, format, metadata)
             else:
-                formattedCaption = [Str('')]
-            return Para([Image((id, classes, attributes), formattedCaption,
-                        [sourceFile, caption])])
-        else:  # CodeBlock, but not tikZ
+                with Timer('JSON read'):
+                    block, text = blockReader.value(raw=True)
+                if '"@"' in text:
+                    # (The key must change when a transcluded file does.)
+                    blocks = [block]
+                    transclude(blocks, metadata)
+                    text = json.dumps(blocks)
+                if state.labelIndex is not None:
+                    # (... or when a label it refers to does.)
+                    text += json.dumps(state.labelIndex.referenced(block))
+                blockKey = cache.key(text, state)
+                output = cache.get(blockKey, state)
+                if output is None:
+                    output = cache.filter_block(blockKey, block, state,
+                                                format, metadata)
+            if output:
+                spool.write(separator)
+                spool.write(output)
+                separator = ', '
+        blockReader.expect(']')
+        report_unclosed(state)
+        if blockReader is not reader:
+            blockReader.infile.close()
+        if cache is not None:
+            cache.close()
+    reader.expect('}')
+
+    if spool is None:  # Could not stream the blocks
+        json.dump(filter_document(dict(before), format), outfile)
+        return
+
+    for k, v in after:
+        walk_inplace(v, action, format, metadata)
+    with Timer('figures'):
+        render_figures(state, metadata)
+    if state.labelIndex is not None:
+        state.labelIndex.save(metadata)
+    if finish_metadata(format, metadata, state):
+        before = [(k, metadata if k == 'meta' else v) for k, v in before]
+
+    outfile.write('{')
+    for key, value in before:
+        outfile.write('{}: {}, '.format(json.dumps(key), json.dumps(value)))
+    outfile.write('"blocks": [')
+    spool.seek(0)
+    with Timer('JSON write'):
+        copyfileobj(spool, outfile)
+    spool.close()
+    outfile.write(']')
+    for key, value in after:
+        outfile.write(', {}: {}'.format(json.dumps(key), json.dumps(value)))
+    outfile.write('}')
+
+
+def serve_documents(infile, outfile):
+    # Filter documents read from `infile` until it is closed, writing them to
+    # `outfile` (both binary files). Each document is sent as a line
+    # `FORMAT LENGTH`, followed by LENGTH bytes of JSON. Each reply is a line
+    # `ok LENGTH` followed by the filtered document, or `error LENGTH`
+    # followed by an error message. Documents that `needs_filter` passes over
+    # are not parsed, so are not checked either.
+    while True:
+        header = infile.readline().split()
+        if not header:
             return
+        try:
+            length = int(header[-1])
+        except ValueError:
+            length = -1
+        if length < 0 or len(header) > 2:
+            # Cannot tell where the next document starts, so give up.
+            reply = 'Bad header: {}'.format(b' '.join(header).decode(
+                'utf-8', 'replace')).encode('utf-8')
+            outfile.write(b'error ' + str(len(reply)).encode() + b'\n' +
+                          reply)
+            outfile.flush()
+            return
+        format = header[0].decode('utf-8') if len(header) == 2 else ''
+        payload = infile.read(length)
 
-    else:  # Not text this filter modifies....
+        status = b'ok '
+        try:
+            if needs_filter(payload, format):
+                document = json.loads(payload.decode('utf-8'))
+                reply = json.dumps(filter_document(document, format)) \
+                    .encode('utf-8')
+            else:
+                reply = payload
+        except (Exception, SystemExit) as e:  # (Exits on mismatched tags)
+            reply = '{}: {}'.format(e.__class__.__name__, e).encode('utf-8')
+            status = b'error '
+        outfile.write(status + str(len(reply)).encode() + b'\n' + reply)
+        outfile.flush()
+
+
+def serve(socketPath=None):
+    # Filter many documents in one process (see `serve_documents`), reading
+    # them from stdin or, if `socketPath` is given, from connections to a Unix
+    # socket there (one connection at a time).
+    if socketPath is None:
+        serve_documents(sys.stdin.buffer, sys.stdout.buffer)
         return
+    import socket
+    if path.exists(socketPath):
+        remove(socketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketPath)
+    server.listen(1)
+    try:
+        while True:
+            connection = server.accept()[0]
+            with connection, connection.makefile('rb') as infile, \
+                    connection.makefile('wb') as outfile:
+                try:
+                    serve_documents(infile, outfile)
+                except OSError as e:  # Client went away
+                    debug('Lost connection: {}'.format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        remove(socketPath)
+
+
+def profile_startup(format):
+    # Report how long the filter takes to start: the time from launching it
+    # to reaching the first node of a small document (compared with starting
+    # Python with nothing to do), the time taken to compile this script, and
+    # the slowest imports.
+    from subprocess import Popen, PIPE, DEVNULL
+    from time import monotonic
+    document = json.dumps({'pandoc-api-version': [1, 22], 'meta': {},
+                           'blocks': [Para([Str('Startup')])]})
+    environ[STARTUP_VARIABLE] = '1'
+    script = path.abspath(__file__)
+
+    def run(options):
+        # Run the filter, returning the time taken and its stderr.
+        start = monotonic()
+        p = Popen([sys.executable] + options + [script, format], stdin=PIPE,
+                  stdout=PIPE, stderr=PIPE)
+        output = p.communicate(document.encode('utf-8'))[1].decode('utf-8')
+        return start, monotonic() - start, output
+
+    start, total, output = run([])
+    firstNode = None
+    for line in output.splitlines():
+        if line.startswith(STARTUP_VARIABLE):
+            firstNode = float(line.split()[1]) - start
+    if firstNode is None:
+        sys.stdout.write('The filter failed:\n{}\n'.format(output))
+        sys.exit(1)
+
+    start = monotonic()
+    Popen([sys.executable, '-c', 'pass'], stdin=DEVNULL).wait()
+    bare = monotonic() - start
+
+    start = monotonic()
+    with open(script) as f:
+        compile(f.read(), script, 'exec')
+    compiling = monotonic() - start
+
+    imports = []
+    for line in run(['-X', 'importtime'])[2].splitlines():
+        if line.startswith('import time:'):
+            fields = line[len('import time:'):].split('|')
+            # Only top-level imports (names indented by one space).
+            if fields[1].strip().isdigit() and fields[2][1] != ' ':
+                imports.append((int(fields[1]), fields[2].strip()))
+
+    sys.stdout.write(
+        'Format {}: {:.1f} ms to first node (target {} ms), '
+        '{:.1f} ms in all.\n'
+        'Python with nothing to do: {:.1f} ms.\n'
+        'Compiling this script: {:.1f} ms. (Python does not cache the '
+        'bytecode\n'
+        'of a script it runs, only of modules it imports: see the wrapper\n'
+        'script under "Startup Time" in the documentation.)\n'
+        'Slowest imports (ms, including the modules they import):\n'.format(
+            format, firstNode * 1000, STARTUP_TARGET, total * 1000,
+            bare * 1000, compiling * 1000))
+    for microseconds, name in sorted(imports, reverse=True)[:10]:
+        sys.stdout.write('{:8.1f}  {}\n'.format(microseconds / 1000, name))
 
 
 def main():
-    # This grabs the output of `pandoc` as json file, retrieves `metadata` to
-    # check for draft status, and runs the document through `handle_comments`.
-    # Then adds any needed entries to `metadata` and passes the output back out
+    # This grabs the output of `pandoc` as json file, runs it through
+    # `filter_document` (or `stream_document`), and passes the output back out
     # to `pandoc`. This code is modeled after
     # <https://github.com/aaren/pandoc-reference-filter>.
-    global DRAFT
-    document = json.loads(sys.stdin.read())
+    # With `--serve [SOCKET]`, filters many documents instead (see `serve`);
+    # with `--profile-startup [FORMAT]`, times starting the filter.
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2] if len(sys.argv) > 2 else None)
+        return
+    if sys.argv[1:2] == ['--profile-startup']:
+        profile_startup(sys.argv[2] if len(sys.argv) > 2 else 'latex')
+        return
     if len(sys.argv) > 1:
         format = sys.argv[1]
     else:
         format = ''
 
-    if 'meta' in document:           # new API
-        metadata = document['meta']
-    elif document[0]:                # old API
-        metadata = document[0]['unMeta']
-
-    if 'draft' in metadata:
-        DRAFT = metadata['draft']['c']
+    if environ.get(STREAM_VARIABLE) or environ.get(BLOCK_CACHE_VARIABLE):
+        stream_document(sys.stdin, sys.stdout, format)
     else:
-        DRAFT = False
-
-    newDocument = document
-    newDocument = walk(newDocument, handle_comments, format, metadata)
-
-    # Need to ensure the LaTeX/beamer template knows if `mdframed` package is
-    # required (when `<!box>` has been used).
-    if (format == 'latex' or format == 'beamer') and USED_BOX:
-        MetaList = elt('MetaList', 1)
-        MetaInlines = elt('MetaInlines', 1)
-        rawinlines = [MetaInlines([RawInline('tex',
-                                             '\\RequirePackage{mdframed}')])]
-        if 'header-includes' in metadata:
-            headerIncludes = metadata['header-includes']
-            if headerIncludes['t'] == 'MetaList':
-                rawinlines += headerIncludes['c']
-            else:  # headerIncludes['t'] == 'MetaInlines'
-                rawinlines += [headerIncludes]
-        metadata['header-includes'] = MetaList(rawinlines)
-        newDocument['meta'] = metadata
-
-    json.dump(newDocument, sys.stdout)
+        with Timer('JSON read'):
+            data = sys.stdin.buffer.read()
+        if environ.get(STARTUP_VARIABLE):
+            from time import monotonic
+            stderr.write('{} {}\n'.format(STARTUP_VARIABLE, monotonic()))
+        if not needs_filter(data, format):
+            sys.stdout.buffer.write(data)  # Pass the document through as is
+            return
+        if b'"block-cache"' in data:  # (Only streaming uses the block cache.)
+            from io import StringIO
+            stream_document(StringIO(data.decode('utf-8')), sys.stdout, format)
+            return
+        with Timer('JSON parse'):
+            document = json.loads(data.decode('utf-8'))
+        document = filter_document(document, format)
+        # (`json.dump` writes to stdout in many small pieces, which takes
+        # several times as long as encoding the whole document first.)
+        with Timer('JSON write'):
+            sys.stdout.write(json.dumps(document))
 
 
 if __name__ == '__main__':
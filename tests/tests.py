@@ -1,95 +1,682 @@
+#!/usr/bin/env python
+
+"""
+Compare the filters' output with the reference output in tests/.
+
+Run from the root of the repository:
+
+    python tests/tests.py [--jobs N] [--python-only] [--subprocess] [--update]
+
+The Lua filter is run by pandoc on `spec.md` (three modes, four formats). The
+Python filter is run on the JSON AST in `tests/python-input.json` (draft and
+final, seven formats), by calling `filter_document` directly, or with
+`--subprocess` by running the script as pandoc would. All cases run at once,
+each writing to its own temporary directory; the slowest are listed at the
+end. With `--update`, the reference output is rewritten instead.
+"""
+
+import argparse
+import json
 import os
 import subprocess
-import nose.tools as nt
-
-
-def call_pandoc(pandoc_cmd):
-    p = subprocess.Popen(pandoc_cmd, stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
-    return stdout.decode()
-
-
-def _test(format):
-    pandoc_cmd = ('pandoc', 'spec.md',
-                  '--lua-filter', './pandocCommentFilter.lua',
-                  '--mathjax',
-                  '-M', 'comment=draft',
-                  '-M', 'fixme=draft',
-                  '-M', 'margin=draft',
-                  '-M', 'highlight=draft',
-                  '--to', format,
-                  '-o', 'temp.txt')
-    call_pandoc(pandoc_cmd)
-    with open('temp.txt') as f:
-        pandoc_output = f.read()
-    ref_file = 'tests/spec-draft.{ext}'.format(ext=format)
-    with open(ref_file) as f:
-        nt.assert_multi_line_equal(pandoc_output, f.read())
-
-    pandoc_cmd = ('pandoc', 'spec.md',
-                  '--lua-filter', './pandocCommentFilter.lua',
-                  '--mathjax',
-                  '-M', 'comment=print',
-                  '-M', 'fixme=print',
-                  '-M', 'margin=print',
-                  '-M', 'highlight=print',
-                  '--to', format,
-                  '-o', 'temp.txt')
-    call_pandoc(pandoc_cmd)
-    with open('temp.txt') as f:
-        pandoc_output = f.read()
-    ref_file = 'tests/spec-print.{ext}'.format(ext=format)
-    with open(ref_file) as f:
-        nt.assert_multi_line_equal(pandoc_output, f.read())
-
-    pandoc_cmd = ('pandoc', 'spec.md',
-                  '--lua-filter', './pandocCommentFilter.lua',
-                  '--mathjax',
-                  '-M', 'comment=hide',
-                  '-M', 'fixme=hide',
-                  '-M', 'margin=hide',
-                  '-M', 'highlight=hide',
-                  '--to', format,
-                  '-o', 'temp.txt')
-    call_pandoc(pandoc_cmd)
-    with open('temp.txt') as f:
-        pandoc_output = f.read()
-    ref_file = 'tests/spec-hide.{ext}'.format(ext=format)
-    with open(ref_file) as f:
-        nt.assert_multi_line_equal(pandoc_output, f.read())
-
-    os.remove('temp.txt')
-
-
-def test_markdown():
-    print("- Markdown")
-    _test('markdown')
-
-
-def test_html4():
-    print("- HTML4")
-    _test('html4')
-
-
-def test_html5():
-    print("- HTML5")
-    _test('html5')
-
-
-def test_latex():
-    print("- LaTeX")
-    _test('latex')
-
-
-def test_all_formats():
-    for format in ('markdown', 'latex', 'html', 'html5'):
-        _test(format)
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from os import cpu_count, path
+from shutil import rmtree
+from tempfile import mkdtemp
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+TESTS = path.join(ROOT, 'tests')
+sys.path.insert(0, ROOT)  # (For `import pandocCommentFilter`.)
+LUA_MODES = ['draft', 'print', 'hide']
+LUA_FORMATS = ['markdown', 'html4', 'html5', 'latex']
+PYTHON_INPUT = path.join(TESTS, 'python-input.json')
+PYTHON_FORMATS = ['markdown', 'latex', 'beamer', 'html', 'html5', 'revealjs',
+                  'docx']
+SLOWEST = 5
+
+
+def lua_case(mode, docFormat, tmpdir):
+    # Run pandoc with the Lua filter, returning its output and the reference
+    # file.
+    outfile = path.join(tmpdir, 'output')
+    command = ['pandoc', 'spec.md', '--lua-filter',
+               './pandocCommentFilter.lua', '--mathjax']
+    for option in ['comment', 'fixme', 'margin', 'highlight']:
+        command += ['-M', '{}={}'.format(option, mode)]
+    command += ['--to', docFormat, '-o', outfile]
+    subprocess.check_call(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+    with open(outfile) as f:
+        output = f.read()
+    return output, path.join(TESTS, 'spec-{}.{}'.format(mode, docFormat))
+
+
+def python_case(draft, docFormat, document, runInProcess, tmpdir):
+    # Run the Python filter on `document`, returning its output (as JSON
+    # text) and the reference file.
+    document = deepcopy(document)
+    document['meta']['draft'] = {'t': 'MetaBool', 'c': draft}
+    if runInProcess:
+        import pandocCommentFilter
+        output = json.dumps(pandocCommentFilter.filter_document(document,
+                                                                 docFormat))
+    else:
+        output = subprocess.check_output(
+            [sys.executable, path.join(ROOT, 'pandocCommentFilter.py'),
+             docFormat], input=json.dumps(document).encode('utf-8'),
+            cwd=tmpdir).decode('utf-8')
+    # One element to a line, so that differences are easy to read.
+    output = json.dumps(json.loads(output), indent=0, sort_keys=True) + '\n'
+    mode = 'draft' if draft else 'final'
+    return output, path.join(TESTS, 'python-{}.{}'.format(mode, docFormat))
+
+
+def run_case(case, update):
+    # Run a test case, returning (name, seconds, error message or None).
+    name, function, args = case
+    tmpdir = mkdtemp()
+    start = time.perf_counter()
+    try:
+        output, reference = function(*args + (tmpdir,))
+        elapsed = time.perf_counter() - start
+        if update:
+            with open(reference, 'w') as f:
+                f.write(output)
+            return name, elapsed, None
+        with open(reference) as f:
+            expected = f.read()
+        if output != expected:
+            return name, elapsed, first_difference(output, expected,
+                                                   reference)
+        return name, elapsed, None
+    except Exception as e:
+        return name, time.perf_counter() - start, '{}: {}'.format(
+            e.__class__.__name__, e)
+    finally:
+        rmtree(tmpdir)
+
+
+def first_difference(output, expected, reference):
+    # Describe where `output` first differs from `expected`.
+    outputLines = output.split('\n')
+    expectedLines = expected.split('\n')
+    for n, (line, expectedLine) in enumerate(zip(outputLines, expectedLines)):
+        if line != expectedLine:
+            break
+    else:
+        n = min(len(outputLines), len(expectedLines))
+    return 'differs from {} at line {}:\n  expected: {!r}\n  got:      {!r}' \
+        .format(path.relpath(reference, ROOT), n + 1,
+                expectedLines[n] if n < len(expectedLines) else '(end)',
+                outputLines[n] if n < len(outputLines) else '(end)')
+
+
+def have_pandoc():
+    try:
+        subprocess.check_call(['pandoc', '--version'],
+                              stdout=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def make_cases(pythonOnly=False, runInProcess=True):
+    # The test cases to run: (name, function, arguments).
+    cases = []
+    if not pythonOnly:
+        for mode in LUA_MODES:
+            for docFormat in LUA_FORMATS:
+                cases.append(('lua {} {}'.format(mode, docFormat), lua_case,
+                              (mode, docFormat)))
+    with open(PYTHON_INPUT) as f:
+        document = json.load(f)
+    for draft in [True, False]:
+        for docFormat in PYTHON_FORMATS:
+            cases.append(('python {} {}'.format(
+                'draft' if draft else 'final', docFormat), python_case,
+                (draft, docFormat, document, runInProcess)))
+    return cases
+
+
+def run_tests(cases, update=False, jobs=None):
+    # Run the cases concurrently, report the results, and return True if
+    # they all passed.
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=jobs or cpu_count() or 1) as pool:
+        results = list(pool.map(lambda case: run_case(case, update), cases))
+    elapsed = time.perf_counter() - start
+
+    failures = [(name, error) for name, seconds, error in results if error]
+    for name, error in failures:
+        print('FAIL: {}: {}'.format(name, error))
+    print('{} {} cases in {:.2f}s ({} failed). Slowest:'.format(
+        'Updated' if update else 'Ran', len(results), elapsed,
+        len(failures)))
+    for name, seconds, error in sorted(results, key=lambda r: -r[1])[:SLOWEST]:
+        print('  {:.3f}s  {}'.format(seconds, name))
+    return not failures
+
+
+def Str(text):
+    # A `Str` element (and so on below, for the tests' documents).
+    return {'t': 'Str', 'c': text}
+
+
+def raw(text, kind='RawInline', rawFormat='html'):
+    # A raw inline or block.
+    return {'t': kind, 'c': [rawFormat, text]}
+
+
+def para(*inlines):
+    # A paragraph, with strings made into `Str` elements.
+    return {'t': 'Para', 'c': [Str(x) if isinstance(x, str) else x
+                               for x in inlines]}
+
+
+def span(cls, inlines):
+    # A span with one class, around inlines or (as a `Str`) a string.
+    if isinstance(inlines, str):
+        inlines = [Str(inlines)]
+    return {'t': 'Span', 'c': [['', [cls], []], inlines]}
+
+
+def new_document(blocks, meta=None):
+    # A document (as pandoc's JSON output, parsed).
+    return {'pandoc-api-version': [1, 22], 'meta': meta or {},
+            'blocks': blocks}
+
+
+def test_all():
+    assert run_tests(make_cases(pythonOnly=not have_pandoc()))
+
+
+def test_profile():
+    # Profiling must not change the output, and must report on the walk.
+    tmpdir = mkdtemp()
+    try:
+        report = path.join(tmpdir, 'profile.json')
+        with open(PYTHON_INPUT) as f:
+            document = json.load(f)
+        document['meta']['draft'] = {'t': 'MetaBool', 'c': False}
+        output = subprocess.check_output(
+            [sys.executable, path.join(ROOT, 'pandocCommentFilter.py'),
+             'latex'], input=json.dumps(document).encode('utf-8'),
+            cwd=tmpdir,
+            env=dict(os.environ, PANDOC_COMMENT_FILTER_PROFILE=report))
+        document = json.loads(output.decode('utf-8'))
+        with open(path.join(TESTS, 'python-final.latex')) as f:
+            assert json.dumps(document, indent=0, sort_keys=True) + '\n' == \
+                f.read()
+        with open(report) as f:
+            work = {entry['name']: entry for entry in json.load(f)['work']}
+        assert work['walk']['count'] == 1
+        assert work['Span .comment']['count'] > 0
+    finally:
+        rmtree(tmpdir)
+
+
+def test_captions():
+    # The filter's caption parser must read the captions in
+    # `tests/captions.json` as listed there (null: left to pandoc) and, if
+    # pandoc is installed, as pandoc does.
+    import pandocCommentFilter
+    with open(path.join(TESTS, 'captions.json')) as f:
+        captions = json.load(f)
+    checkPandoc = have_pandoc()
+    for caption, expected in captions:
+        inlines = pandocCommentFilter.parse_caption(caption)
+        assert inlines == expected, caption
+        if checkPandoc and inlines is not None:
+            blocks = pandocCommentFilter.json_blocks(
+                pandocCommentFilter.toFormat(' '.join(caption.split()),
+                                             'markdown', 'json'))
+            assert [block['t'] for block in blocks] == ['Para'], caption
+            assert inlines == blocks[0]['c'], caption
+
+
+def test_block_cache():
+    # Filtering with a block cache, whether the blocks are stored there yet
+    # or not, must give the same output as filtering without one.
+    from io import StringIO
+    import pandocCommentFilter
+    tmpdir = mkdtemp()
+    try:
+        with open(PYTHON_INPUT) as f:
+            document = json.load(f)
+        document['meta']['block-cache'] = {'t': 'MetaString', 'c': tmpdir}
+        for draft in [True, False]:
+            document['meta']['draft'] = {'t': 'MetaBool', 'c': draft}
+            for docFormat in ['latex', 'html5', 'docx']:
+                reference = path.join(TESTS, 'python-{}.{}'.format(
+                    'draft' if draft else 'final', docFormat))
+                with open(reference) as f:
+                    expected = f.read()
+                for run in ['cold', 'warm']:
+                    outfile = StringIO()
+                    pandocCommentFilter.stream_document(
+                        StringIO(json.dumps(document)), outfile, docFormat)
+                    output = json.loads(outfile.getvalue())
+                    del output['meta']['block-cache']
+                    assert json.dumps(output, indent=0, sort_keys=True) + \
+                        '\n' == expected, (run, reference)
+    finally:
+        rmtree(tmpdir)
+
+
+def test_transclusion():
+    # Transcluded files are filtered along with the document, including the
+    # files they transclude; cycles (however the files in them are named)
+    # and missing files are reported in the output; and the block cache
+    # notices when a transcluded file changes.
+    # (Without pandoc, the files' blocks are put in the filter's cache.)
+    from io import StringIO
+    from pandocfilters import stringify
+    import pandocCommentFilter
+
+    def link(name):
+        return para('@', {'t': 'Link', 'c': [['', [], []], [], [name, '']]})
+
+    tmpdir = path.realpath(mkdtemp())
+    try:
+        files = {
+            'a.md': ('A [comment]{.comment}\n\n@[](sub/b.md)\n', [
+                para('A', {'t': 'Space'}, span('comment', 'comment')),
+                link('sub/b.md')]),
+            'sub/b.md': ('B\n\n@[](c.md)\n\n@[](c.md)\n',
+                         [para('B'), link('c.md'), link('c.md')]),
+            'sub/c.md': ('C\n', [para('C')]),
+            'loop.md': ('L\n\n@[](loop.md)\n', [para('L'), link('loop.md')]),
+            'd/self.md': ('S\n\n@[](./self.md)\n',
+                          [para('S'), link('./self.md')]),
+            'd/a.md': ('DA\n\n@[](../d/a.md)\n',
+                       [para('DA'), link('../d/a.md')])}
+        os.makedirs(path.join(tmpdir, 'sub'))
+        os.makedirs(path.join(tmpdir, 'd'))
+        for name, (text, blocks) in files.items():
+            fileName = path.join(tmpdir, name)
+            with open(fileName, 'w') as f:
+                f.write(text)
+            if not have_pandoc():
+                pandocCommentFilter.TRANSCLUSIONS[
+                    pandocCommentFilter.transclusion_key(fileName, text)] = \
+                    blocks
+        document = new_document(
+            [link(path.join(tmpdir, name))
+             for name in ['a.md', 'loop.md', 'd/self.md', 'd/a.md',
+                          'missing.md']],
+            {'block-cache': {'t': 'MetaString', 'c': tmpdir}})
+        loop = path.join(tmpdir, 'loop.md')
+        missing = path.join(tmpdir, 'missing.md')
+        cycle = '\\Longrightarrow ERROR: Transclusion cycle at {}! ' \
+            '\\Longleftarrow'
+        expected = ['A ', 'B', 'C', 'C', 'L', cycle.format(loop), 'S',
+                    cycle.format(path.join(tmpdir, 'd', 'self.md')), 'DA',
+                    cycle.format(path.join(tmpdir, 'd', 'a.md')),
+                    '\\Longrightarrow ERROR: Cannot find {}! '
+                    '\\Longleftarrow'.format(missing)]
+        output = pandocCommentFilter.filter_document(deepcopy(document),
+                                                     'latex')
+        assert [stringify(block) for block in output['blocks']] == expected
+        for run in ['cold', 'warm']:
+            outfile = StringIO()
+            pandocCommentFilter.stream_document(
+                StringIO(json.dumps(document)), outfile, 'latex')
+            assert json.loads(outfile.getvalue())['blocks'] == \
+                output['blocks'], run
+        with open(path.join(tmpdir, 'sub', 'c.md'), 'w') as f:
+            f.write('D\n')
+        if not have_pandoc():
+            pandocCommentFilter.TRANSCLUSIONS[
+                pandocCommentFilter.transclusion_key(
+                    path.join(tmpdir, 'sub', 'c.md'), 'D\n')] = [para('D')]
+        outfile = StringIO()
+        pandocCommentFilter.stream_document(StringIO(json.dumps(document)),
+                                            outfile, 'latex')
+        assert [stringify(block) for block in json.loads(
+            outfile.getvalue())['blocks']][2:4] == ['D', 'D']
+    finally:
+        rmtree(tmpdir)
+
+
+def test_inert():
+    # Only elements `handle_comments` would leave alone are skipped, and
+    # nothing is skipped while output is suppressed.
+    import pandocCommentFilter
+
+    plain = para({'t': 'Emph', 'c': [Str('a')]}, {'t': 'Space'}, 'b')
+    assert pandocCommentFilter.inert(plain)
+    for block in [para('<comment>'), para('<', 'x'), para('@', 'x'),
+                  para(raw('<comment>')),
+                  {'t': 'Div', 'c': [['', [], []], [plain]]}]:
+        assert not pandocCommentFilter.inert(block), block
+    state = pandocCommentFilter.FilterState({})
+    assert state.skip(plain)
+    state.blockComment = True
+    assert not state.skip(plain)
+    state = pandocCommentFilter.FilterState({'macros': {'t': 'MetaMap', 'c': {
+        'm': {'t': 'MetaInlines', 'c': [Str('x')]}}}})
+    assert state.skip is None
+
+
+def test_prune_comments():
+    # In final output, `<!comment>` blocks and `<comment>` and `<margin>`
+    # inlines are cut out with everything in them, including spans and raw
+    # inlines that are not HTML; unbalanced ones are still suppressed. The
+    # output is the same whether the document is streamed or not.
+    from io import StringIO
+    import pandocCommentFilter
+    hidden = [raw('<comment>'), Str('hidden'), span('smcaps', 'caps'),
+              raw('\\hidden', rawFormat='tex'), raw('</comment>')]
+    document = new_document([
+        para(Str('a'), *hidden + [Str('b')]),
+        {'t': 'Plain', 'c': [raw('<margin>'), Str('note'), raw('</margin>'),
+                             Str('c')]},
+        raw('<!comment>', 'RawBlock'), para(Str('x'), *hidden),
+        {'t': 'Div', 'c': [['', [], []], [
+            para(Str('d')), raw('<!comment>', 'RawBlock'), para(Str('y')),
+            raw('</!comment>', 'RawBlock')]]},
+        raw('</!comment>', 'RawBlock'),
+        {'t': 'Div', 'c': [['', [], []], [
+            para(Str('e')), raw('<!comment>', 'RawBlock'), para(Str('z')),
+            raw('</!comment>', 'RawBlock'), para(Str('f'))]]},
+        para(Str('g'), raw('<comment>'), Str('unclosed'))])
+    expected = [para(Str('a'), Str('b')), {'t': 'Plain', 'c': [Str('c')]},
+                {'t': 'Div', 'c': [['', [], []], [para(Str('e')),
+                                                  para(Str('f'))]]},
+                para(Str('g'))]
+    for docFormat in ['latex', 'html5']:
+        output = pandocCommentFilter.filter_document(deepcopy(document),
+                                                     docFormat)
+        assert output['blocks'] == expected, docFormat
+        outfile = StringIO()
+        pandocCommentFilter.stream_document(StringIO(json.dumps(document)),
+                                            outfile, docFormat)
+        assert json.loads(outfile.getvalue())['blocks'] == expected, \
+            docFormat
+
+
+def test_unclosed_comments():
+    # In final output, comments and margin notes may span paragraphs, and
+    # only those that are never closed are reported.
+    import pandocCommentFilter
+
+    def warnings(*blocks):
+        result = subprocess.run(
+            [sys.executable, path.join(ROOT, 'pandocCommentFilter.py'),
+             'html5'], input=json.dumps(new_document(list(blocks))).encode(
+                 'utf-8'),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        return result.stderr.decode('utf-8')
+
+    assert warnings(para('a', raw('<comment>')), para('b'),
+                    para(raw('</comment>'))) == ''
+    assert warnings(para('a', raw('<margin>')), para(raw('</margin>')),
+                    raw('<!comment>', 'RawBlock'), para('b'),
+                    para('</!comment>')) == ''
+    assert 'Unclosed <comment>' in warnings(para('a', raw('<comment>')),
+                                            para('b'))
+    document = new_document([para('a', raw('<comment>'), 'b'), para('c'),
+                             para('d', raw('</comment>'), 'e')])
+    assert pandocCommentFilter.filter_document(document, 'latex')['blocks'] \
+        == [para('a'), para('e')]
+
+
+def test_merge_raw_inlines():
+    # Runs of raw inlines are merged, and markup around nothing is dropped,
+    # without changing the markup in the dispatch tables.
+    import pandocCommentFilter
+
+    def filtered(inlines, docFormat):
+        document = new_document([para(*inlines)],
+                                {'draft': {'t': 'MetaBool', 'c': True}})
+        return pandocCommentFilter.filter_document(document, docFormat)[
+            'blocks'][0]['c']
+
+    table = deepcopy(pandocCommentFilter.dispatch_table('latex', True))
+    empty = [Str('a'), span('highlight', []), Str('b'),
+             span('smcaps', [span('comment', [])]), Str('c')]
+    for docFormat in ['latex', 'html5']:
+        assert filtered(deepcopy(empty), docFormat) == \
+            [Str('a'), Str('b'), Str('c')], docFormat
+    assert filtered([Str('a'), raw('<highlight>'), raw('<comment>'), Str('x'),
+                     raw('</comment>'), raw('</highlight>'), Str('b')],
+                    'latex') == [
+        Str('a'), raw('\\textcolor{red}{\\hl{', rawFormat='latex'), Str('x'),
+        raw('}}\\color{black}{}', rawFormat='latex'), Str('b')]
+    assert pandocCommentFilter.dispatch_table('latex', True) == table
+    # An empty span with attributes of the user's own is an anchor, and stays.
+    anchor = [Str('a'), raw('<span id="x">'), raw('</span>'), Str('b')]
+    assert filtered(deepcopy(anchor), 'html5') == \
+        [Str('a'), raw('<span id="x"></span>'), Str('b')]
+
+
+def test_css_classes():
+    # With `css-classes`, HTML output uses classes instead of `style`
+    # attributes, and the stylesheet is added to `header-includes` once
+    # (in front of what is there already).
+    import pandocCommentFilter
+    header = {'t': 'MetaInlines', 'c': [Str('mine')]}
+    blocks = [raw('<!comment>', 'RawBlock'),
+              para(span('comment', 'a'), span('margin', 'b'),
+                   span('fixme', 'c')),
+              raw('</!comment>', 'RawBlock')]
+    for docFormat in ['html5', 'revealjs']:
+        document = new_document(deepcopy(blocks), {
+            'draft': {'t': 'MetaBool', 'c': True},
+            'css-classes': {'t': 'MetaBool', 'c': True},
+            'header-includes': deepcopy(header)})
+        output = pandocCommentFilter.filter_document(document, docFormat)
+        text = json.dumps(output['blocks'])
+        assert 'style=' not in text and 'Fix this!' not in text, docFormat
+        for cls in ['block-comment', 'comment', 'margin', 'fixme']:
+            assert 'class=\\"pcf-{}\\"'.format(cls) in text, (docFormat,
+                                                                  cls)
+        includes = output['meta']['header-includes']['c']
+        assert includes[1:] == [header], docFormat
+        assert includes[0]['c'][0]['c'] == [
+            'html', pandocCommentFilter.CLASS_STYLESHEET], docFormat
+    document = new_document(deepcopy(blocks),
+                            {'draft': {'t': 'MetaBool', 'c': True}})
+    output = pandocCommentFilter.filter_document(document, 'html5')
+    assert 'style=' in json.dumps(output) and 'pcf-' not in \
+        json.dumps(output)
+
+
+def test_label_index():
+    # In HTML and docx, references are resolved with the label index, also
+    # across documents (through index files), whether the document is
+    # streamed or not; labels in comments are left out of final output.
+    # Section numbers are pandoc's, and used only if sections are numbered.
+    from io import StringIO
+    import pandocCommentFilter
+
+    def header(level, text, *inlines, **attributes):
+        return {'t': 'Header', 'c': [level, [attributes.get('id', ''),
+                                             attributes.get('classes', []),
+                                             []],
+                                     [Str(text)] + list(inlines)]}
+
+    def links(output):
+        return ''.join(x['c'][1] for block in output['blocks']
+                       if block['t'] == 'Para' for x in block['c']
+                       if x['t'] == 'RawInline')
+
+    tmpdir = mkdtemp()
+    try:
+        indexFile = path.join(tmpdir, 'chapter1.json')
+        chapter1 = new_document([
+            para(span('r', 'later'), span('rp', 'fig'), raw('<r intro>'),
+                 span('r', 'missing'), span('r', 'hidden'),
+                 span('r', 'aside')),
+            header(1, 'Intro', span('l', 'intro')),
+            header(2, 'Details', id='details'),
+            para('x', raw('<l later>')),
+            para({'t': 'Image', 'c': [['fig', [], []], [Str('A figure')],
+                                      ['a.png', 'fig:']]}),
+            header(1, 'Appendix', span('l', 'aside'),
+                   classes=['unnumbered']),
+            raw('<!comment>', 'RawBlock'), para(span('l', 'hidden')),
+            raw('</!comment>', 'RawBlock')], {
+                'number-sections': {'t': 'MetaBool', 'c': True},
+                'label-index': {'t': 'MetaString', 'c': indexFile},
+                'label-index-url': {'t': 'MetaString',
+                                    'c': 'chapter1.html'}})
+        expected = ('<a href="#later">section 1.1</a>'
+                    '<a href="#fig">figure 1</a>'
+                    '<a href="#intro">section 1</a>'
+                    '<a href="#missing">??</a><a href="#hidden">??</a>'
+                    '<a href="#aside">Appendix</a><a name="later"></a>')
+        output = pandocCommentFilter.filter_document(deepcopy(chapter1),
+                                                     'html5')
+        assert links(output) == expected
+        outfile = StringIO()
+        pandocCommentFilter.stream_document(StringIO(json.dumps(chapter1)),
+                                            outfile, 'html5')
+        assert json.loads(outfile.getvalue()) == output
+        with open(indexFile) as f:
+            index = json.load(f)
+        assert index['url'] == 'chapter1.html'
+        assert sorted(index['labels']) == ['aside', 'details', 'fig',
+                                           'intro', 'later']
+
+        chapter2 = new_document([para(span('r', 'details'))], {
+            'label-index-import': {'t': 'MetaList', 'c': [
+                {'t': 'MetaString', 'c': indexFile}]}})
+        output = pandocCommentFilter.filter_document(deepcopy(chapter2),
+                                                     'html5')
+        assert links(output) == \
+            '<a href="chapter1.html#details">section 1.1</a>'
+        output = pandocCommentFilter.filter_document(deepcopy(chapter2),
+                                                     'docx')
+        assert output['blocks'][0]['c'] == [{'t': 'Link', 'c': [
+            ['', [], []], [Str('section 1.1')],
+            ['chapter1.html#details', '']]}]
+
+        preface = new_document([
+            header(2, 'Thanks', id='thanks'), header(1, 'Intro', id='intro'),
+            para(span('r', 'thanks'), span('r', 'intro'))])
+        output = pandocCommentFilter.filter_document(deepcopy(preface),
+                                                     'html5')
+        assert links(output) == ('<a href="#thanks">Thanks</a>'
+                                 '<a href="#intro">Intro</a>')
+        preface['meta']['numbersections'] = {'t': 'MetaBool', 'c': True}
+        output = pandocCommentFilter.filter_document(preface, 'html5')
+        assert links(output) == ('<a href="#thanks">section 0.1</a>'
+                                 '<a href="#intro">section 1</a>')
+    finally:
+        rmtree(tmpdir)
+
+
+def test_serve():
+    # With `--serve`, each document gets the same reply as when it is
+    # filtered on its own (with none of the state of the one before it); a
+    # malformed document gets an error, and a bad header ends the session.
+    from io import BytesIO
+    import pandocCommentFilter
+
+    def frame(docFormat, payload):
+        return '{} {}\n'.format(docFormat, len(payload)).encode() + payload
+
+    unclosed = new_document([para('a', raw('<comment>'), 'b')])
+    after = new_document([para('c', span('comment', 'x'), 'd')])
+    documents = [('html5', unclosed), ('latex', after)]
+    infile = BytesIO(b''.join(
+        [frame(docFormat, json.dumps(document).encode())
+         for docFormat, document in documents] +
+        [frame('html5', b'{"blocks": ["<comment>"'),
+         frame('latex', json.dumps(after).encode()),
+         b'not a header\n', frame('latex', json.dumps(after).encode())]))
+    outfile = BytesIO()
+    pandocCommentFilter.serve_documents(infile, outfile)
+    replies = BytesIO(outfile.getvalue())
+    for expected in documents + [None, ('latex', after), None]:
+        status, length = replies.readline().split()
+        reply = replies.read(int(length))
+        if expected is None:
+            assert status == b'error', reply
+            continue
+        docFormat, document = expected
+        assert status == b'ok', reply
+        assert json.loads(reply.decode('utf-8')) == \
+            pandocCommentFilter.filter_document(deepcopy(document), docFormat)
+    assert reply.startswith(b'Bad header: not a header')
+    assert replies.read() == b''
+
+
+def test_label_index_without_markup():
+    # A document with none of the filter's markup still has its index
+    # written when PANDOC_COMMENT_FILTER_LABEL_INDEX asks for it.
+    tmpdir = mkdtemp()
+    try:
+        indexFile = path.join(tmpdir, 'chapter.json')
+        document = new_document([
+            {'t': 'Header', 'c': [1, ['intro', [], []], [Str('Intro')]]}])
+        environment = dict(os.environ,
+                           PANDOC_COMMENT_FILTER_LABEL_INDEX=indexFile)
+        output = subprocess.check_output(
+            [sys.executable, path.join(ROOT, 'pandocCommentFilter.py'),
+             'html5'], input=json.dumps(document).encode('utf-8'),
+            cwd=tmpdir, env=environment)
+        assert json.loads(output.decode('utf-8')) == document
+        with open(indexFile) as f:
+            assert list(json.load(f)['labels']) == ['intro']
+    finally:
+        rmtree(tmpdir)
+
+
+def test_macros():
+    # `$NAME$` is replaced by the macro's definition, whether pandoc read it
+    # as math or as text, and the markup and macros in the definition are
+    # handled too; a macro used in its own definition is left alone.
+    import pandocCommentFilter
+
+    def math(text):
+        return {'t': 'Math', 'c': [{'t': 'InlineMath'}, text]}
+
+    def inlines(*items):
+        return {'t': 'MetaInlines', 'c': list(items)}
+
+    macros = {'t': 'MetaList', 'c': [{'t': 'MetaMap', 'c': {
+        'a': inlines(Str('A')),
+        'ab': inlines(Str('AB'), math('a')),
+        'hl': inlines(span('highlight', 'H')),
+        'loop': inlines(Str('L'), math('loop'))}}]}
+    document = new_document([
+        para(math('ab'), '($a$),', math('hl'), math('loop'), math('x'))],
+        {'draft': {'t': 'MetaBool', 'c': True}, 'macros': macros})
+    output = pandocCommentFilter.filter_document(deepcopy(document), 'latex')
+    assert output['blocks'][0]['c'] == [
+        Str('AB'), Str('A'), Str('('), Str('A'), Str('),'),
+        raw('\\hl{', rawFormat='latex'), Str('H'),
+        raw('}', rawFormat='latex'), Str('L'), math('loop'), math('x')]
+    # The definitions are not changed by being used.
+    output = pandocCommentFilter.filter_document(deepcopy(document), 'latex')
+    assert output['blocks'][0]['c'][5:8] == [
+        raw('\\hl{', rawFormat='latex'), Str('H'),
+        raw('}', rawFormat='latex')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--jobs', type=int, help='cases to run at once '
+                        '(default: number of CPUs)')
+    parser.add_argument('--python-only', action='store_true',
+                        help='only test the Python filter')
+    parser.add_argument('--subprocess', action='store_true',
+                        help='run the Python filter as a separate process')
+    parser.add_argument('--update', action='store_true',
+                        help='rewrite the reference output')
+    args = parser.parse_args()
+
+    pythonOnly = args.python_only
+    if not pythonOnly and not have_pandoc():
+        print('pandoc not found: only testing the Python filter.')
+        pythonOnly = True
+    cases = make_cases(pythonOnly, not args.subprocess)
+    sys.exit(0 if run_tests(cases, args.update, args.jobs) else 1)
 
 
 if __name__ == '__main__':
-    print("Comparing pandoc output with reference output in tests/:")
-    test_markdown()
-    test_html4()
-    test_html5()
-    test_latex()
-    print("All comparison tests passed ok!")
+    main()